@@ -3,16 +3,225 @@
 Uses classes DB and Pyramid to build a pyramid game.
 """
 
-import wsgiref.simple_server
-import urllib.parse
+import argparse
+import datetime
+import email.utils
+import hashlib
 import http.cookies
-from db_sqlite import DB
+import json
+import urllib.parse
+import wsgiref.simple_server
+
+import archive
+import db_memory
+import db_sharded
+import group_commit
+import metrics
+import profiling
+import render
+import storage
+import threaded_server
+from cache import LRUCache
+from db_sqlite import configure_pool
+from notify import hub, game_topic, user_topic, LOBBY, RESET
 from pyramid import Pyramid
+from storage import DUMP_COLUMNS, open_db
+
+# Paths with their own label in the request metrics
+ROUTES = [
+    '/', '/login_register', '/logout', '/updated_games', '/wait_games', '/newgame', '/join', '/quit', '/game',
+    '/updated_game', '/wait_game', '/leaderboard', '/dump', '/clear_games', '/clear_all', '/metrics',
+    '/api/login', '/api/games', '/api/game', '/api/moves', '/api/leaderboard',
+]
+PAGE_CACHE_SIZE = 1000
+DUMP_PAGE_SIZE = 100
+LEADERBOARD_PAGE_SIZE = 50
+MAX_LEADERBOARD_PAGE = 500  # Users in one /api/leaderboard response
+MAX_API_BODY = 65536  # Bytes
+MAX_API_MOVES = 100  # Moves in one /api/moves request
+
+# Rendered pages as lists of encoded chunks. root_pages maps a user to (stamp, chunks), game_pages maps a game id to
+# {viewer: (stamp, chunks)}. A stamp identifies the data a page was rendered from and the app_root its links start
+# with, so a page is only served while its stamp is current.
+root_pages = LRUCache(PAGE_CACHE_SIZE)
+game_pages = LRUCache(PAGE_CACHE_SIZE)
+
+
+def invalidate_pages(topics):
+    """Drop cached pages affected by a change published on the hub."""
+    for topic in topics:
+        if topic == RESET:
+            root_pages.clear()
+            game_pages.clear()
+        elif topic == LOBBY:
+            root_pages.clear()
+        elif topic.startswith('user:'):
+            root_pages.invalidate(topic[len('user:'):])
+        elif topic.startswith('game:'):
+            game_pages.invalidate(topic[len('game:'):])
+
+
+hub.subscribe(invalidate_pages)
+
+
+def validators(e, headers, stamp, ts):
+    """Add ETag and Last-Modified headers for a page rendered from the data identified by stamp.
+
+    :param e: WSGI environ
+    :param headers: Response headers to extend
+    :param stamp: Tuple identifying the data and viewer of the page
+    :param ts: Timestamp of the latest change in the page, or None
+    :return: True if the client's copy (If-None-Match) is still current
+    """
+    etag = '"{}"'.format(hashlib.sha1(repr(stamp).encode()).hexdigest()[:20])
+    headers.append(('ETag', etag))
+    headers.append(('Cache-Control', 'private, no-cache'))
+    if ts:
+        modified = datetime.datetime.strptime(ts, '%Y-%m-%d %H:%M:%S').replace(tzinfo=datetime.timezone.utc)
+        headers.append(('Last-Modified', email.utils.format_datetime(modified, usegmt=True)))
+    return etag in [tag.strip() for tag in e.get('HTTP_IF_NONE_MATCH', '').split(',')]
+
+
+def load_lobby_games(db, username):
+    """Return the games username can join as Pyramid objects, built from the lobby index without SQL."""
+    rows = [(i, p, g, 0, ts, r, v) for i, p, g, ts, r, v in db.get_registering_games_by_user(username)]
+    return Pyramid.load_many(rows, db, players=db.get_registering_players([row[0] for row in rows]))
+
+
+def load_game(db, game_id):
+    """Return a game as Pyramid object, read-only from the archive if it is no longer in the hot tables.
+
+    :return: Pyramid, None if there is no such game
+    """
+    try:
+        game_id = int(game_id)
+    except ValueError:
+        return None
+    row = db.get_game_by_id(game_id)
+    if row is not None:
+        return Pyramid(game_id, *row, db)
+    archived = db.get_archived_game(game_id)
+    if archived is None:
+        return None
+    row, players, moves = archived
+    return Pyramid(game_id, *row, None, players=players, moves=moves)
+
+
+def root_page_version(db, username):
+    """Return the version of the data of a user's root page, which /wait_games waits to change.
+
+    The hub version moves on changes made through this process, the change counters in the database on those made by
+    any process sharing it.
+    """
+    version = hub.version(LOBBY, user_topic(username))  # Read before the counters so no change slips past
+    return '{}-{}-{}'.format(version, *db.updated_games(username))
+
+
+def game_page_version(db, game_id):
+    """Return the version of the data of a game page, which /wait_game waits to change, see root_page_version()."""
+    version = hub.version(game_topic(game_id))
+    row = db.get_game_by_id(game_id)
+    if row is None:
+        archived = db.get_archived_game(game_id)
+        row = archived and archived[0]
+    return '{}-{}'.format(version, row[5] if row else None)
+
+
+def seen_version(params):
+    """Return the version a page was rendered at, from the v parameter of its long-poll, and the hub version in it.
+
+    :raise KeyError: If there is no v
+    :raise ValueError: If v is not a version
+    """
+    seen = params['v'][0]
+    return seen, int(seen.split('-', 1)[0])
+
+
+def wait_version(db, topics, seen, current):
+    """Long-poll: wait until the version of a page differs from seen, holding no pooled connection while waiting.
+
+    Changes made through this process wake the hub. Those made by other processes are found by comparing current()
+    with seen every notify.CHECK_INTERVAL seconds.
+
+    :param topics: Topics of the page
+    :param seen: (version, hub version) from seen_version()
+    :param current: Function returning the current version of the page
+    :return: Current version
+    """
+    def changed():
+        try:
+            return current() != seen[0]
+        finally:
+            db.close()
+
+    db.close()
+    hub.wait(topics, seen[1], changed=changed)
+    return current()
+
+
+def cache_game_page(game_id, viewer, stamp, chunks):
+    viewers = game_pages.get(game_id)
+    if viewers is None:
+        viewers = {}
+        game_pages.put(game_id, viewers)
+    viewers[viewer] = (stamp, chunks)
+
+
+def cached_stream(chunks, store):
+    """Pass chunks through and hand the complete list to store() once the last one has been sent."""
+    sent = []
+    for chunk in chunks:
+        sent.append(chunk)
+        yield chunk
+    store(sent)
+
+
+class Response:
+    """Response body that closes the Storage object, handing back e.g. its pooled connection, when the server closes
+    the body.
+
+    Pages are rendered while the server iterates over them and may still read from storage, so it cannot be closed
+    when handle_request() returns.
+    """
+    def __init__(self, body, db):
+        self.body = body
+        self.db = db
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.db.close()
 
 
 def application(e, start_response):
-    db = DB()
+    db = open_db()
+    try:
+        return Response(handle_request(e, start_response, db), db)
+    except BaseException:
+        db.close()
+        raise
+
+
+application = metrics.MetricsMiddleware(application, ROUTES)
+
+
+def request_session_token(e):
+    """Return the session token of a request, from the session cookie or an Authorization: Bearer header."""
+    if e.get('HTTP_AUTHORIZATION', '').startswith('Bearer '):  # API clients send the session token as a header
+        return e['HTTP_AUTHORIZATION'][len('Bearer '):].strip()
+    if 'HTTP_COOKIE' in e:
+        cookies = http.cookies.SimpleCookie(e['HTTP_COOKIE'])
+        if 'session' in cookies:
+            return cookies['session'].value
+    return None
+
 
+def handle_request(e, start_response, db):
     headers = [('Content-Type', 'text/html; charset=utf-8')]
     app_root = urllib.parse.urlunsplit((e['wsgi.url_scheme'], e['HTTP_HOST'], e['SCRIPT_NAME'], '', ''))
     params = urllib.parse.parse_qs(e['QUERY_STRING'])
@@ -22,24 +231,17 @@ def application(e, start_response):
 
     session = False
     session_user = None
-    cookies = http.cookies.SimpleCookie()
-    if 'HTTP_COOKIE' in e:
-        cookies.load(e['HTTP_COOKIE'])
-        if 'session' in cookies:
-            session_user, session_pass = cookies['session'].value.split(':')
-            session = db.user_pass_valid(session_user, session_pass)
+    session_token = request_session_token(e)
+    if session_token:
+        session_user = db.session_user(session_token)
+        session = session_user is not None
+
+    if path_info.startswith('/api/'):
+        return handle_api(e, start_response, db, path_info, params, session_user)
 
     # ----- The common start of every page ---------------------------
 
-    page = '''<!DOCTYPE html>
-<html><head><title>Game</title>
-<style>
-    table { border-collapse: collapse; }
-    table, th, td { border: 1px solid silver; padding: 2px; }
-</style>
-</head>
-<body>
-<h1>Rock-Paper-Scissors</h1>'''
+    page = render.HEADER
 
     # ----- For logging in and registering ---------------------------
 
@@ -58,7 +260,7 @@ def application(e, start_response):
 
         if param_do == 'Login' and param_user and param_pass:
             if db.user_pass_valid(param_user, param_pass):
-                headers.append(('Set-Cookie', 'session={}:{}'.format(param_user, param_pass)))
+                headers.append(('Set-Cookie', 'session={}; HttpOnly'.format(db.new_session(param_user))))
                 headers.append(('Location', app_root))
                 start_response('303 See Other', headers)
                 return []
@@ -69,7 +271,7 @@ def application(e, start_response):
 
         elif param_do == 'Register' and param_user and param_pass:
             if db.add_username(param_user, param_pass):
-                headers.append(('Set-Cookie', 'session={}:{}'.format(param_user, param_pass)))
+                headers.append(('Set-Cookie', 'session={}; HttpOnly'.format(db.new_session(param_user))))
                 headers.append(('Location', app_root))
                 start_response('303 See Other', headers)
                 return []
@@ -85,6 +287,8 @@ def application(e, start_response):
     # ----- Logout --------------------------------------------
 
     elif path_info == '/logout':
+        if session_token:
+            db.delete_session(session_token)
         headers.append(('Set-Cookie', 'session=0; expires=Thu, 01 Jan 1970 00:00:00 GMT'))
         headers.append(('Location', app_root))
         start_response('303 See Other', headers)
@@ -98,79 +302,24 @@ def application(e, start_response):
             page += '<a href="{}/login_register">Log in or register</a> to play</body></html>'.format(app_root)
             return [page.encode()]
 
-        page += '{} | <a href="{}/logout">Logout</a>'.format(session_user, app_root)
-#       page += ' | <a href="{}">Refresh</a>'.format(app_root)
-        page += '<h2>My games</h2>\n'
-        page += '<table><tr><th>Game</th><th>Goal</th><th>Quit</th><th>State</th><th>Players</th></tr>\n'
-        games = [
-            Pyramid(i, p, g, st, ts, t, db.connection) for i, p, g, st, ts, t in db.get_games_by_user(session_user)
-            ]
-        for game in games:
-            page += '<tr><td>{}</td><td>{}</td><td><a href="{}/quit?id={}">quit</a></td>'.format(
-                game.id, game.goal, app_root, game.id
-            )
-            players_scores = ', '.join(
-                [
-                    '{}{}|{}{}'.format(
-                        '' if p['playing'] else '<s>',  # Add open strikethrough tag if player left game
-                        p['name'],
-                        p['score'],
-                        '' if p['playing'] else '</s>'  # Add close strikethrough tag
-                    ) for p in game.players
-                ]
-            )
-            if game.state == 0:  # Accepting players
-                page += '<td>Awaiting {}</td>'.format(game.num_players - len(game.players))
-                page += '<td>' + ', '.join([p['name'] for p in game.players]) + '</td>'
-            elif game.state == 2:
-                page += '<td><a href="{}/game?id={}">Game over</a></td>'.format(app_root, game.id)
-                page += '<td>' + players_scores + '</td>'
-            elif game.is_players_turn(session_user):  # Playing, player's turn
-                page += '<td><a href="{}/game?id={}">My turn</a></td>'.format(app_root, game.id)
-                page += '<td>' + players_scores + '</td>'
-            else:  # Playing, not player's turn
-                page += '<td><a href="{}/game?id={}">Awaiting Turn</a></td>'.format(app_root, game.id)
-                page += '<td>' + players_scores + '</td>'
-            page += '</tr>\n'
-        page += '</table>'
-        page += '<p><a href="{}/newgame">Start a New Game</a></p>'.format(app_root)
-        ts1 = max(game.ts for game in games) if games else None
-
-        page += '<h2>Games accepting players</h2>\n'
-        page += '<table><tr><th>Game</th><th>Goal</th><th>Join</th><th>State</th><th>Players</th></tr>\n'
-        games = [
-            Pyramid(i, p, g, 0, ts, t, db.connection)
-            for i, p, g, ts, t in db.get_registering_games_by_user(session_user)
-            ]
-        for game in games:
-            page += '<tr><td>{}</td><td>{}</td><td><a href="{}/join?id={}">join</a></td>'.format(
-                game.id, game.goal, app_root, game.id
-            )
-            page += '<td>{} of {} players</td>'.format(len(game.players), game.num_players, game.id)
-            page += '<td>' + ', '.join([p['name'] for p in game.players]) + '</td>'
-            page += '</tr>\n'
-        page += '</table>'
-        ts2 = max(game.ts for game in games) if games else None
+        version = root_page_version(db, session_user)  # Read before the games so no change slips past
+        stamp = (app_root, session_user, version)  # Links in the page start with app_root
+        if validators(e, headers, stamp, None):
+            start_response('304 Not Modified', headers)
+            return []
+        cached = root_pages.get(session_user)
+        if cached and cached[0] == stamp:
+            start_response('200 OK', headers)
+            return cached[1]
 
-        page += '''
-<script>
-    function callback(event) {{
-        if (event.target.readyState == 4 && event.target.responseText != '{} {}') {{
-            window.location = '{}'
-        }}
-    }}
-    function timeFunc(event) {{
-        var xmlhttp = new XMLHttpRequest();
-        xmlhttp.addEventListener("readystatechange", callback)
-        xmlhttp.open("GET", "{}/updated_games", true)
-        xmlhttp.setRequestHeader("Content-Type", "text/plain")
-        xmlhttp.send()
-    }}
-    setInterval(timeFunc, 1000)
-</script>'''.format(ts1, ts2, app_root, app_root)
+        games = Pyramid.load_many(db.get_games_by_user(session_user), db)
+        lobby_games = load_lobby_games(db, session_user)
 
         start_response('200 OK', headers)
-        return [(page + '</body></html>').encode()]
+        return cached_stream(
+            render.stream(render.root_page(app_root, session_user, games, lobby_games, version)),
+            lambda chunks: root_pages.put(session_user, (stamp, chunks))
+        )
 
     # ----- Check if game list changed -------------------------------------------
 
@@ -179,10 +328,28 @@ def application(e, start_response):
             start_response('200 OK', headers)
             return ['No session'.encode()]
 
-        ts1, ts2 = db.updated_games(session_user)
+        games_version, lobby_version = db.updated_games(session_user)
+
+        start_response('200 OK', headers)
+        return ['{} {}'.format(games_version, lobby_version).encode()]
+
+    # ----- Wait until game list changes (long-poll) -----------------------------
+
+    elif path_info == '/wait_games':
+        if not session:
+            start_response('200 OK', headers)
+            return ['No session'.encode()]
+
+        try:
+            seen = seen_version(params)
+        except (KeyError, ValueError):
+            start_response('400 Bad Request', headers)
+            return ['Expected v'.encode()]
+        topics = (LOBBY, user_topic(session_user))
+        version = wait_version(db, topics, seen, lambda: root_page_version(db, session_user))
 
         start_response('200 OK', headers)
-        return ['{} {}'.format(ts1, ts2).encode()]
+        return ['{}'.format(version).encode()]
 
     # ----- Register new game ---------------------------------------------------------------
     # ***** MODIFY THIS PART TO ASK FOR NUMBER OF PLAYERS AND RECEIVE NUMBER OF PLAYERS *****
@@ -251,71 +418,34 @@ def application(e, start_response):
             return ['No session'.encode()]
 
         game_id = params['id'][0]
+        version = hub.version(game_topic(game_id))
 
-        (players, goal, state, ts, turns) = db.get_game_by_id(game_id)
-        game = Pyramid(game_id, players, goal, state, ts, turns, db.connection)
+        game = load_game(db, game_id)
+        if game is None:
+            start_response('200 OK', headers)
+            return [(page + 'Unknown game</body></html>').encode()]
         if game.state == 0:  # Error: cannot view game, it is still registering players
             start_response('200 OK', headers)
             return [(page + 'Still registering players</body></html>').encode()]
 
-        if 'move' in params:  # Player came here by making a move
+        stamp = None
+        if 'move' in params and not game.read_only:  # Player came here by making a move
             game.add_player_move(session_user, params['move'][0])
-
-        page += '<a href="{}">Home</a>'.format(app_root)
-#       page += ' | <a href="{}/game?id={}">Refresh</a>'.format(app_root, game_id)
-        page += '<h3>Game {} -- Play to {}</h3>'.format(game.id, game.goal)
-
-        if game.state == 2:
-            page += '<p>Game over</p>'
-        elif game.is_players_turn(session_user):
-            page += '<p>Your move: '
-            move_template = '<a href="{}/game?id={}&amp;move={}">{}</a>'
-            move_links = [
-                move_template.format(app_root, game.id, mval, mname) for mval, mname in game.valid_moves(session_user)
-                ]
-            page += ' | '.join(move_links)
         else:
-            page += '<p>Wait for your turn</p>'
-
-        page += '<table>\n<tr><th>&nbsp;</th>'
-        for p in game.players:
-            page += '<th>{}</th>'.format(p['name']) if p['playing'] else '<th><s>{}</s></th>'.format(p['name'])
-        page += '</tr>\n<tr style="background-color: silver"><td>Round</td>'
-        for p in game.players:
-            page += '<td>{} p</td>'.format(p['score'])
-        page += '</tr>\n'
-
-        for index, turn in enumerate(reversed(game.decorated_moves(session_user))):
-            page += '<tr><td>{}</td>'.format(len(game.turns) - index)
-            for move, winner in turn:
-                if winner:
-                    page += '<td style="background-color:lightgreen">{}</td>'.format(move)
-                else:
-                    page += '<td>{}</td>'.format(move)
-            page += '</tr>\n'
-
-        page += '</table>'
-
-        if game.state == 1:
-            page += '''
-<script>
-    function callback(event) {{
-        if (event.target.readyState == 4 && event.target.responseText != '{}') {{
-            window.location = '{}/game?id={}'
-        }}
-    }}
-    function timeFunc(event) {{
-        var xmlhttp = new XMLHttpRequest();
-        xmlhttp.addEventListener("readystatechange", callback)
-        xmlhttp.open("GET", "{}/updated_game?id={}", true)
-        xmlhttp.setRequestHeader("Content-Type", "text/plain")
-        xmlhttp.send()
-    }}
-    setInterval(timeFunc, 1000)
-</script>'''.format(game.ts, app_root, game.id, app_root, game.id)
+            stamp = (app_root, str(game.id), session_user, game.version, version)
+            if validators(e, headers, stamp, game.ts):
+                start_response('304 Not Modified', headers)
+                return []
+            cached = (game_pages.get(str(game.id)) or {}).get(session_user)
+            if cached and cached[0] == stamp:
+                start_response('200 OK', headers)
+                return cached[1]
 
         start_response('200 OK', headers)
-        return [(page + '</body></html>').encode()]
+        chunks = render.stream(render.game_page(app_root, game, session_user, '{}-{}'.format(version, game.version)))
+        if not stamp:
+            return chunks
+        return cached_stream(chunks, lambda chunks: cache_game_page(str(game.id), session_user, stamp, chunks))
 
     # ----- Check if game changed --------------------------------------
 
@@ -325,47 +455,81 @@ def application(e, start_response):
             return ['No session'.encode()]
 
         start_response('200 OK', headers)
-        p, g, s, ts, t = db.get_game_by_id(params['id'][0])
-        return ['{}'.format(ts).encode()]
+        game = load_game(db, params['id'][0])
+        return ['{}'.format(game.ts if game else None).encode()]
+
+    # ----- Wait until game changes (long-poll) -----------------------------------
+
+    elif path_info == '/wait_game':
+        if not session:
+            start_response('200 OK', headers)
+            return ['No session'.encode()]
+
+        try:
+            game_id = int(params['id'][0])
+            seen = seen_version(params)
+        except (KeyError, ValueError):
+            start_response('400 Bad Request', headers)
+            return ['Expected id and v'.encode()]
+        version = wait_version(db, (game_topic(game_id),), seen, lambda: game_page_version(db, game_id))
+
+        start_response('200 OK', headers)
+        return ['{}'.format(version).encode()]
+
+    # ----- Leaderboard ------------------------------------------------
+
+    elif path_info == '/leaderboard':
+        # Keyset pagination: after is the name of the last user of the previous page, rank the rank of the next one
+        after = params['after'][0] if 'after' in params else None
+        try:
+            rank = max(1, int(params['rank'][0])) if 'rank' in params else 1
+        except ValueError:
+            rank = 1  # rank only numbers the rows, a bad one from a hand-edited link starts them at 1
+        rows = db.leaderboard(after, LEADERBOARD_PAGE_SIZE)
+        start_response('200 OK', headers)
+        return render.stream(render.leaderboard_page(app_root, rows, rank, LEADERBOARD_PAGE_SIZE))
 
     # ----- Dump tables ------------------------------------------------
 
     elif path_info == '/dump':
-        users, games, players = db.dump()
-
-        page += '<a href="{}">Home</a>'.format(app_root)
-        page += ' | <a href="{}/clear_games">Clear games and players</a>'.format(app_root)
-        page += ' | <a href="{}/clear_all">Clear all</a>'.format(app_root)
-
-        page += '<h2>Table "user"</h2>\n'
-        page += '<p>Contains all registered users and their passwords.</p>\n'
-        page += '<table><tr><th>name</th><th>password</th></tr>\n'
-        for name, password in users:
-            page += '<tr><td>{}</td><td>{}</td></tr>\n'.format(name, password)
-        page += '</table>\n'
-
-        page += '<h2>Table "game"</h2>\n'
-        page += '<p>One row for every game.</p>\n'
-        page += '<table><tr><th>rowid</th><th>players</th><th>goal</th><th>state</th><th>ts</th><th>turns</th></tr>\n'
-        for rowid, numplayers, goal, state, ts, turns in games:
-            page += '<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>\n'.format(
-                rowid, numplayers, goal, state, ts, turns
-            )
-        page += '</table>\n'
-
-        page += '<h2>Table "player"</h2>\n'
-        page += '<p>Connects players with games. One row for every player in a game.</p>\n'
-        page += '<table><tr><th>rowid</th><th>game_id</th><th>user_name</th><th>score</th><th>playing</th></tr>\n'
-        for rowid, game_id, user_name, score, playing in players:
-            page += '<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>\n'.format(
-                rowid, game_id, user_name, score, playing
-            )
-        page += '</table>\n'
-
-        page += '</body></html>'
+        # /dump shows the first DUMP_PAGE_SIZE rows of every table with links to further pages (keyset pagination
+        # by rowid). Parameters: table, after (rowid), limit, stream=1 for all rows, format=ndjson or format=csv.
+        tables = params['table'] if 'table' in params else None
+        if tables and [table for table in tables if table not in DUMP_COLUMNS]:
+            start_response('200 OK', headers)
+            return [(page + 'Unknown table</body></html>').encode()]
+        export = params['format'][0] if 'format' in params else None
+        after = int(params['after'][0]) if 'after' in params else 0
+        if 'limit' in params:
+            limit = int(params['limit'][0])
+        elif 'stream' in params or export:
+            limit = None
+        else:
+            limit = DUMP_PAGE_SIZE
+        dump = db.dump(tables, after, limit)
+
+        if export == 'ndjson':
+            start_response('200 OK', [('Content-Type', 'application/x-ndjson; charset=utf-8')])
+            return render.stream(render.dump_ndjson(dump))
+        elif export == 'csv':
+            if len(dump) != 1:
+                start_response('200 OK', headers)
+                return [(page + 'CSV export needs one table</body></html>').encode()]
+            table, columns, rows = dump[0]
+            start_response('200 OK', [
+                ('Content-Type', 'text/csv; charset=utf-8'),
+                ('Content-Disposition', 'attachment; filename="{}.csv"'.format(table))
+            ])
+            return render.stream(render.dump_csv(columns, rows))
 
         start_response('200 OK', headers)
-        return [page.encode()]
+        return render.stream(render.dump_page(app_root, dump, limit))
+
+    # ----- Metrics ----------------------------------------------------
+
+    elif path_info == '/metrics':
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')])
+        return [metrics.exposition().encode()]
 
     # ----- Clear tables --------------------------------------
 
@@ -387,5 +551,203 @@ def application(e, start_response):
         start_response('200 OK', headers)
         return [(page + 'Unknown Web app {}</body></html>'.format(path_info)).encode()]
 
-httpd = wsgiref.simple_server.make_server('', 8000, application)
-httpd.serve_forever()
+
+def json_response(start_response, data, status='200 OK', headers=()):
+    start_response(status, [('Content-Type', 'application/json')] + list(headers))
+    return [render.to_json(data)]
+
+
+def read_json(e):
+    """Return the decoded JSON request body, or None if it is missing, too big or not JSON."""
+    try:
+        length = int(e.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return None
+    if not 0 < length <= MAX_API_BODY:
+        return None
+    try:
+        return json.loads(e['wsgi.input'].read(length))
+    except ValueError:
+        return None
+
+
+def handle_api(e, start_response, db, path_info, params, session_user):
+    """JSON endpoints for bots and native clients.
+
+    POST /api/login with {"username", "password", "register"} returns {"token"}. Other requests send the token as
+    "Authorization: Bearer <token>" or use the session cookie of the web pages. GET /api/games and GET
+    /api/game?id=..&since=.. answer with ETags and 304 Not Modified while nothing changed. POST /api/moves takes
+    [{"id": game id, "move": move}, ...] and makes all the moves in one transaction. GET /api/leaderboard?after=..
+    &limit=.. needs no session.
+    """
+
+    # ----- Log in or register -----------------------------------------
+
+    if path_info == '/api/login':
+        data = read_json(e)
+        if not isinstance(data, dict) or not data.get('username') or not data.get('password'):
+            return json_response(start_response, {'error': 'Expected username and password'}, '400 Bad Request')
+        username, password = str(data['username']), str(data['password'])
+        if data.get('register'):
+            if not db.add_username(username, password):
+                return json_response(start_response, {'error': 'Username is taken'}, '409 Conflict')
+        elif not db.user_pass_valid(username, password):
+            return json_response(start_response, {'error': 'Wrong username or password'}, '403 Forbidden')
+        return json_response(start_response, {'token': db.new_session(username)})
+
+    # ----- Leaderboard ------------------------------------------------
+
+    if path_info == '/api/leaderboard':
+        try:
+            limit = int(params['limit'][0]) if 'limit' in params else LEADERBOARD_PAGE_SIZE
+        except ValueError:
+            return json_response(start_response, {'error': 'Expected a number as limit'}, '400 Bad Request')
+        limit = max(1, min(limit, MAX_LEADERBOARD_PAGE))
+        rows = db.leaderboard(params['after'][0] if 'after' in params else None, limit)
+        return json_response(start_response, render.leaderboard_json(rows, limit))
+
+    if not session_user:
+        return json_response(start_response, {'error': 'No session'}, '401 Unauthorized')
+    headers = []
+
+    # ----- Games and lobby --------------------------------------------
+
+    if path_info == '/api/games':
+        version = hub.version(LOBBY, user_topic(session_user))
+        games_version, lobby_version = db.updated_games(session_user)
+        stamp = ('api', session_user, games_version, lobby_version, version)
+        if validators(e, headers, stamp, None):
+            start_response('304 Not Modified', headers)
+            return []
+        games = Pyramid.load_many(db.get_games_by_user(session_user), db)
+        lobby_games = load_lobby_games(db, session_user)
+        return json_response(start_response, render.games_json(session_user, games, lobby_games), headers=headers)
+
+    # ----- One game ---------------------------------------------------
+
+    elif path_info == '/api/game':
+        try:
+            game_id = int(params['id'][0])
+            since = int(params['since'][0]) if 'since' in params else 0
+        except (KeyError, ValueError):
+            return json_response(start_response, {'error': 'Expected id'}, '400 Bad Request')
+        version = hub.version(game_topic(game_id))
+        game = load_game(db, game_id)
+        if game is None:
+            return json_response(start_response, {'error': 'No such game'}, '404 Not Found')
+        if session_user not in [p.name for p in game.players]:
+            return json_response(start_response, {'error': 'Not a player'}, '403 Forbidden')
+        if validators(e, headers, ('api', game_id, session_user, game.version, version, since), game.ts):
+            start_response('304 Not Modified', headers)
+            return []
+        return json_response(start_response, render.game_json(game, session_user, since), headers=headers)
+
+    # ----- Moves in several games -------------------------------------
+
+    elif path_info == '/api/moves':
+        data = read_json(e)
+        if not isinstance(data, list) or len(data) > MAX_API_MOVES:
+            return json_response(start_response, {'error': 'Expected a list of at most {} moves'.format(
+                MAX_API_MOVES)}, '400 Bad Request')
+        try:
+            moves = [(int(item['id']), str(item['move'])) for item in data]
+        except (KeyError, TypeError, ValueError):
+            return json_response(start_response, {'error': 'Expected {"id": game, "move": move} items'},
+                                 '400 Bad Request')
+        results = []
+        game_ids = {game_id for game_id, move in moves}
+        with db.batch(game_ids):  # Holds the write lock, so the games cannot change between reading them and the commit
+            games = {game.id: game for game in Pyramid.load_many(db.get_games_by_ids(game_ids), db)}
+            for game_id in game_ids - games.keys():
+                games[game_id] = load_game(db, game_id)  # Read-only if archived, moves on it are not made
+            for game_id, move in moves:
+                game = games.get(game_id)
+                if game is None or session_user not in [p.name for p in game.players]:
+                    results.append({'id': game_id, 'error': 'Not a player'})
+                    continue
+                results.append({
+                    'id': game_id,
+                    'ok': game.add_player_move(session_user, move),
+                    'state': game.state,
+                    'rounds': game.rounds,
+                    'players': [render.player_json(p) for p in game.players],
+                })
+        return json_response(start_response, {'results': results})
+
+    else:
+        return json_response(start_response, {'error': 'Unknown API {}'.format(path_info)}, '404 Not Found')
+
+
+def argument_parser(description):
+    """Return a parser of the command line options shared by the servers of the app, see configure()."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=threaded_server.WORKERS,
+                        help='threads running requests, 0 for the single-threaded wsgiref server of app.py')
+    parser.add_argument('--queue', type=int, default=threaded_server.QUEUE_SIZE,
+                        help='requests allowed to wait for a worker before answering 503')
+    parser.add_argument('--storage', choices=['sqlite', 'memory'], default='sqlite',
+                        help='keep data in game.db or only in memory, lost when the server stops')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='spread games over this many SQLite files, see db_sharded')
+    parser.add_argument('--group-commit', action='store_true',
+                        help='save the changes of concurrent requests in shared transactions, see group_commit')
+    parser.add_argument('--commit-window', type=float, default=group_commit.WINDOW,
+                        help='seconds the group commit writer waits for more changes')
+    parser.add_argument('--commit-batch', type=int, default=group_commit.MAX_BATCH,
+                        help='changes per group commit transaction')
+    parser.add_argument('--archive-interval', type=float, default=archive.INTERVAL,
+                        help='seconds between runs of the archive job, 0 to not run it')
+    parser.add_argument('--archive-days', type=float, default=archive.RETENTION_DAYS,
+                        help='archive games that have been over for this many days')
+    return parser
+
+
+def configure(args):
+    """Set up the storage backend and start the archive job as chosen on the command line of a server.
+
+    :param args: argparse.Namespace of a parser returned by argument_parser()
+    :raise ValueError: If the options do not go together, before anything is set up
+    :raise RuntimeError: If game.db was split into a different number of shards, see db_sharded.check_layout()
+    """
+    if args.group_commit and (args.storage != 'sqlite' or args.shards > 1):
+        raise ValueError('--group-commit needs the sqlite storage without shards')
+    if args.storage == 'memory':
+        storage.configure(db_memory.MemoryDB)
+    elif args.shards > 1:
+        db_sharded.configure(count=args.shards, size=max(1, args.workers))
+        storage.configure(db_sharded.ShardedDB)
+    elif args.group_commit:
+        group_commit.start(configure_pool(size=max(1, args.workers) + 1), args.commit_window, args.commit_batch)
+        storage.configure(group_commit.GroupCommitDB)
+    elif args.workers > 0:
+        configure_pool(size=args.workers)
+    if args.storage != 'memory' and args.shards <= 1:
+        db_sharded.check_layout()  # Refuse a game.db whose games were moved to shards
+    if args.archive_interval > 0:
+        archive.ArchiveThread(args.archive_interval, args.archive_days).start()
+
+
+if __name__ == '__main__':
+    parser = argument_parser('Serve the game web app.')
+    parser.add_argument('--profile-dir', help='write sampled profiles of selected requests to this directory')
+    parser.add_argument('--profile-rate', type=float, default=0.0, help='fraction of requests to profile')
+    parser.add_argument('--profile-route', action='append', default=[], help='always profile this path')
+    parser.add_argument('--profile-user', action='append', default=[], help='always profile requests by this user')
+    args = parser.parse_args()
+    try:
+        configure(args)
+    except ValueError as error:
+        parser.error(str(error))
+
+    if args.profile_dir:
+        application = profiling.ProfilingMiddleware(
+            application, args.profile_dir, args.profile_rate, args.profile_route, args.profile_user
+        )
+    if args.workers > 0:
+        hub.max_waiters = max(1, args.workers // 2)
+        httpd = threaded_server.make_server('', args.port, application, args.workers, args.queue)
+    else:
+        hub.max_waiters = 0  # A single thread cannot hold long-polls open
+        httpd = wsgiref.simple_server.make_server('', args.port, application)
+    httpd.serve_forever()
@@ -0,0 +1,116 @@
+"""Background job keeping the hot tables proportional to active play.
+
+Games that have been over for longer than the retention window are copied to the archive, a separate read-only
+database file with one compressed row per game (see db_sqlite.Archive), and then deleted from game, player and move.
+Games accepting players that nobody joined or quit for as long are deleted without being archived. The job works in
+small batches, each deleting in one short write transaction and borrowing a pooled connection only while it runs,
+with a pause in between so live requests get the write lock. /game falls back to the archive for games that are no
+longer in the hot tables. Game ids are never reused, so an archived id cannot clash with a new game. Expired sessions
+are deleted in batches as well.
+
+    python archive.py --days 30 --batch 100
+"""
+
+import argparse
+import datetime
+import threading
+import time
+import traceback
+
+from db_sqlite import configure_pool
+from storage import open_db
+
+RETENTION_DAYS = 30
+BATCH_SIZE = 100  # Games per write transaction, at most MAX_SQL_VARIABLES
+PAUSE = 0.05  # Seconds between batches
+INTERVAL = 3600  # Seconds between runs of the background thread
+
+
+def cutoff(days):
+    """Start of the retention window in the format of utc_timestamp()."""
+    start = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days)
+    return start.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def archive_batch(db, before, batch_size=BATCH_SIZE):
+    """Archive one batch of games that were over before the given time and delete them from the hot tables.
+
+    A game that changes after it was archived, e.g. because a player quit, is not deleted. The next run archives it
+    again.
+
+    :return: Number of games deleted
+    """
+    due = db.finished_games(before, batch_size)
+    if not due:
+        return 0
+    games = db.export_games(game_id for game_id, version in due)
+    db.archive_games(games)  # Before deleting, so every game is always in at least one of the two
+    return len(db.delete_games([(game_id, row[5]) for game_id, (row, players, moves) in games.items()]))
+
+
+def delete_abandoned_batch(db, before, batch_size=BATCH_SIZE):
+    """Delete one batch of games that have not seen a player join or quit since the given time.
+
+    :return: Number of games deleted
+    """
+    return len(db.delete_games(db.abandoned_games(before, batch_size)))
+
+
+def run(days=RETENTION_DAYS, batch_size=BATCH_SIZE, pause=PAUSE):
+    """Archive and delete all games that are due, and delete expired sessions, batch after batch.
+
+    :return: (games archived, abandoned games deleted, sessions deleted)
+    """
+    before = cutoff(days)
+    totals = []
+    steps = [
+        lambda db: archive_batch(db, before, batch_size),
+        lambda db: delete_abandoned_batch(db, before, batch_size),
+        lambda db: db.delete_expired_sessions(batch_size),
+    ]
+    for step in steps:
+        total = 0
+        while True:
+            with open_db() as db:
+                count = step(db)
+            total += count
+            if not count:  # Done, or every game of the batch changed meanwhile and is no longer due
+                break
+            time.sleep(pause)
+        totals.append(total)
+    return tuple(totals)
+
+
+class ArchiveThread(threading.Thread):
+    """Daemon thread calling run() every interval seconds."""
+    def __init__(self, interval=INTERVAL, days=RETENTION_DAYS, batch_size=BATCH_SIZE):
+        super().__init__(name='archive', daemon=True)
+        self.interval = interval
+        self.days = days
+        self.batch_size = batch_size
+        self.stopped = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                run(days=self.days, batch_size=self.batch_size)
+            except Exception:  # E.g. the database stayed locked, try again next time
+                traceback.print_exc()
+            if self.stopped.wait(self.interval):
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Move finished games to the archive and delete abandoned ones.')
+    parser.add_argument('--days', type=float, default=RETENTION_DAYS, help='retention window')
+    parser.add_argument('--batch', type=int, default=BATCH_SIZE, help='games or sessions per write transaction')
+    parser.add_argument('--pause', type=float, default=PAUSE, help='seconds between batches')
+    args = parser.parse_args()
+
+    configure_pool(size=1)
+    print('{} games archived, {} abandoned games deleted, {} expired sessions deleted'.format(
+        *run(args.days, args.batch, args.pause)))
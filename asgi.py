@@ -0,0 +1,364 @@
+"""ASGI entry point for the web app, with a small asyncio HTTP/1.1 server.
+
+ASGIApp runs the WSGI application on a bounded pool of threads, so the event loop never waits for SQLite, and
+streams the response back chunk by chunk. Long-polls (/wait_games and /wait_game) are answered on the event loop
+itself with Hub.wait_async(), so an idle client costs a socket and a coroutine instead of a thread. All other routes
+go through app.application unchanged.
+
+    python asgi.py --port 8000 --workers 8
+    uvicorn asgi:application  (any ASGI server works as well)
+"""
+
+import asyncio
+import concurrent.futures
+import http
+import io
+import sys
+import time
+import urllib.parse
+
+import app
+import metrics
+import storage
+import threaded_server
+from notify import hub, game_topic, user_topic, LOBBY
+
+MAX_BODY = 1048576  # Bytes
+MAX_HEADER = 65536  # Bytes
+KEEP_ALIVE_TIMEOUT = 75.0  # Seconds an idle connection is kept open
+
+_done = object()
+
+
+def wsgi_environ(scope, body):
+    """Build a WSGI environ for an ASGI http scope.
+
+    :param scope: ASGI connection scope
+    :param body: Complete request body
+    :return: Dict
+    """
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    e = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            e[name] = value
+        elif name != 'CONTENT_LENGTH':
+            key = 'HTTP_' + name
+            e[key] = e[key] + ',' + value if key in e else value
+    e.setdefault('HTTP_HOST', '{}:{}'.format(server_name, server_port))
+    return e
+
+
+def session_user(token):
+    with storage.open_db() as db:
+        return db.session_user(token)
+
+
+def page_version(version, *args):
+    """Call app.root_page_version() or app.game_page_version() with a Storage object of its own."""
+    with storage.open_db() as db:
+        return version(db, *args)
+
+
+class ASGIApp:
+    """ASGI application serving a WSGI application from a bounded pool of threads.
+
+    :param wsgi_app: WSGI application, app.application
+    :param workers: Threads running the WSGI application
+    :param queue_size: Requests allowed to wait for a thread before answering 503
+    """
+    def __init__(self, wsgi_app, workers=threaded_server.WORKERS, queue_size=threaded_server.QUEUE_SIZE):
+        self.wsgi_app = wsgi_app
+        self.workers = workers
+        self.limit = workers + queue_size
+        self.pending = 0  # Requests running in or waiting for the executor. Only touched on the event loop.
+        self.executor = None
+
+    async def run(self, function, *args):
+        """Run function on the executor."""
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix='asgi-worker')
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        body = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            size += len(body[-1])
+            if size > MAX_BODY:
+                await self.respond(send, 413, 'Request too large\n')
+                return
+            if not message.get('more_body'):
+                break
+        e = wsgi_environ(scope, b''.join(body))
+
+        if e['PATH_INFO'] in ('/wait_games', '/wait_game'):
+            await self.long_poll(e, send)
+        elif self.pending >= self.limit:
+            await self.respond(send, 503, 'Server busy\n', headers=[(b'retry-after', b'1')])
+        else:
+            self.pending += 1
+            try:
+                await self.call_wsgi(e, send)
+            finally:
+                self.pending -= 1
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.executor is not None:
+                    self.executor.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    async def respond(send, status, text, content_type=b'text/plain; charset=utf-8', headers=()):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', content_type)] + list(headers),
+        })
+        await send({'type': 'http.response.body', 'body': text.encode()})
+
+    def start_wsgi(self, e):
+        """Call the WSGI application and fetch the first chunk, which is when start_response has been called."""
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+
+        body = self.wsgi_app(e, start_response)
+        chunks = iter(body)
+        try:
+            first = next(chunks, _done)
+        except BaseException:
+            if hasattr(body, 'close'):
+                body.close()
+            raise
+        return response, body, chunks, first
+
+    async def call_wsgi(self, e, send):
+        response, body, chunks, chunk = await self.run(self.start_wsgi, e)
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': int(response['status'].split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for name, value in response['headers']],
+            })
+            while chunk is not _done:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await self.run(next, chunks, _done)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(body, 'close'):
+                await self.run(body.close)  # Hands the DB connection back and records the request metrics
+
+    async def long_poll(self, e, send):
+        """Answer /wait_games and /wait_game like app.handle_request() does, without holding a thread."""
+        started = time.perf_counter()
+        params = urllib.parse.parse_qs(e['QUERY_STRING'])
+        token = app.request_session_token(e)
+        username = await self.run(session_user, token) if token else None
+        status = 200
+        if username is None:
+            text = 'No session'
+        else:
+            try:
+                if e['PATH_INFO'] == '/wait_games':
+                    topics, current = (LOBBY, user_topic(username)), (app.root_page_version, username)
+                else:
+                    game_id = int(params['id'][0])
+                    topics, current = (game_topic(game_id),), (app.game_page_version, game_id)
+                seen, version = app.seen_version(params)
+            except (KeyError, ValueError):
+                status, text = 400, 'Expected id and v' if e['PATH_INFO'] == '/wait_game' else 'Expected v'
+            else:
+                async def changed():  # Changes made by other processes, see app.wait_version()
+                    return await self.run(page_version, *current) != seen
+
+                await hub.wait_async(topics, version, changed=changed)
+                text = await self.run(page_version, *current)
+        await self.respond(send, status, text, b'text/html; charset=utf-8')
+        metrics.requests_total.inc(e['PATH_INFO'], str(status))
+        metrics.request_seconds.observe(time.perf_counter() - started, e['PATH_INFO'])
+
+
+application = ASGIApp(app.application)
+
+
+class HTTPConnection:
+    """The ASGI send() and receive() of one request on a keep-alive HTTP/1.1 connection.
+
+    Responses to HEAD and with status 1xx, 204 or 304 have no body, whatever the application sends.
+    """
+    def __init__(self, reader, writer, body, keep_alive, method='GET'):
+        self.reader = reader
+        self.writer = writer
+        self.body = body
+        self.keep_alive = keep_alive
+        self.method = method
+        self.started = False
+        self.chunked = False
+        self.bodyless = False
+        self.finished = asyncio.Event()
+
+    async def receive(self):
+        if self.body is not None:
+            body, self.body = self.body, None
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        await self.finished.wait()  # The connection may carry the next request, so do not read from it
+        return {'type': 'http.disconnect'}
+
+    async def send(self, message):
+        if message['type'] == 'http.response.start':
+            status = message['status']
+            headers = message.get('headers', [])
+            names = {name.lower() for name, value in headers}
+            self.bodyless = self.method == 'HEAD' or status < 200 or status in (204, 304)
+            if b'content-length' not in names and not self.bodyless:
+                if self.keep_alive:
+                    self.chunked = True
+                    headers = list(headers) + [(b'transfer-encoding', b'chunked')]
+            if not self.keep_alive:
+                headers = list(headers) + [(b'connection', b'close')]
+            lines = ['HTTP/1.1 {} {}'.format(status, http.HTTPStatus(status).phrase).encode()]
+            lines.extend(name + b': ' + value for name, value in headers)
+            self.writer.write(b'\r\n'.join(lines) + b'\r\n\r\n')
+            self.started = True
+        elif message['type'] == 'http.response.body':
+            body = b'' if self.bodyless else message.get('body', b'')
+            if self.chunked and body:
+                self.writer.write(b'%x\r\n%s\r\n' % (len(body), body))
+            elif body:
+                self.writer.write(body)
+            if not message.get('more_body'):
+                if self.chunked:
+                    self.writer.write(b'0\r\n\r\n')
+                self.finished.set()
+            await self.writer.drain()
+
+
+async def serve_connection(asgi_app, reader, writer):
+    """Serve HTTP/1.1 requests on one connection until the client closes it or asks for it to be closed."""
+    server = writer.get_extra_info('sockname')
+    client = writer.get_extra_info('peername')
+    try:
+        while True:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), KEEP_ALIVE_TIMEOUT)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+                return
+            lines = head.decode('latin-1').split('\r\n')
+            try:
+                method, target, version = lines[0].split(' ')
+                headers = []
+                for line in lines[1:]:
+                    if line:
+                        name, value = line.split(':', 1)
+                        headers.append((name.strip().lower().encode('latin-1'), value.strip().encode('latin-1')))
+                fields = dict(headers)
+                length = int(fields.get(b'content-length', b'0'))
+            except ValueError:
+                writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                return
+            if fields.get(b'transfer-encoding', b'identity').lower() != b'identity':  # Chunked bodies are not read
+                writer.write(b'HTTP/1.1 411 Length Required\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                return
+            if length > MAX_BODY:
+                writer.write(b'HTTP/1.1 413 Payload Too Large\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                return
+            body = await reader.readexactly(length) if length else b''
+
+            connection = fields.get(b'connection', b'').lower()
+            keep_alive = version == 'HTTP/1.1' and connection != b'close' or connection == b'keep-alive'
+            path, _, query = target.partition('?')
+            scope = {
+                'type': 'http',
+                'asgi': {'version': '3.0', 'spec_version': '2.3'},
+                'http_version': version[len('HTTP/'):],
+                'method': method,
+                'scheme': 'http',
+                'path': urllib.parse.unquote(path),
+                'raw_path': path.encode('latin-1'),
+                'query_string': query.encode('latin-1'),
+                'root_path': '',
+                'headers': headers,
+                'client': client[:2] if client else None,
+                'server': server[:2] if server else None,
+            }
+            exchange = HTTPConnection(reader, writer, body, keep_alive, method)
+            try:
+                await asgi_app(scope, exchange.receive, exchange.send)
+            except Exception:
+                if exchange.started:
+                    return  # Part of the response is out already, the client sees the connection close
+                await exchange.send({'type': 'http.response.start', 'status': 500, 'headers': [
+                    (b'content-type', b'text/plain; charset=utf-8')]})
+                await exchange.send({'type': 'http.response.body', 'body': b'Internal Server Error\n'})
+                raise
+            if not exchange.finished.is_set() or not keep_alive:
+                return
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(asgi_app, host, port):
+    """Serve an ASGI application over HTTP/1.1 until cancelled."""
+    server = await asyncio.start_server(
+        lambda reader, writer: serve_connection(asgi_app, reader, writer), host, port, limit=MAX_HEADER
+    )
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = app.argument_parser('Serve the game web app on asyncio.')
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    try:
+        app.configure(args)
+    except ValueError as error:
+        parser.error(str(error))
+    hub.max_waiters = 0  # Long-polls wait on the event loop, never on a worker thread
+    application = ASGIApp(app.application, args.workers, args.queue)
+    try:
+        asyncio.run(serve(application, '', args.port))
+    except KeyboardInterrupt:
+        pass
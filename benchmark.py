@@ -0,0 +1,251 @@
+"""In-process load test for the web app.
+
+Simulated users call app.application directly with hand-built WSGI environs, so no sockets or HTTP parsing are
+involved. Every user registers, half of them create games and the other half join games from the lobby, and then
+they play random moves until their game is over, polling /updated_games between moves. The run uses a temporary
+game.db, or a fresh in-memory store, and reports requests per second and, per route, latency percentiles and SQL
+statements per request. Given several backends, the same workload runs against each of them in turn. The
+group-commit backend is sqlite with changes made by the group_commit writer, whose statements are not counted.
+
+    python benchmark.py --users 50 --goal 5 --polls-per-move 5 --threads 4 --storage sqlite group-commit memory
+"""
+
+import argparse
+import collections
+import contextlib
+import http.cookies
+import io
+import os
+import random
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import app
+import db_memory
+import db_sharded
+import db_sqlite
+import db_sqlite_initialize
+import group_commit
+import storage
+
+MAX_REQUESTS_PER_USER = 100000
+
+counter = threading.local()
+
+
+class CountingPool(db_sqlite.ConnectionPool):
+    """Connection pool that counts the SQL statements run by the current thread."""
+    def _connect(self):
+        connection = super()._connect()
+        connection.set_trace_callback(self._count)
+        return connection
+
+    @staticmethod
+    def _count(sql):
+        counter.statements = getattr(counter, 'statements', 0) + 1
+
+
+class Stats:
+    """Latencies and statement counts per route."""
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.statements = collections.defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, route, seconds, statements):
+        with self._lock:
+            self.latencies[route].append(seconds)
+            self.statements[route] += statements
+
+    def merge(self, other):
+        for route, latencies in other.latencies.items():
+            self.latencies[route].extend(latencies)
+            self.statements[route] += other.statements[route]
+
+    def requests(self):
+        return sum(len(latencies) for latencies in self.latencies.values())
+
+
+def percentile(values, fraction):
+    """Return the value below which the given fraction of the sorted values fall."""
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def request(path, params, cookie, stats):
+    """Call the app once and return (status, headers, body)."""
+    e = {
+        'REQUEST_METHOD': 'GET',
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(),
+        'HTTP_HOST': 'localhost:8000',
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': urllib.parse.urlencode(params),
+    }
+    if cookie:
+        e['HTTP_COOKIE'] = cookie
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = status
+        response['headers'] = headers
+
+    counter.statements = 0
+    started = time.perf_counter()
+    body = app.application(e, start_response)
+    try:
+        data = b''.join(body)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    stats.record(path, time.perf_counter() - started, counter.statements)
+    return response['status'], response['headers'], data.decode()
+
+
+def simulated_user(name, creates_game, goal, polls_per_move, rng):
+    """Generator of (path, params) requests for one user. Receives the body of every response."""
+    yield '/login_register', {'do': 'Register', 'username': name, 'password': 'secret'}
+    if creates_game:
+        yield '/newgame', {'goal': goal}
+
+    game_id = None
+    while game_id is None:
+        body = yield '/', {}
+        running = re.search(r'/game\?id=(\d+)">(My turn|Awaiting Turn)', body)
+        if running:
+            game_id = running.group(1)
+        elif not creates_game:
+            lobby = re.findall(r'/join\?id=(\d+)', body)
+            if lobby:
+                yield '/join', {'id': rng.choice(lobby)}
+
+    while True:
+        for _ in range(polls_per_move):
+            yield '/updated_games', {}
+        body = yield '/game', {'id': game_id}
+        if 'Game over' in body:
+            break
+        if 'Your move' in body:
+            yield '/game', {'id': game_id, 'move': rng.choice('rps')}
+    yield '/', {}
+
+
+def run_users(names, goal, polls_per_move, seed, stats):
+    """Run simulated users round-robin, one request each in turn, until all are done."""
+    rng = random.Random(seed)
+    users = {}
+    for index, name in names:
+        user = simulated_user(name, index % 2 == 0, goal, polls_per_move, rng)
+        users[name] = [user, next(user), None, 0]  # Generator, next request, cookie, requests made
+
+    while users:
+        for name in list(users):
+            user, (path, params), cookie, requests = users[name]
+            status, headers, body = request(path, params, cookie, stats)
+            for header, value in headers:
+                if header == 'Set-Cookie':
+                    cookie = http.cookies.SimpleCookie(value)['session'].OutputString(attrs=[])
+            try:
+                if requests >= MAX_REQUESTS_PER_USER:
+                    raise RuntimeError('{} did not finish its game'.format(name))
+                users[name] = [user, user.send(body), cookie, requests + 1]
+            except StopIteration:
+                del users[name]
+
+
+def simulate(num_users, goal, polls_per_move, threads, seed):
+    """Run the simulated users against the configured storage and return (list of Stats, elapsed seconds)."""
+    names = [(index, 'user{}'.format(index)) for index in range(num_users)]
+    groups = [names[start::threads] for start in range(threads)]
+    results = [Stats() for _ in groups]
+    workers = [
+        threading.Thread(target=run_users, args=(group, goal, polls_per_move, seed + number, results[number]))
+        for number, group in enumerate(groups)
+    ]
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):  # Storage prints a message for every join of a full game
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    elapsed = time.perf_counter() - started
+    with storage.open_db() as db:
+        db.clear_tables(True)  # Also drops what the app cached about the games, the next run reuses their ids
+    return results, elapsed
+
+
+def benchmark(num_users, goal, polls_per_move, threads, seed, backend='sqlite', shards=1):
+    """Run the simulation against fresh, empty storage and return (Stats, elapsed seconds).
+
+    :param backend: 'sqlite' for a temporary database file, 'group-commit' for the same with group commit, or 'memory'
+        for a new MemoryStore
+    :param shards: Number of shard files for 'sqlite', 1 for no sharding
+    """
+    if num_users % 2:
+        raise ValueError('Number of users must be even, half create games and half join them')
+    if backend == 'memory':
+        store = db_memory.MemoryStore()
+        storage.configure(lambda: db_memory.MemoryDB(store))
+        results, elapsed = simulate(num_users, goal, polls_per_move, threads, seed)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            database = os.path.join(directory, 'game.db')
+            connections = [sqlite3.connect(path) for path in
+                           [database] + (db_sharded.shard_paths(database, shards) if shards > 1 else [])]
+            for connection in reversed(connections):  # The shards first, game.db counts the stats of their games
+                db_sqlite_initialize.migrate(connection)
+            if shards > 1:
+                db_sqlite_initialize.shard_games(connections[0], connections[1:])
+            for connection in connections:
+                connection.close()
+            if shards > 1:
+                db_sharded.configure(database, shards, size=threads, pool_class=CountingPool)
+                storage.configure(db_sharded.ShardedDB)
+            elif backend == 'group-commit':
+                group_commit.start(db_sqlite.configure_pool(database, size=threads + 1, pool_class=CountingPool))
+                storage.configure(group_commit.GroupCommitDB)
+            else:
+                db_sqlite.configure_pool(database, size=threads, pool_class=CountingPool)
+                storage.configure(db_sqlite.DB)
+            results, elapsed = simulate(num_users, goal, polls_per_move, threads, seed)
+            group_commit.stop()
+            db_sharded.configure(count=0)  # Close the connections to the temporary databases
+
+    stats = Stats()
+    for result in results:
+        stats.merge(result)
+    return stats, elapsed
+
+
+def report(stats, elapsed):
+    print('{} requests in {:.2f} s, {:.0f} requests/s'.format(stats.requests(), elapsed, stats.requests() / elapsed))
+    print()
+    print('{:<20} {:>8} {:>10} {:>10} {:>10}'.format('route', 'requests', 'p50 ms', 'p99 ms', 'SQL/req'))
+    for route in sorted(stats.latencies):
+        latencies = sorted(stats.latencies[route])
+        print('{:<20} {:>8} {:>10.3f} {:>10.3f} {:>10.1f}'.format(
+            route, len(latencies), percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+            stats.statements[route] / len(latencies)
+        ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the game app in-process.')
+    parser.add_argument('--users', type=int, default=20, help='simulated users, an even number')
+    parser.add_argument('--goal', type=int, default=5, help='score that ends a game')
+    parser.add_argument('--polls-per-move', type=int, default=5, help='/updated_games polls between game views')
+    parser.add_argument('--threads', type=int, default=1, help='threads running users concurrently')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--storage', nargs='+', choices=['sqlite', 'group-commit', 'memory'], default=['sqlite'],
+                        help='backends to run the workload against')
+    parser.add_argument('--shards', type=int, default=1, help='shard files of the sqlite backend')
+    args = parser.parse_args()
+
+    for number, backend in enumerate(args.storage):
+        if len(args.storage) > 1:
+            print('{}{}:'.format('\n' if number else '', backend))
+        report(*benchmark(args.users, args.goal, args.polls_per_move, args.threads, args.seed, backend, args.shards))
@@ -0,0 +1,470 @@
+"""Storage in dicts of the running process.
+
+MemoryDB keeps users, sessions, games, players, moves and the archive in a MemoryStore, indexed by dicts, and never
+touches the disk. Everything is lost when the process ends, which is what benchmarks, tests and short-lived
+tournament servers want. All MemoryDB objects share one store unless given their own.
+
+A single lock serializes all changes. A game change holds it from reading the game again to saving it, so changes
+cannot conflict, and undoes what it did if it raises.
+"""
+
+import bisect
+import contextlib
+import itertools
+import secrets
+import threading
+
+from lobby import Lobby, LobbyGame
+from notify import hub, game_topic, user_topic, LOBBY, RESET
+from storage import ConflictError, Storage, DUMP_COLUMNS, utc_timestamp
+
+SESSION_DAYS = 30
+
+
+class MemoryStore:
+    """All data of the in-memory backend."""
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.users = {}  # name -> [rowid, password]
+        self.sessions = {}  # token -> (user name, expires)
+        self.games = {}  # game id -> [players, goal, state, ts, rounds, version]
+        self.players = {}  # game id -> [rowid, user name, score, playing] lists in joining order
+        self.moves = {}  # game id -> {(round, player_index): (rowid, move)}
+        self.user_games = {}  # user name -> ids of the games the user joined
+        self.user_versions = {}  # user name -> version, see Storage.updated_games()
+        self.lobby_version = 0
+        self.lobby = Lobby()
+        self.lobby.load([])
+        self.archive = {}  # game id -> (game row, player rows, move rows)
+        self.user_stats = {}  # user name -> (games_played, wins, rounds_won)
+        self.ranking = []  # Sorted rank_key() of every user in user_stats
+        self.last_rowids = dict.fromkeys(DUMP_COLUMNS, 0)  # Rowids, and so game ids, are never reused
+
+    def next_rowid(self, table):
+        self.last_rowids[table] += 1
+        return self.last_rowids[table]
+
+
+_store = None
+
+
+def get_store():
+    """Return the shared store, creating it on first use."""
+    global _store
+    if _store is None:
+        _store = MemoryStore()
+    return _store
+
+
+def rank_key(username, stats):
+    """Sort key of a user on the leaderboard: most wins, then fewest games played, then name."""
+    games_played, wins, rounds_won = stats
+    return -wins, games_played, username
+
+
+def _game_id(game_id):
+    """Return game_id as int, None if it is not a number."""
+    try:
+        return int(game_id)
+    except (TypeError, ValueError):
+        return None
+
+
+class MemoryDB(Storage):
+    """Storage in a MemoryStore, the shared one if store is None."""
+    def __init__(self, store=None):
+        self.store = store or get_store()
+        self._undo = None  # Functions undoing the changes of the open change() or batch(), None outside of them
+        self._pending_topics = None  # Topics to publish when the open batch() ends
+
+    def _touch(self, game_id, *usernames, lobby=False):
+        """Count a change to a game in the versions of its players, of usernames and, if lobby, of the lobby."""
+        store = self.store
+        for name in {player[1] for player in store.players.get(game_id, [])} | set(usernames):
+            store.user_versions[name] = store.user_versions.get(name, 0) + 1
+        if lobby:
+            store.lobby_version += 1
+
+    def _update_lobby(self, game_id):
+        """Apply the current state of a game to the lobby index."""
+        store = self.store
+        row = store.games.get(game_id)
+        if row and row[2] == 0:
+            names = [player[1] for player in store.players[game_id]]
+            store.lobby.put(LobbyGame(game_id, row[0], row[1], row[3], row[5], names))
+        else:
+            store.lobby.remove(game_id)
+
+    def _delete_game(self, game_id):
+        store = self.store
+        row = store.games.pop(game_id)
+        players = store.players.pop(game_id)
+        store.moves.pop(game_id)
+        for player in players:
+            store.user_games[player[1]].discard(game_id)
+        store.lobby.remove(game_id)
+        for player in players:
+            store.user_versions[player[1]] = store.user_versions.get(player[1], 0) + 1
+        if row[2] == 0:
+            store.lobby_version += 1
+        return [player[1] for player in players]
+
+    # ----- Users and sessions -----------------------------------------------
+
+    def user_pass_valid(self, username, password):
+        with self.store.lock:
+            user = self.store.users.get(username)
+        return user is not None and user[1] == password
+
+    def add_username(self, username, password):
+        store = self.store
+        with store.lock:
+            if username in store.users:
+                return False
+            store.users[username] = [store.next_rowid('user'), password]
+            store.user_versions[username] = 0
+            return True
+
+    def new_session(self, username):
+        token = secrets.token_urlsafe(32)
+        with self.store.lock:
+            self.store.sessions[token] = (username, utc_timestamp(SESSION_DAYS))
+        return token
+
+    def session_user(self, token):
+        with self.store.lock:
+            session = self.store.sessions.get(token)
+        if session is None or session[1] <= utc_timestamp():
+            return None
+        return session[0]
+
+    def delete_session(self, token):
+        with self.store.lock:
+            self.store.sessions.pop(token, None)
+
+    def delete_expired_sessions(self, limit):
+        now = utc_timestamp()
+        with self.store.lock:
+            sessions = self.store.sessions
+            expired = list(itertools.islice((token for token, (name, expires) in sessions.items() if expires <= now),
+                                            limit))
+            for token in expired:
+                del sessions[token]
+        return len(expired)
+
+    # ----- Games ------------------------------------------------------------
+
+    def get_game_by_id(self, game_id):
+        with self.store.lock:
+            row = self.store.games.get(_game_id(game_id))
+            return tuple(row) if row else None
+
+    def get_games_by_ids(self, game_ids):
+        games = self.store.games
+        with self.store.lock:
+            game_ids = {_game_id(game_id) for game_id in game_ids} & games.keys()
+            return [(game_id, *games[game_id]) for game_id in sorted(game_ids)]
+
+    def get_games_by_user(self, username):
+        store = self.store
+        with store.lock:
+            return [
+                (game_id, *store.games[game_id]) for game_id in sorted(store.user_games.get(username, ()))
+                if any(player[1] == username and player[3] for player in store.players[game_id])
+            ]
+
+    def get_registering_games_by_user(self, username):
+        return [game.row() for game in self.store.lobby.games_for(username)]
+
+    def get_registering_players(self, game_ids):
+        return {game_id: [(name, 0, 1) for name in self.store.lobby.players(game_id)] for game_id in game_ids}
+
+    def new_game(self, players, goal, username):
+        store = self.store
+        with store.lock:
+            game_id = store.next_rowid('game')
+            store.games[game_id] = [int(players), int(goal), 0, utc_timestamp(), 0, 0]  # Like INTEGER columns
+            store.players[game_id] = [[store.next_rowid('player'), username, 0, 1]]
+            store.moves[game_id] = {}
+            store.user_games.setdefault(username, set()).add(game_id)
+            self._touch(game_id, lobby=True)
+            self._update_lobby(game_id)
+        hub.publish(LOBBY, user_topic(username))
+
+    def join_game(self, game_id, username):
+        store = self.store
+        game_id = _game_id(game_id)
+        with store.lock:
+            row = store.games.get(game_id)
+            if not row:
+                print("Unknown game")
+                return
+            players = store.players[game_id]
+            if row[2] > 0 or any(player[1] == username for player in players):
+                print("Game full")
+                return
+            players.append([store.next_rowid('player'), username, 0, 1])
+            store.user_games.setdefault(username, set()).add(game_id)
+            row[2] = 1 if len(players) == row[0] else 0
+            row[3] = utc_timestamp()
+            row[5] += 1
+            self._touch(game_id, lobby=True)
+            self._update_lobby(game_id)
+            names = [player[1] for player in players]
+        hub.publish(LOBBY, game_topic(game_id), *[user_topic(name) for name in names])
+
+    def quit_game(self, game_id, username):
+        store = self.store
+        game_id = _game_id(game_id)
+        with store.lock:
+            players = store.players.get(game_id, [])
+            player = next((player for player in players if player[1] == username), None)
+            if player is None:
+                print('Player not found in game')
+                return
+            row = store.games[game_id]
+            names = [player[1] for player in players]
+            if row[2] == 0:  # Still registering players
+                players.remove(player)
+                store.user_games[username].discard(game_id)
+                if players:
+                    row[3] = utc_timestamp()
+                    row[5] += 1
+                    self._touch(game_id, username, lobby=True)
+                else:
+                    self._delete_game(game_id)
+                    store.user_versions[username] += 1
+                self._update_lobby(game_id)
+            else:
+                player[3] = 0
+                row[3] = utc_timestamp()
+                row[5] += 1
+                self._touch(game_id)
+        hub.publish(LOBBY, game_topic(game_id), *[user_topic(name) for name in names])
+
+    def updated_games(self, username):
+        with self.store.lock:
+            return self.store.user_versions.get(username), self.store.lobby_version
+
+    # ----- Game state, used by Game -----------------------------------------
+
+    def get_players(self, game_ids):
+        store = self.store
+        with store.lock:
+            return {
+                game_id: [(name, score, playing)
+                          for rowid, name, score, playing in store.players.get(_game_id(game_id), [])]
+                for game_id in game_ids
+            }
+
+    def get_last_turns(self, game_ids):
+        store = self.store
+        with store.lock:
+            turns = {}
+            for game_id in game_ids:
+                last = store.games[game_id][4] - 1 if game_id in store.games else -1
+                turns[game_id] = sorted(
+                    (index, move) for (round_index, index), (rowid, move) in store.moves.get(game_id, {}).items()
+                    if round_index == last
+                )
+            return turns
+
+    def get_moves(self, game_id, first_round, rounds):
+        with self.store.lock:
+            return sorted(
+                (round_index, index, move)
+                for (round_index, index), (rowid, move) in self.store.moves.get(_game_id(game_id), {}).items()
+                if first_round <= round_index < rounds
+            )
+
+    def _rollback(self):
+        for undo in reversed(self._undo):
+            undo()
+
+    def change(self, game_id, change, *args, before_retry=None):
+        with self.store.lock:
+            if self._undo is not None:  # Inside batch(), which read the games under the lock already
+                return change(*args)
+            if before_retry:  # Read the game again under the lock, so nobody can have changed it meanwhile
+                before_retry()
+            self._undo = []
+            try:
+                return change(*args)
+            except BaseException:
+                self._rollback()
+                raise
+            finally:
+                self._undo = None
+
+    @contextlib.contextmanager
+    def batch(self, game_ids=None):
+        with self.store.lock:
+            self._undo = []
+            self._pending_topics = topics = []
+            try:
+                yield
+            except BaseException:
+                self._rollback()
+                raise
+            finally:
+                self._undo = self._pending_topics = None
+        if topics:
+            hub.publish(*dict.fromkeys(topics))
+
+    def _changed(self, undo):
+        if self._undo is not None:
+            self._undo.append(undo)
+
+    def add_move(self, game_id, round_index, index, move):
+        game_id = _game_id(game_id)
+        with self.store.lock:
+            moves = self.store.moves[game_id]
+            if (round_index, index) in moves:  # Someone else saved a move for this player and round first
+                raise ConflictError(game_id)
+            moves[round_index, index] = (self.store.next_rowid('move'), move)
+            self._changed(lambda: moves.pop((round_index, index), None))
+
+    def save_score(self, game_id, username, score):
+        with self.store.lock:
+            for player in self.store.players[_game_id(game_id)]:
+                if player[1] == username:
+                    self._changed(lambda player=player, old=player[2]: player.__setitem__(2, old))
+                    player[2] = score
+
+    def end_game(self, game_id):
+        with self.store.lock:
+            row = self.store.games[_game_id(game_id)]
+            self._changed(lambda old=row[2]: row.__setitem__(2, old))
+            row[2] = 2
+
+    def _set_stats(self, username, stats):
+        """Replace the stats of a user, keeping the ranking sorted. None removes them."""
+        store = self.store
+        old = store.user_stats.pop(username, None)
+        if old is not None:
+            del store.ranking[bisect.bisect_left(store.ranking, rank_key(username, old))]
+        if stats is not None:
+            store.user_stats[username] = stats
+            bisect.insort(store.ranking, rank_key(username, stats))
+        return old
+
+    def _add_stats(self, username, games_played, wins, rounds_won):
+        old = self.store.user_stats.get(username, (0, 0, 0))
+        old = self._set_stats(username, (old[0] + games_played, old[1] + wins, old[2] + rounds_won))
+        self._changed(lambda: self._set_stats(username, old))
+
+    def add_round_wins(self, game_id, usernames):
+        with self.store.lock:
+            for name in usernames:
+                self._add_stats(name, 0, 0, 1)
+
+    def add_game_results(self, game_id, usernames, winners):
+        with self.store.lock:
+            for name in usernames:
+                self._add_stats(name, 1, int(name in winners), 0)
+
+    def save_game_state(self, game_id, rounds, ts, version, usernames):
+        game_id = _game_id(game_id)
+        with self.store.lock:
+            row = self.store.games.get(game_id)
+            if row is None or row[5] != version:
+                raise ConflictError(game_id)
+            old = list(row)
+            self._changed(lambda: row.__setitem__(slice(None), old))
+            row[3:6] = [ts, rounds, version + 1]
+            self._touch(game_id)
+        topics = [game_topic(game_id)] + [user_topic(name) for name in usernames]
+        if self._pending_topics is None:
+            hub.publish(*topics)
+        else:
+            self._pending_topics.extend(topics)
+
+    # ----- Archive ----------------------------------------------------------
+
+    def finished_games(self, before, limit):
+        return self._games_before(2, before, limit)
+
+    def abandoned_games(self, before, limit):
+        return self._games_before(0, before, limit)
+
+    def _games_before(self, state, before, limit):
+        with self.store.lock:
+            games = [(row[3], game_id, row[5]) for game_id, row in self.store.games.items()
+                     if row[2] == state and row[3] < before]
+        return [(game_id, version) for ts, game_id, version in sorted(games)[:limit]]
+
+    def export_games(self, game_ids):
+        game_ids = list(game_ids)
+        with self.store.lock:
+            rows = {game_id: self.get_game_by_id(game_id) for game_id in game_ids if game_id in self.store.games}
+            players = self.get_players(rows)
+            return {
+                game_id: (row, players[game_id], self.get_moves(game_id, 0, row[4])) for game_id, row in rows.items()
+            }
+
+    def delete_games(self, games):
+        store = self.store
+        deleted, names = [], set()
+        with store.lock:
+            for game_id, version in games:
+                row = store.games.get(game_id)
+                if row and row[5] == version:
+                    names.update(self._delete_game(game_id))
+                    deleted.append(game_id)
+        if deleted:
+            hub.publish(LOBBY, *[game_topic(game_id) for game_id in deleted] + [user_topic(name) for name in names])
+        return deleted
+
+    def archive_games(self, games):
+        with self.store.lock:
+            self.store.archive.update(games)
+
+    def get_archived_game(self, game_id):
+        with self.store.lock:
+            return self.store.archive.get(_game_id(game_id))
+
+    # ----- Leaderboard ------------------------------------------------------
+
+    def leaderboard(self, after=None, limit=None):
+        """Read a page of the ranking, which every stats change keeps sorted."""
+        store = self.store
+        with store.lock:
+            start = 0
+            if after is not None:
+                after_key = rank_key(after, store.user_stats.get(after, (0, 0, 0)))
+                start = bisect.bisect_right(store.ranking, after_key)
+            keys = store.ranking[start:None if limit is None else start + limit]
+            return [(name, *store.user_stats[name]) for wins, games_played, name in keys]
+
+    # ----- Administration ---------------------------------------------------
+
+    def dump_table(self, table, after=0, limit=None):
+        store = self.store
+        with store.lock:
+            if table == 'user':
+                rows = [(rowid, name, password) for name, (rowid, password) in store.users.items()]
+            elif table == 'game':
+                rows = [(game_id, *row[:5]) for game_id, row in store.games.items()]
+            elif table == 'player':
+                rows = [(rowid, game_id, name, score, playing)
+                        for game_id, players in store.players.items() for rowid, name, score, playing in players]
+            else:
+                rows = [(rowid, game_id, round_index, index, move)
+                        for game_id, moves in store.moves.items()
+                        for (round_index, index), (rowid, move) in moves.items()]
+        rows = sorted(row for row in rows if row[0] > after)
+        return rows if limit is None else rows[:limit]
+
+    def clear_tables(self, clear_all):
+        store = self.store
+        with store.lock:
+            for game_id in list(store.games):
+                self._delete_game(game_id)
+            store.user_stats.clear()
+            store.ranking.clear()
+            if clear_all:
+                store.users.clear()
+                store.sessions.clear()
+                store.user_games.clear()
+                store.user_versions.clear()
+        hub.publish(LOBBY, RESET)
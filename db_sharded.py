@@ -0,0 +1,267 @@
+"""Games spread over several SQLite files.
+
+SQLite lets only one connection write to a database file at a time, so with a single game.db every saved move waits
+for every other one. In sharded mode the users and sessions stay in game.db, while games with their players and moves
+are partitioned by id over count shard files next to it (game-shard0.db, game-shard1.db, ...): a game lives in shard
+game_id % count, each with a pool of its own, so moves in different shards are saved in parallel. Each shard only
+hands out ids that belong to it, above the largest id used before. db_sqlite_initialize.py moves the games already in
+game.db into their shards and records count in all files, configure() refuses to start with a different one.
+
+ShardedDB routes what concerns one game to its shard and fans per-user listings out to all shards, merging the
+results. Game objects use the DB of their shard directly. A batch() holds the write locks of the shards of the games
+it is given and commits them one after the other, so it is atomic per shard only. The leaderboard stats of all games
+are kept in game.db, each shard adds to them right after committing a game change.
+
+    python db_sqlite_initialize.py --shards 4
+    python app.py --shards 4
+"""
+
+import contextlib
+import heapq
+import itertools
+import os
+
+from db_sqlite import DB, ConnectionPool, DATABASE, POOL_SIZE, configure_pool
+from storage import Storage
+
+_shard_pools = []
+_next_shard = itertools.count()  # Shards take new games in turn
+
+
+def shard_paths(database=DATABASE, count=1):
+    """Return the paths of the shard files of a database."""
+    root, extension = os.path.splitext(database)
+    return ['{}-shard{}{}'.format(root, index, extension) for index in range(count)]
+
+
+def configure(database=DATABASE, count=2, size=POOL_SIZE, timeout=10.0, pool_class=ConnectionPool):
+    """Replace the shared pools with one for users and sessions in database and one for each of count shards.
+
+    :param size: Maximum number of open connections per pool
+    :return: The shard pools
+    """
+    global _shard_pools
+    configure_pool(database, size, timeout, pool_class)
+    old_pools, _shard_pools = _shard_pools, [
+        pool_class(path, size, timeout, shard=(index, count)) for index, path in enumerate(shard_paths(database, count))
+    ]
+    for pool in old_pools:
+        pool.close()
+    if count > 1:
+        check_layout(count)
+    return _shard_pools
+
+
+def check_layout(count=1):
+    """Make sure the games of the shared pools were split into count shards by db_sqlite_initialize.py.
+
+    :raise RuntimeError: If game.db or a shard was split differently, so games would be looked up in the wrong file or
+        get an id that was used before
+    """
+    with DB() as users:
+        shards, last_game_id = users.sharding()
+    if shards != count:
+        raise RuntimeError('{} is split into {} shards, not {}: run db_sqlite_initialize.py --shards {}'.format(
+            users.pool.database, shards, count, count))
+    for pool in _shard_pools:
+        with DB(pool) as db:
+            shards, shard_last_game_id = db.sharding()
+        if shards != count or shard_last_game_id < last_game_id:
+            raise RuntimeError('{} does not belong to {} shards of {}: run db_sqlite_initialize.py --shards {}'.format(
+                pool.database, count, users.pool.database, count))
+
+
+def _numbered(rows, index, count):
+    """Replace the rowids of the rows of shard index by rowid * count + index, unique across all shards."""
+    for rowid, *columns in rows:
+        yield (rowid * count + index, *columns)
+
+
+class ShardedDB(Storage):
+    """Storage in a users database and several shard databases, see configure().
+
+    :param pools: (users pool, shard pools), the shared pools if None
+    """
+    def __init__(self, pools=None):
+        users_pool, shard_pools = pools or (None, _shard_pools)
+        self.users = DB(users_pool)
+        self.shards = [DB(pool, stats=self.users) for pool in shard_pools]  # All user stats in the users database
+
+    def close(self):
+        for db in [self.users] + self.shards:
+            db.close()
+
+    def shard(self, game_id):
+        """Return the DB of the shard holding a game."""
+        return self.shards[int(game_id) % len(self.shards)]
+
+    def _by_shard(self, items, game_id=lambda item: item):
+        """Group game ids, or items with a game id, by the DB of their shard."""
+        groups = {}
+        for item in items:
+            groups.setdefault(self.shard(game_id(item)), []).append(item)
+        return groups.items()
+
+    # ----- Users and sessions -----------------------------------------------
+
+    def user_pass_valid(self, username, password):
+        return self.users.user_pass_valid(username, password)
+
+    def add_username(self, username, password):
+        return self.users.add_username(username, password)
+
+    def new_session(self, username):
+        return self.users.new_session(username)
+
+    def session_user(self, token):
+        return self.users.session_user(token)
+
+    def delete_session(self, token):
+        self.users.delete_session(token)
+
+    def delete_expired_sessions(self, limit):
+        return self.users.delete_expired_sessions(limit)
+
+    # ----- Games ------------------------------------------------------------
+
+    def get_game_by_id(self, game_id):
+        return self.shard(game_id).get_game_by_id(game_id)
+
+    def get_games_by_ids(self, game_ids):
+        return sorted(row for db, ids in self._by_shard(game_ids) for row in db.get_games_by_ids(ids))
+
+    def get_games_by_user(self, username):
+        return sorted(row for db in self.shards for row in db.get_games_by_user(username))
+
+    def get_registering_games_by_user(self, username):
+        return sorted((row for db in self.shards for row in db.get_registering_games_by_user(username)),
+                      key=lambda row: -row[0])
+
+    def get_registering_players(self, game_ids):
+        players = {}
+        for db, ids in self._by_shard(game_ids):
+            players.update(db.get_registering_players(ids))
+        return players
+
+    def new_game(self, players, goal, username):
+        self.shards[next(_next_shard) % len(self.shards)].new_game(players, goal, username)
+
+    def join_game(self, game_id, username):
+        self.shard(game_id).join_game(game_id, username)
+
+    def quit_game(self, game_id, username):
+        self.shard(game_id).quit_game(game_id, username)
+
+    def updated_games(self, username):
+        """Return the sums of the versions of all shards, which change whenever one of them does."""
+        versions = [db.updated_games(username) for db in self.shards]
+        return sum(user or 0 for user, lobby in versions), sum(lobby for user, lobby in versions)
+
+    # ----- Game state, used by Game -----------------------------------------
+
+    def for_game(self, game_id):
+        return self.shard(game_id)
+
+    def get_players(self, game_ids):
+        players = {}
+        for db, ids in self._by_shard(game_ids):
+            players.update(db.get_players(ids))
+        return players
+
+    def get_last_turns(self, game_ids):
+        turns = {}
+        for db, ids in self._by_shard(game_ids):
+            turns.update(db.get_last_turns(ids))
+        return turns
+
+    def get_moves(self, game_id, first_round, rounds):
+        return self.shard(game_id).get_moves(game_id, first_round, rounds)
+
+    def change(self, game_id, change, *args, before_retry=None):
+        return self.shard(game_id).change(game_id, change, *args, before_retry=before_retry)
+
+    @contextlib.contextmanager
+    def batch(self, game_ids=None):
+        """Hold the write locks of the shards of game_ids, of all shards if None."""
+        if game_ids is None:
+            shards = self.shards
+        else:
+            shards = {self.shard(game_id) for game_id in game_ids}
+            shards = [db for db in self.shards if db in shards]
+        with contextlib.ExitStack() as stack:
+            for db in shards:  # Always in shard order, so two batches cannot wait for each other
+                stack.enter_context(db.batch())
+            yield
+
+    def add_move(self, game_id, round_index, index, move):
+        self.shard(game_id).add_move(game_id, round_index, index, move)
+
+    def save_score(self, game_id, username, score):
+        self.shard(game_id).save_score(game_id, username, score)
+
+    def end_game(self, game_id):
+        self.shard(game_id).end_game(game_id)
+
+    def add_round_wins(self, game_id, usernames):
+        self.shard(game_id).add_round_wins(game_id, usernames)
+
+    def add_game_results(self, game_id, usernames, winners):
+        self.shard(game_id).add_game_results(game_id, usernames, winners)
+
+    def save_game_state(self, game_id, rounds, ts, version, usernames):
+        self.shard(game_id).save_game_state(game_id, rounds, ts, version, usernames)
+
+    # ----- Archive ----------------------------------------------------------
+
+    def finished_games(self, before, limit):
+        """Return games of the first shards that have any, oldest first per shard."""
+        return list(itertools.islice((game for db in self.shards for game in db.finished_games(before, limit)), limit))
+
+    def abandoned_games(self, before, limit):
+        return list(itertools.islice((game for db in self.shards for game in db.abandoned_games(before, limit)), limit))
+
+    def export_games(self, game_ids):
+        games = {}
+        for db, ids in self._by_shard(game_ids):
+            games.update(db.export_games(ids))
+        return games
+
+    def delete_games(self, games):
+        deleted = []
+        for db, shard_games in self._by_shard(games, lambda game: game[0]):
+            deleted.extend(db.delete_games(shard_games))
+        return deleted
+
+    def archive_games(self, games):
+        self.users.archive_games(games)  # One archive next to game.db, the shard files share it
+
+    def get_archived_game(self, game_id):
+        return self.users.get_archived_game(game_id)
+
+    # ----- Leaderboard ------------------------------------------------------
+
+    def leaderboard(self, after=None, limit=None):
+        """The shards add the stats of their games to the users database, so a page is read from its index."""
+        return self.users.leaderboard(after, limit)
+
+    # ----- Administration ---------------------------------------------------
+
+    def dump_table(self, table, after=0, limit=None):
+        """Rows of the users database for user, the rows of all shards merged in keyset order for the other tables,
+        read as they are consumed. Game ids are unique across shards, the rowids of players and moves only per shard,
+        so their rows start with rowid * count + shard index instead, which after refers to as well.
+        """
+        if table == 'user':
+            return self.users.dump_table(table, after, limit)
+        count = len(self.shards)
+        if table == 'game':
+            streams = [db.dump_table(table, after, limit) for db in self.shards]
+        else:
+            streams = [_numbered(db.dump_table(table, (after - index) // count, limit), index, count)
+                       for index, db in enumerate(self.shards)]
+        return itertools.islice(heapq.merge(*streams), limit)
+
+    def clear_tables(self, clear_all):
+        self.users.clear_tables(clear_all)
+        for db in self.shards:
+            db.clear_tables(False)
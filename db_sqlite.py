@@ -1,18 +1,416 @@
 """All sqlite3 dependencies.
 
 All sqlite3 dependent code is collected in this module. The rest of the game app will be isolated from direct
-interaction with sqlite3. This makes it easy to replace sqlite3 with a different database. Only the code in this
-module needs to be adapted for a different database. The rest of the app will work the same.
+interaction with sqlite3: DB implements storage.Storage and the app only uses that interface. This makes it easy to
+replace sqlite3 with a different database, like db_memory does. The rest of the app will work the same.
 """
 
-import sqlite3
+import contextlib
 import json
+import os
+import sqlite3
+import queue
+import secrets
+import sys
+import threading
+import time
+import urllib.request
+import zlib
+import metrics
+from cache import LRUCache
+from lobby import Lobby, LobbyGame
+from notify import hub, game_topic, user_topic, LOBBY, RESET
+from storage import ConflictError, Storage, DUMP_COLUMNS, utc_timestamp
+
+DATABASE = 'game.db'
+ARCHIVE_DATABASE = 'archive.db'  # Next to DATABASE
+POOL_SIZE = 5
+HEALTH_CHECK_IDLE = 60.0  # Seconds a pooled connection may sit idle before it is health checked on checkout
+SESSION_DAYS = 30
+SESSION_CACHE_SIZE = 10000
+SESSION_CACHE_TTL = 300  # Seconds a validated session is trusted before it is looked up again, at most until it expires
+MAX_RETRIES = 3  # Attempts at a change that conflicts with changes of other requests, the last one under lock
+
+# Applied to every new connection. The journal mode is stored in the database file, the others are per connection.
+PRAGMAS = [
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -8000',  # KiB
+]
+
+session_cache = LRUCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+
+
+class PoolTimeout(Exception):
+    """No connection became available in the pool within the timeout."""
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that records the number and duration of statements per calling DB method."""
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            code = sys._getframe(1).f_code
+            metrics.record_query(getattr(code, 'co_qualname', code.co_name), time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            code = sys._getframe(1).f_code
+            metrics.record_query(getattr(code, 'co_qualname', code.co_name), time.perf_counter() - started)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    pending_topics = None  # Topics to publish when the open DB.batch() commits, None outside of a batch
+    pending_lobby = None  # (game_id, LobbyGame or None, counter before, counter after) changes for the lobby index
+    pending_stats = None  # Stats rows to add to the stats DB once the transaction has committed, see DB._add_stats()
+
+    def rollback(self):
+        super().rollback()
+        self.pending_stats = None
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+
+class Archive:
+    """Finished games moved out of the hot tables, kept read-only in a database file of their own.
+
+    Every game is one row holding its game row, players and moves as zlib compressed JSON. Only the archive job
+    writes to the file, lookups open it read-only.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, games):
+        """Store games, replacing earlier copies of them.
+
+        :param games: Dict as returned by DB.export_games()
+        """
+        connection = sqlite3.connect(self.path)
+        try:
+            connection.execute('PRAGMA journal_mode = WAL')  # Lookups keep reading while the job writes
+            connection.execute('CREATE TABLE IF NOT EXISTS game (id INTEGER PRIMARY KEY, ts TIMESTAMP, data BLOB)')
+            connection.executemany('INSERT OR REPLACE INTO game (id, ts, data) VALUES (?, ?, ?)', [
+                (game_id, row[3], zlib.compress(json.dumps({'game': row, 'players': p, 'moves': m}).encode()))
+                for game_id, (row, p, m) in games.items()
+            ])
+            connection.commit()
+        finally:
+            connection.close()
+
+    def _connect(self):
+        uri = 'file:{}?mode=ro'.format(urllib.request.pathname2url(os.path.abspath(self.path)))
+        return sqlite3.connect(uri, uri=True)
+
+    @staticmethod
+    def _decode(blob):
+        data = json.loads(zlib.decompress(blob))
+        return tuple(data['game']), [tuple(player) for player in data['players']], [tuple(m) for m in data['moves']]
+
+    def read(self, game_id):
+        """Return (game row, player rows, move rows) like DB.export_games(), None if the game is not archived."""
+        try:
+            connection = self._connect()
+            try:
+                row = connection.execute('SELECT data FROM game WHERE id = ?', [int(game_id)]).fetchone()
+            finally:
+                connection.close()
+        except sqlite3.OperationalError:  # Nothing archived yet
+            return None
+        return self._decode(row[0]) if row else None
+
+    def last_game_id(self):
+        """Return the largest id of an archived game, 0 if there is none."""
+        try:
+            connection = self._connect()
+            try:
+                return connection.execute('SELECT max(id) FROM game').fetchone()[0] or 0
+            finally:
+                connection.close()
+        except sqlite3.OperationalError:  # Nothing archived yet
+            return 0
+
+    def games(self):
+        """Iterate over (game_id, (game row, player rows, move rows)) of all archived games in id order, decompressing
+        one game at a time.
+        """
+        try:
+            connection = self._connect()
+            rows = connection.execute('SELECT id, data FROM game ORDER BY id')
+        except sqlite3.OperationalError:  # Nothing archived yet
+            return
+        try:
+            for game_id, blob in rows:
+                yield game_id, self._decode(blob)
+        finally:
+            connection.close()
+
+
+class ConnectionPool:
+    """Bounded pool of reusable sqlite3 connections.
+
+    Connections are opened lazily, up to `size` of them, and reused across requests. A connection that sat idle for
+    longer than HEALTH_CHECK_IDLE is health checked when it is checked out and replaced with a fresh one if the check
+    fails, one that raised an error on rollback is discarded when it is handed back. The pool also carries the lobby
+    index and the archive of its database.
+
+    :param shard: (index, count) if the database is one of count shards, holding the games whose id modulo count is
+        index, see db_sharded
+    """
+    def __init__(self, database=DATABASE, size=POOL_SIZE, timeout=10.0, shard=(0, 1)):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.shard = shard
+        self.lobby = Lobby()
+        self.archive = Archive(os.path.join(os.path.dirname(database), ARCHIVE_DATABASE))
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.database, check_same_thread=False, factory=InstrumentedConnection)
+        for pragma in PRAGMAS:
+            connection.execute(pragma)
+        return connection
+
+    @staticmethod
+    def _healthy(connection):
+        try:
+            connection.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _discard(self, connection):
+        with self._lock:
+            self._opened -= 1
+        try:
+            connection.close()
+        except sqlite3.Error:
+            pass
 
+    def get(self):
+        """Check out a connection, opening a new one if the pool is not yet full.
+
+        :return: sqlite3.Connection, to be handed back with put()
+        """
+        while True:
+            try:
+                connection, idle_since = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    grow = self._opened < self.size
+                    if grow:
+                        self._opened += 1
+                if grow:
+                    try:
+                        return self._connect()
+                    except sqlite3.Error:
+                        with self._lock:
+                            self._opened -= 1
+                        raise
+                try:
+                    connection, idle_since = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise PoolTimeout('No database connection available after {} s'.format(self.timeout))
+
+            if time.monotonic() - idle_since < HEALTH_CHECK_IDLE or self._healthy(connection):
+                return connection
+            self._discard(connection)
+
+    def put(self, connection):
+        """Return a checked out connection to the pool. Uncommitted changes are rolled back.
+
+        :param connection: Connection previously returned by get()
+        """
+        try:
+            if connection.in_transaction:
+                connection.rollback()
+        except sqlite3.Error:
+            self._discard(connection)
+            return
+        self._idle.put((connection, time.monotonic()))
+
+    def close(self):
+        """Close all idle connections. Connections still checked out are closed when they are returned."""
+        while True:
+            try:
+                connection, idle_since = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(connection)
+
+
+_pool = None
+
+
+def configure_pool(database=DATABASE, size=POOL_SIZE, timeout=10.0, pool_class=ConnectionPool):
+    """Replace the shared connection pool used by DB objects created without an explicit pool.
+
+    :param database: Path of the sqlite3 database file
+    :param size: Maximum number of open connections
+    :param timeout: Seconds to wait for a free connection before raising PoolTimeout
+    :param pool_class: ConnectionPool or a subclass of it
+    :return: The new pool
+    """
+    global _pool
+    old_pool, _pool = _pool, pool_class(database, size, timeout)
+    if old_pool:
+        old_pool.close()
+    return _pool
+
+
+def get_pool():
+    """Return the shared connection pool, creating it with default settings on first use."""
+    if _pool is None:
+        configure_pool()
+    return _pool
+
+
+class DB(Storage):
+    """Storage in SQLite files.
+
+    A DB object borrows a connection from the pool on first use and keeps it until close() is called.
+
+    :param stats: DB keeping the user stats of the games in this one, e.g. the users database of the shards. None to
+        keep them in this database, in the transaction of the game change.
+    """
+    def __init__(self, pool=None, stats=None):
+        self.pool = pool or get_pool()
+        self.stats = stats
+        self._connection = None
+        self._lobby_checked = False  # Lobby counter compared with the index since the connection was borrowed
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = self.pool.get()
+        return self._connection
+
+    def close(self):
+        """Hand the borrowed connection back to the pool."""
+        self._lobby_checked = False
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            self.pool.put(connection)
+
+    @property
+    def lobby(self):
+        """The pool's index of games accepting players.
+
+        Loaded from the database on first use, and again when the lobby counter shows that another process changed
+        the lobby since. The counter is compared once per borrowed connection, i.e. once per request.
+        """
+        lobby = self.pool.lobby
+        if not self._lobby_checked:
+            if self._lobby_counter() != lobby.counter:
+                with lobby.lock:
+                    if self._lobby_counter() != lobby.counter:  # Not loaded by another thread meanwhile
+                        self._load_lobby(lobby)
+            self._lobby_checked = True
+        return lobby
+
+    def _load_lobby(self, lobby):
+        """Read the games accepting players and the lobby counter from the same snapshot into the index."""
+        connection = self.connection
+        cursor = connection.cursor()
+        own_transaction = not connection.in_transaction
+        if own_transaction:
+            cursor.execute('BEGIN')
+        try:
+            counter = self._lobby_counter()
+            cursor.execute(
+                'SELECT game.rowid, players, goal, ts, version, user_name '
+                'FROM game LEFT JOIN player ON player.game_id = game.rowid '
+                'WHERE state = 0 ORDER BY game.rowid, player.rowid'
+            )
+            games = {}
+            for game_id, num_players, goal, ts, version, username in cursor:
+                if game_id not in games:
+                    games[game_id] = LobbyGame(game_id, num_players, goal, ts, version, [])
+                if username is not None:
+                    games[game_id].players.append(username)
+        finally:
+            if own_transaction:
+                connection.commit()
+        lobby.load(games.values(), counter)
+
+    def _lobby_counter(self):
+        """Return the lobby counter, which the triggers of migration 6 move on every change to the lobby."""
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT value FROM counter WHERE name = 'lobby'")
+        return cursor.fetchone()[0]
 
-class DB:
-    """Miscellaneous functions for checking username & password, fetching games, updating scores etc."""
-    def __init__(self):
-        self.connection = sqlite3.connect('game.db')
+    def _commit_lobby_change(self, game_id, counter):
+        """Commit a change to a game that accepts or accepted players and apply it to the lobby index, both at the end
+        of the open batch() if there is one.
+
+        :param counter: Lobby counter read after the change took the write lock, before it changed the game table
+        """
+        game_id = int(game_id)  # Ids from query strings are str
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT players, goal, state, ts, version FROM game WHERE rowid = ?', [game_id])
+        row = cursor.fetchone()  # Read inside the write transaction, so this is the state being committed
+        game = None
+        if row and row[2] == 0:
+            cursor.execute('SELECT user_name FROM player WHERE game_id = ? ORDER BY rowid', [game_id])
+            game = LobbyGame(game_id, row[0], row[1], row[3], row[4], [name for (name,) in cursor])
+        change = (game_id, game, counter, self._lobby_counter())
+        if self.connection.pending_lobby is not None:
+            self.connection.pending_lobby.append(change)
+            return
+        with self.pool.lobby.lock:
+            self.connection.commit()
+            apply_lobby_changes(self.pool.lobby, [change])
+
+    def _commit(self, *topics):
+        """Commit and publish topics, or leave both to the end of the open batch()."""
+        if self.connection.pending_topics is None:
+            self.connection.commit()
+            self._save_stats()
+        self._publish(*topics)
+
+    def _publish(self, *topics):
+        """Publish topics of committed changes, or add them to the topics published when the open batch() commits."""
+        if self.connection.pending_topics is None:
+            if topics:
+                hub.publish(*topics)
+        else:
+            self.connection.pending_topics.extend(topics)
+
+    @contextlib.contextmanager
+    def batch(self, game_ids=None):
+        """Save the changes made inside the block in one transaction.
+
+        No method commits or publishes while a batch is open. The batch commits once at the end, applies the changes to
+        the lobby index and then publishes every touched topic, or rolls everything back if the block raises. The batch
+        holds the write lock from the start, so games read inside the block cannot be changed by anyone else before it
+        commits.
+        """
+        connection = self.connection
+        connection.cursor().execute('BEGIN IMMEDIATE')
+        connection.pending_topics = topics = []
+        connection.pending_lobby = lobby_changes = []
+        try:
+            yield
+        except BaseException:
+            connection.rollback()
+            raise
+        else:
+            with self.pool.lobby.lock:
+                connection.commit()
+                apply_lobby_changes(self.pool.lobby, lobby_changes)
+        finally:
+            connection.pending_topics = connection.pending_lobby = None
+        self._save_stats()
+        if topics:
+            hub.publish(*dict.fromkeys(topics))
 
     def user_pass_valid(self, username, password):
         cursor = self.connection.cursor()
@@ -29,18 +427,84 @@ class DB:
             return False
         else:
             cursor.execute('INSERT INTO user (name, password) VALUES (?, ?)', [username, password])
-            self.connection.commit()
+            self._commit()
             return True
 
+    def new_session(self, username):
+        """Create a session for a user who has logged in.
+
+        :param username: Name of the user
+        :return: Opaque session token to be stored in the session cookie
+        """
+        token = secrets.token_urlsafe(32)
+        expires = utc_timestamp(SESSION_DAYS)
+        cursor = self.connection.cursor()
+        cursor.execute('INSERT INTO session (token, user_name, expires) VALUES (?, ?, ?)', [token, username, expires])
+        self._commit()
+        session_cache.put(token, (username, expires))
+        return token
+
+    def session_user(self, token):
+        """Return the user a session token belongs to.
+
+        Valid tokens are cached in memory with their expiry, so most requests do not query the session table.
+
+        :param token: Session token from the cookie
+        :return: Username, or None if the token is unknown or expired
+        """
+        cached = session_cache.get(token)
+        if cached is not None:
+            username, expires = cached
+            if expires > utc_timestamp():
+                return username
+            session_cache.invalidate(token)
+            return None
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT user_name, expires FROM session WHERE token = ? AND expires > datetime()', [token])
+        row = cursor.fetchone()
+        if not row:
+            return None
+        session_cache.put(token, row)
+        return row[0]
+
+    def delete_session(self, token):
+        """End a session, e.g. when the user logs out.
+
+        :param token: Session token from the cookie
+        """
+        session_cache.invalidate(token)
+        cursor = self.connection.cursor()
+        cursor.execute('DELETE FROM session WHERE token = ?', [token])
+        self._commit()
+
+    def delete_expired_sessions(self, limit):
+        cursor = self.connection.cursor()
+        cursor.execute(
+            'DELETE FROM session WHERE token IN (SELECT token FROM session WHERE expires <= datetime() LIMIT ?)',
+            [limit]
+        )
+        self._commit()
+        return cursor.rowcount
+
     def get_game_by_id(self, game_id):
         cursor = self.connection.cursor()
-        cursor.execute('SELECT players, goal, state, ts, turns FROM game WHERE rowid = ?', [game_id])
+        cursor.execute('SELECT players, goal, state, ts, rounds, version FROM game WHERE rowid = ?', [game_id])
         return cursor.fetchone()
 
+    def get_games_by_ids(self, game_ids):
+        """Return (game_id, players, goal, state, ts, rounds, version) rows of at most MAX_SQL_VARIABLES games."""
+        game_ids = list(game_ids)
+        cursor = self.connection.cursor()
+        cursor.execute(
+            'SELECT rowid, players, goal, state, ts, rounds, version FROM game WHERE rowid IN ({}) ORDER BY 1'.format(
+                ', '.join('?' * len(game_ids))), game_ids
+        )
+        return cursor.fetchall()
+
     def get_games_by_user(self, username):
         cursor = self.connection.cursor()
         cursor.execute(
-            'SELECT game.rowid, players, goal, state, ts, turns '
+            'SELECT game.rowid, players, goal, state, ts, rounds, version '
             'FROM game, player '
             'WHERE player.game_id = game.rowid AND playing AND user_name = ? '
             'ORDER BY 1', [username]
@@ -48,67 +512,189 @@ class DB:
         return cursor.fetchall()
 
     def get_registering_games_by_user(self, username):
-        cursor = self.connection.cursor()
-        cursor.execute(
-            'SELECT game_id, players, goal, ts, turns FROM game, ('
-            ' SELECT rowid game_id FROM game WHERE state = 0 AND rowid NOT IN ('
-            '  SELECT game.rowid FROM game, player'
-            '  WHERE state = 0 AND game.rowid = player.game_id AND player.user_name = ?'
-            ' )'
-            ') registering '
-            'WHERE game.rowid = registering.game_id '
-            'ORDER BY 1 DESC', [username]
-        )
-        return cursor.fetchall()
+        """Return (game_id, players, goal, ts, rounds, version) rows of the games username can join, newest first."""
+        return [game.row() for game in self.lobby.games_for(username)]
+
+    def get_registering_players(self, game_ids):
+        """Return the players of games accepting players, like players_by_game_ids() but from the lobby index.
+
+        :param game_ids: Iterable of game ids
+        :return: Dict mapping game id to a list of (user_name, score, playing) rows in joining order
+        """
+        return {game_id: [(name, 0, 1) for name in self.lobby.players(game_id)] for game_id in game_ids}
 
     def new_game(self, players, goal, username):
         cursor = self.connection.cursor()
-        cursor.execute('INSERT INTO game (players, goal) VALUES (?, ?);', [players, goal])
-        cursor.execute('INSERT INTO player (game_id, user_name) VALUES (last_insert_rowid(), ?)', [username])
-        self.connection.commit()
+        index, count = self.pool.shard
+        if not self.connection.in_transaction:  # Inside batch() the write lock is held already
+            cursor.execute('BEGIN IMMEDIATE')  # Nobody else can change the lobby or take the id before the insert
+        counter = self._lobby_counter()
+        if count == 1:
+            cursor.execute('INSERT INTO game (players, goal) VALUES (?, ?);', [players, goal])
+        else:
+            cursor.execute('SELECT last_game_id FROM sharding WHERE id = 1')
+            last = cursor.fetchone()[0]
+            game_id = last + 1 + (index - last - 1) % count  # The next id that belongs to this shard
+            cursor.execute('UPDATE sharding SET last_game_id = ? WHERE id = 1', [game_id])
+            cursor.execute('INSERT INTO game (rowid, players, goal) VALUES (?, ?, ?)', [game_id, players, goal])
+            self._add_user_version(username)
+        game_id = cursor.lastrowid
+        cursor.execute('INSERT INTO player (game_id, user_name) VALUES (?, ?)', [game_id, username])
+        self._commit_lobby_change(game_id, counter)
+        self._publish(LOBBY, user_topic(username))
+
+    def sharding(self):
+        """Return (shards, last_game_id) as recorded by db_sqlite_initialize.py, see db_sharded. A database that was
+        never split, or not upgraded to schema version 9 yet, counts as a single shard.
+        """
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute('SELECT shards, last_game_id FROM sharding WHERE id = 1')
+        except sqlite3.OperationalError:  # No sharding table
+            return 1, 0
+        return cursor.fetchone() or (1, 0)
+
+    def _add_user_version(self, username):
+        """Start counting the changes to username's games in a shard, whose user table does not have the user."""
+        cursor = self.connection.cursor()
+        cursor.execute('INSERT OR IGNORE INTO user_version (user_name) VALUES (?)', [username])
+
+    def _publish_game_change(self, game_id, *usernames):
+        """Notify the lobby, the game and all of its players that the game changed."""
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT user_name FROM player WHERE game_id = ?', [game_id])
+        players = {name for (name,) in cursor.fetchall()} | set(usernames)
+        self._publish(LOBBY, game_topic(game_id), *[user_topic(name) for name in players])
 
     def join_game(self, game_id, username):
+        self.change(game_id, self._join_game, game_id, username)
+
+    def _join_game(self, game_id, username):
         game = self.get_game_by_id(game_id)
         if not game:
             print("Unknown game")
             return
 
-        max_players, goal, state, ts, turns = game
+        max_players, goal, state, ts, rounds, version = game
         if state > 0:
             print("Game full")
             return
 
         cursor = self.connection.cursor()
-        cursor.execute('INSERT INTO player (game_id, user_name) VALUES (?, ?)', [game_id, username])
         cursor.execute('SELECT count(*) FROM player WHERE game_id = ?', [game_id])
-        (players_in_game,) = cursor.fetchone()
-        if players_in_game == max_players:  # Players filled
-            cursor.execute('UPDATE game SET state = 1, ts = datetime() WHERE rowid = ?', [game_id])
-            self.connection.commit()
-        elif players_in_game < max_players:  # Waiting more players
-            cursor.execute('UPDATE game SET ts = datetime() WHERE rowid = ?', [game_id])
-            self.connection.commit()
-        elif players_in_game > max_players:  # Too many players
-            self.connection.rollback()
+        players_in_game = cursor.fetchone()[0] + 1
+        if players_in_game > max_players:  # Too many players
+            return
+        if self.pool.shard[1] > 1:
+            self._add_user_version(username)
+        cursor.execute('INSERT INTO player (game_id, user_name) VALUES (?, ?)', [game_id, username])
+        counter = self._lobby_counter()  # The insert took the write lock
+        cursor.execute(  # Players filled, or waiting for more players
+            'UPDATE game SET state = ?, ts = datetime(), version = version + 1 WHERE rowid = ? AND version = ?',
+            [1 if players_in_game == max_players else 0, game_id, version]
+        )
+        if cursor.rowcount != 1:
+            raise ConflictError(game_id)
+        self._commit_lobby_change(game_id, counter)
+        self._publish_game_change(game_id)
 
     def updated_games(self, username):
+        """Return the change versions of the user's games and of the lobby.
+
+        Triggers count every change to a game in the version of each of its players and every change to a game
+        accepting players in the lobby counter, so two changes in the same second still give different versions.
+
+        :param username: Logged in user
+        :return: (user version, lobby version)
+        """
+        cursor = self.connection.cursor()
+        cursor.execute(
+            'SELECT (SELECT version FROM user_version WHERE user_name = ?), '
+            "(SELECT value FROM counter WHERE name = 'lobby')", [username]
+        )
+        return cursor.fetchone()
+
+    def get_players(self, game_ids):
+        return players_by_game_ids(self.connection, game_ids)
+
+    def get_last_turns(self, game_ids):
+        return last_turns_by_game_ids(self.connection, game_ids)
+
+    def get_moves(self, game_id, first_round, rounds):
         cursor = self.connection.cursor()
-        cursor.execute(  # Find latest timestamps of players' game joins, quits, moves where user himself has not quit
-            'SELECT max(ts) FROM game, player '
-            'WHERE player.user_name = ? AND player.playing AND player.game_id = game.rowid ', [username])
-        (latest_timestamp_of_running_games,) = cursor.fetchone()
-        cursor.execute(  # Latest timestamps of games waiting for registrations
-            'SELECT max(ts) FROM game, ('
-            ' SELECT rowid game_id FROM game WHERE state = 0 AND rowid NOT IN ('
-            '  SELECT game.rowid FROM game, player'
-            '  WHERE state = 0 AND game.rowid = player.game_id AND player.user_name = ?'
-            ' )'
-            ') registering '
-            'WHERE game.rowid = registering.game_id', [username]
+        cursor.execute(
+            'SELECT round, player_index, move FROM move WHERE game_id = ? AND round >= ? AND round < ?',
+            [game_id, first_round, rounds]
         )
+        return cursor.fetchall()
+
+    def change(self, game_id, change, *args, before_retry=None):
+        return retry_on_conflict(self.connection, change, *args, before_retry=before_retry)
+
+    def add_move(self, game_id, round_index, index, move):
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(
+                'INSERT INTO move (game_id, round, player_index, move) VALUES (?, ?, ?, ?)',
+                [game_id, round_index, index, move]
+            )
+        except sqlite3.IntegrityError:  # Someone else saved a move for this player and round first
+            raise ConflictError(game_id)
+        # Commit in save_game_state()
 
-        (latest_timestamp_of_registering_games,) = cursor.fetchone()
-        return latest_timestamp_of_running_games, latest_timestamp_of_registering_games
+    def save_score(self, game_id, username, score):
+        cursor = self.connection.cursor()
+        cursor.execute('UPDATE player SET score = ? WHERE user_name = ? AND game_id = ?', [score, username, game_id])
+        # Commit in save_game_state()
+
+    def end_game(self, game_id):
+        cursor = self.connection.cursor()
+        cursor.execute('UPDATE game SET state = 2 WHERE rowid = ?', [game_id])
+        # Commit in save_game_state()
+
+    def add_round_wins(self, game_id, usernames):
+        self._add_stats([(name, 0, 0, 1) for name in usernames])
+        # Commit in save_game_state()
+
+    def add_game_results(self, game_id, usernames, winners):
+        self._add_stats([(name, 1, int(name in winners), 0) for name in usernames])
+        # Commit in save_game_state()
+
+    def _add_stats(self, rows):
+        """Add (user_name, games_played, wins, rounds_won) rows to user_stats, or with a stats DB, to its user_stats
+        once the game change has committed.
+        """
+        if self.stats is not None:
+            self.connection.pending_stats = (self.connection.pending_stats or []) + rows
+            return
+        cursor = self.connection.cursor()
+        cursor.executemany(
+            'INSERT INTO user_stats (user_name, games_played, wins, rounds_won) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (user_name) DO UPDATE SET games_played = games_played + excluded.games_played, '
+            'wins = wins + excluded.wins, rounds_won = rounds_won + excluded.rounds_won', rows
+        )
+
+    def _save_stats(self):
+        """Commit the stats counted by a committed game change to the stats DB.
+
+        The two commits are not atomic, stats of a change are lost if the process dies in between. Rebuild them with
+        db_sqlite_initialize.py --backfill-stats.
+        """
+        rows, self.connection.pending_stats = self.connection.pending_stats, None
+        if rows:
+            self.stats._add_stats(rows)
+            self.stats.connection.commit()
+
+    def save_game_state(self, game_id, rounds, ts, version, usernames):
+        """Save a game's rounds and ts. Inside batch() the commit waits for the end of the batch."""
+        cursor = self.connection.cursor()
+        cursor.execute(
+            'UPDATE game SET rounds = ?, ts = ?, version = version + 1 WHERE rowid = ? AND version = ?',
+            [rounds, ts, game_id, version]
+        )
+        if cursor.rowcount != 1:
+            raise ConflictError(game_id)
+        self._commit(game_topic(game_id), *[user_topic(name) for name in usernames])
 
     def quit_game(self, game_id, username):
         cursor = self.connection.cursor()
@@ -128,94 +714,263 @@ class DB:
 
         if game_state == 0:  # Still registering players
             cursor.execute('DELETE FROM player WHERE user_name = ? AND game_id = ?', [username, game_id])
+            counter = self._lobby_counter()  # The delete took the write lock
             cursor.execute('SELECT count(*) FROM player WHERE game_id = ?', [game_id])
             (remaining_players,) = cursor.fetchone()
             if remaining_players > 0:
-                cursor.execute('UPDATE game SET ts = datetime() WHERE rowid = ?', [game_id])
+                cursor.execute('UPDATE game SET ts = datetime(), version = version + 1 WHERE rowid = ?', [game_id])
             else:
                 cursor.execute('DELETE FROM game WHERE rowid = ?', [game_id])
                 # Minor prob: Reg list will not update if a newer game is in the list
-            self.connection.commit()
+            self._commit_lobby_change(game_id, counter)
         else:
             cursor.execute(
                 'UPDATE player SET playing = 0 WHERE user_name = ? AND game_id = ?', [username, game_id]
             )
-            cursor.execute('UPDATE game SET ts = datetime() WHERE rowid = ?', [game_id])
-            self.connection.commit()
+            cursor.execute('UPDATE game SET ts = datetime(), version = version + 1 WHERE rowid = ?', [game_id])
+            self._commit()
+        self._publish_game_change(game_id, username)
 
-    def dump(self):
+    def finished_games(self, before, limit):
         cursor = self.connection.cursor()
+        cursor.execute(
+            'SELECT rowid, version FROM game WHERE state = 2 AND ts < ? ORDER BY ts LIMIT ?', [before, limit]
+        )
+        return cursor.fetchall()
 
-        cursor.execute('SELECT name, password FROM user')
-        users = cursor.fetchall()
+    def abandoned_games(self, before, limit):
+        cursor = self.connection.cursor()
+        cursor.execute(
+            'SELECT rowid, version FROM game WHERE state = 0 AND ts < ? ORDER BY ts LIMIT ?', [before, limit]
+        )
+        return cursor.fetchall()
 
-        cursor.execute('SELECT rowid, players, goal, state, ts, turns FROM game')
-        games = cursor.fetchall()
+    def export_games(self, game_ids):
+        """Read everything about at most MAX_SQL_VARIABLES games, for the archive.
 
-        cursor.execute('SELECT rowid, game_id, user_name, score, playing FROM player')
-        players = cursor.fetchall()
+        :return: Dict mapping game id to (game row, player rows, move rows), the game row as returned by
+            get_game_by_id() and move rows being (round, player_index, move)
+        """
+        self.connection.execute('BEGIN')  # All rows from the same snapshot
+        try:
+            rows = {row[0]: row[1:] for row in self.get_games_by_ids(game_ids)}
+            players = players_by_game_ids(self.connection, rows)
+            moves = {game_id: [] for game_id in rows}
+            cursor = self.connection.cursor()
+            cursor.execute(
+                'SELECT game_id, round, player_index, move FROM move WHERE game_id IN ({}) ORDER BY 1, 2, 3'.format(
+                    ', '.join('?' * len(rows))), list(rows)
+            )
+            for game_id, round_index, index, move in cursor:
+                moves[game_id].append((round_index, index, move))
+        finally:
+            self.connection.commit()
+        return {game_id: (row, players[game_id], moves[game_id]) for game_id, row in rows.items()}
+
+    def delete_games(self, games):
+        """Delete at most MAX_SQL_VARIABLES games with their players and moves, skipping games that changed since
+        their version was read.
+
+        :param games: (game_id, version) pairs
+        :return: Ids of the deleted games
+        """
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            counter = self._lobby_counter()
+            deleted = []
+            for game_id, version in games:
+                cursor.execute('DELETE FROM game WHERE rowid = ? AND version = ?', [game_id, version])
+                if cursor.rowcount:
+                    deleted.append(game_id)
+            if not deleted:
+                self.connection.rollback()
+                return deleted
+            in_deleted = 'game_id IN ({})'.format(', '.join('?' * len(deleted)))
+            cursor.execute('SELECT DISTINCT user_name FROM player WHERE ' + in_deleted, deleted)
+            players = [name for (name,) in cursor.fetchall()]
+            cursor.execute('DELETE FROM player WHERE ' + in_deleted, deleted)
+            cursor.execute('DELETE FROM move WHERE ' + in_deleted, deleted)
+            after = self._lobby_counter()
+            with self.pool.lobby.lock:
+                self.connection.commit()
+                for game_id in deleted:
+                    self.pool.lobby.remove(game_id)
+                self.pool.lobby.advance(counter, after)
+        except Exception:
+            self.connection.rollback()
+            raise
+        hub.publish(LOBBY, *[game_topic(game_id) for game_id in deleted] + [user_topic(name) for name in players])
+        return deleted
+
+    def archive_games(self, games):
+        self.pool.archive.write(games)
+
+    def get_archived_game(self, game_id):
+        return self.pool.archive.read(game_id)
+
+    # ----- Leaderboard ------------------------------------------------------
+
+    def leaderboard(self, after=None, limit=None):
+        """Read a page of user_stats along its rank index, seeking to the wins of the after user."""
+        sql = 'SELECT user_name, games_played, wins, rounds_won FROM user_stats'
+        params = []
+        if after is not None:
+            cursor = self.connection.cursor()
+            cursor.execute('SELECT wins, games_played FROM user_stats WHERE user_name = ?', [after])
+            wins, games_played = cursor.fetchone() or (0, 0)
+            sql += ' WHERE wins <= ? AND (wins < ? OR games_played > ? OR games_played = ? AND user_name > ?)'
+            params += [wins, wins, games_played, games_played, after]
+        sql += ' ORDER BY wins DESC, games_played, user_name'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params)
+        return cursor.fetchall()
 
-        return users, games, players
+    def dump_table(self, table, after=0, limit=None):
+        """Iterate over the rows of a table in rowid order, reading them from the database as they are consumed."""
+        sql = 'SELECT rowid, {} FROM {} WHERE rowid > ? ORDER BY rowid'.format(', '.join(DUMP_COLUMNS[table]), table)
+        params = [after]
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params)
+        yield from cursor
 
     def clear_tables(self, clear_all):
         cursor = self.connection.cursor()
         if clear_all:
             cursor.execute('DELETE FROM user')
+            cursor.execute('DELETE FROM session')
+            session_cache.clear()
         cursor.execute('DELETE FROM game')
         cursor.execute('DELETE FROM player')
+        cursor.execute('DELETE FROM move')
+        cursor.execute('DELETE FROM user_stats')
         self.connection.commit()
+        self.pool.lobby.reset()
+        hub.publish(LOBBY, RESET)
 
 
-class Game:
-    """Base functionality for game classes."""
-    def __init__(self, game_id, num_players, goal, state, ts, turns, connection):
-        """Initialize game object with state and load players and scores from database."""
-        self.id = game_id
-        self.num_players = num_players
-        self.goal = goal
-        self.state = state  # 0={Registering players}, 1={Game on}, 2={Game over}
-        self.ts = ts
-        self.turns = json.loads(turns)
-
-        self.connection = connection
-        cursor = connection.cursor()
-        cursor.execute('SELECT user_name, score, playing FROM player WHERE game_id = ? ORDER BY rowid', [game_id])
-        self.players = [{'name': n, 'score': s, 'playing': p} for n, s, p in cursor.fetchall()]
+MAX_SQL_VARIABLES = 500  # Stay well below SQLite's limit on host parameters in one statement
 
-    def player_index(self, username):
-        """Return player's index in player list
-
-        :param username: Name of the user to find index for
-        :return: int
-        """
-        return [p['name'] for p in self.players].index(username)
 
-    def save_score_for_player(self, index):
-        """Save player's score.
+def players_by_game_ids(connection, game_ids):
+    """Fetch the players of many games with one query per MAX_SQL_VARIABLES games.
 
-        :param index: Position of player in Game's player list
-        """
-        player = self.players[index]
-        cursor = self.connection.cursor()
+    :param connection: sqlite3.Connection
+    :param game_ids: Iterable of game ids
+    :return: Dict mapping game id to a list of (user_name, score, playing) rows in joining order
+    """
+    game_ids = list(game_ids)
+    players = {game_id: [] for game_id in game_ids}
+    cursor = connection.cursor()
+    for start in range(0, len(game_ids), MAX_SQL_VARIABLES):
+        chunk = game_ids[start:start + MAX_SQL_VARIABLES]
         cursor.execute(
-            'UPDATE player SET score = ? '
-            'WHERE user_name = ? AND game_id = ?', [player['score'], player['name'], self.id])
-        # Commit in save_game_state()
+            'SELECT game_id, user_name, score, playing FROM player '
+            'WHERE game_id IN ({}) ORDER BY rowid'.format(', '.join('?' * len(chunk))), chunk
+        )
+        for game_id, name, score, playing in cursor:
+            players[game_id].append((name, score, playing))
+    return players
+
+
+def last_turns_by_game_ids(connection, game_ids):
+    """Fetch the moves of the latest round of many games with one query per MAX_SQL_VARIABLES games.
+
+    :param connection: sqlite3.Connection
+    :param game_ids: Iterable of game ids
+    :return: Dict mapping game id to a list of (player_index, move) rows, empty for games without moves
+    """
+    game_ids = list(game_ids)
+    moves = {game_id: [] for game_id in game_ids}
+    cursor = connection.cursor()
+    for start in range(0, len(game_ids), MAX_SQL_VARIABLES):
+        chunk = game_ids[start:start + MAX_SQL_VARIABLES]
+        cursor.execute(
+            'SELECT game_id, player_index, move FROM game, move '
+            'WHERE game.rowid IN ({}) AND move.game_id = game.rowid AND move.round = game.rounds - 1'.format(
+                ', '.join('?' * len(chunk))), chunk
+        )
+        for game_id, index, move in cursor:
+            moves[game_id].append((index, move))
+    return moves
 
-    def set_game_over(self):
-        """Set game status to game over."""
-        self.state = 2  # Game over
-        cursor = self.connection.cursor()
-        cursor.execute('UPDATE game SET state = 2 WHERE rowid = ?', [self.id])
-        # Commit in save_game_state()
 
-    def save_game_state(self):
-        """Save game state to database."""
-        cursor = self.connection.cursor()
-        cursor.execute(
-            'UPDATE game SET turns = ?, ts = datetime() '
-            'WHERE rowid = ?', [json.dumps(self.turns), self.id])
-        self.connection.commit()
-        cursor = self.connection.cursor()
-        cursor.execute('SELECT ts FROM game WHERE rowid = ?', [self.id])
-        self.ts = cursor.fetchone()[0]
+def apply_lobby_changes(lobby, changes):
+    """Apply committed changes to a lobby index, holding its lock.
+
+    :param changes: (game_id, game, counter before, counter after) of each change, game being a LobbyGame for games
+        accepting players and None for games that no longer do
+    """
+    for game_id, game, before, after in changes:
+        if game:
+            lobby.put(game)
+        else:
+            lobby.remove(game_id)
+        lobby.advance(before, after)
+
+
+@contextlib.contextmanager
+def savepoint(connection):
+    """Inside DB.batch(), roll back only the changes made inside the block, with their topics, if it raises.
+
+    :param connection: sqlite3.Connection with an open batch
+    """
+    topics, lobby_changes = len(connection.pending_topics), len(connection.pending_lobby)
+    stats = len(connection.pending_stats or [])
+    cursor = connection.cursor()
+    cursor.execute('SAVEPOINT change')
+    try:
+        yield
+    except BaseException:
+        cursor.execute('ROLLBACK TO change')
+        cursor.execute('RELEASE change')
+        del connection.pending_topics[topics:], connection.pending_lobby[lobby_changes:]
+        connection.pending_stats = (connection.pending_stats or [])[:stats] or None
+        raise
+    else:
+        cursor.execute('RELEASE change')
+
+
+def retry_on_conflict(connection, change, *args, before_retry=None):
+    """Make a change, starting over when it raises ConflictError, at most MAX_RETRIES times.
+
+    Attempts read outside of a transaction and the version checks in their updates catch changes committed in
+    between (optimistic concurrency). The last attempt begins with BEGIN IMMEDIATE, so it holds the write lock while
+    reading and cannot conflict. Inside DB.batch() the write lock is held already, so change can only conflict with
+    what was read before the batch began. It is then rolled back to a savepoint and started over once.
+
+    :param connection: sqlite3.Connection
+    :param change: Function that commits its changes or raises ConflictError
+    :param before_retry: Function called before every attempt but the first, e.g. to read the game again
+    :return: What change returns
+    """
+    if getattr(connection, 'pending_topics', None) is not None:
+        try:
+            with savepoint(connection):
+                return change(*args)
+        except ConflictError:
+            if not before_retry:
+                raise
+        before_retry()
+        return change(*args)
+    for attempt in range(MAX_RETRIES):
+        last = attempt == MAX_RETRIES - 1
+        if last:
+            connection.cursor().execute('BEGIN IMMEDIATE')
+        try:
+            if attempt and before_retry:
+                before_retry()
+            return change(*args)
+        except ConflictError:
+            connection.rollback()
+            if last:
+                raise
+        finally:
+            if last and connection.in_transaction:  # change decided to not change anything
+                connection.rollback()
@@ -1,36 +1,501 @@
+"""Create or upgrade the game database.
+
+    python db_sqlite_initialize.py            Bring game.db up to the latest schema, keeping its data
+    python db_sqlite_initialize.py --reset    Drop all tables first and start from an empty database
+    python db_sqlite_initialize.py --explain  Print the query plan of every query DB and Game run
+    python db_sqlite_initialize.py --backfill-stats  Rebuild the leaderboard stats from the games played so far
+    python db_sqlite_initialize.py --shards 4  Also create 4 shard files and move the games of game.db into them
+
+The schema version is kept in PRAGMA user_version. Every entry in MIGRATIONS upgrades the database by one version
+and is applied in its own transaction, so an existing game.db is upgraded in place. A step is either an SQL
+statement or a function taking the connection. Append new migrations, never edit ones that have been released.
+
+Upgrading to version 8 counts the leaderboard stats of the games already in game.db, its shard files and its archive,
+so the stats are complete from the start. --backfill-stats only repairs them after a crash, see DB._save_stats().
+"""
+
+import argparse
+import json
+import os
+import re
 import sqlite3
 
-connection = sqlite3.connect('game.db')
-
-connection.execute('DROP TABLE IF EXISTS user')
-connection.execute('DROP TABLE IF EXISTS game')
-connection.execute('DROP TABLE IF EXISTS player')
-
-connection.execute('''
-CREATE TABLE user (
- name VARCHAR(64) NOT NULL PRIMARY KEY,
- password VARCHAR(64) NOT NULL
-)
-''')
-
-connection.execute('''
-CREATE TABLE game (
- players INTEGER,
- goal INTEGER,
- state INTEGER DEFAULT 0,
- ts TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
- turns VARCHAR(4096) DEFAULT '[]'
-)
-''')
-
-connection.execute('''
-CREATE TABLE player (
- game_id INTEGER,
- user_name VARCHAR(64),
- score INTEGER DEFAULT 0,
- playing INTEGER DEFAULT 1,
- UNIQUE (game_id, user_name)
-)
-''')
-
-connection.commit()
+import db_sharded
+import db_sqlite
+import pyramid
+import storage
+
+BATCH_SIZE = 1000
+
+
+def _move_turns_to_move_table(connection):
+    """Copy the JSON turns of every game into the move table, a batch of games at a time."""
+    last_rowid = 0
+    while True:
+        games = connection.execute(
+            'SELECT rowid, turns FROM game WHERE rowid > ? ORDER BY rowid LIMIT ?', [last_rowid, BATCH_SIZE]
+        ).fetchall()
+        if not games:
+            return
+        for game_id, turns in games:
+            turns = json.loads(turns or '[]')
+            connection.executemany(
+                'INSERT INTO move (game_id, round, player_index, move) VALUES (?, ?, ?, ?)',
+                [(game_id, round_index, index, move)
+                 for round_index, turn in enumerate(turns) for index, move in enumerate(turn) if move is not None]
+            )
+            connection.execute('UPDATE game SET rounds = ? WHERE rowid = ?', [len(turns), game_id])
+        last_rowid = games[-1][0]
+
+
+# Triggers keeping the change counters of migration 6 up to date. Recreated when the game table is rebuilt.
+GAME_TRIGGERS = [
+    '''
+    CREATE TRIGGER game_update_version AFTER UPDATE ON game BEGIN
+     UPDATE user_version SET version = version + 1
+     WHERE user_name IN (SELECT user_name FROM player WHERE game_id = NEW.rowid);
+    END''',
+    '''
+    CREATE TRIGGER game_insert_lobby AFTER INSERT ON game BEGIN
+     UPDATE counter SET value = value + 1 WHERE name = 'lobby';
+    END''',
+    '''
+    CREATE TRIGGER game_update_lobby AFTER UPDATE ON game WHEN OLD.state = 0 OR NEW.state = 0 BEGIN
+     UPDATE counter SET value = value + 1 WHERE name = 'lobby';
+    END''',
+    '''
+    CREATE TRIGGER game_delete_lobby AFTER DELETE ON game WHEN OLD.state = 0 BEGIN
+     UPDATE counter SET value = value + 1 WHERE name = 'lobby';
+    END''',
+]
+
+
+def _count_user_stats(connection, archive=None, shards=()):
+    """Count the stats of every user from the games in the database, its shards and the archive, in one pass over each.
+
+    A player's score is the number of rounds they won, so rounds_won sums the scores of all of a user's games. A
+    finished game counts as played by all of its players and as won by those who reached the goal. Rows are read as
+    they are consumed, only the totals per user are held in memory. Games are looked up by rowid, which is their id
+    at every schema version, so shards that have not been upgraded yet are counted as well.
+
+    :param connection: sqlite3.Connection of game.db
+    :param archive: db_sqlite.Archive, or None to count only the games in the hot tables
+    :param shards: sqlite3.Connection of every shard in order, empty if the games are in connection
+    :return: Dict of user name -> [games_played, wins, rounds_won]
+    """
+    totals = {}
+
+    def count(name, score, goal, state):
+        stats = totals.setdefault(name, [0, 0, 0])
+        if state == 2:
+            stats[0] += 1
+            stats[1] += score >= goal
+        stats[2] += score
+
+    sources = list(shards) or [connection]
+    for source in sources:
+        for name, score, goal, state in source.execute(
+                'SELECT user_name, score, goal, state FROM player, game WHERE game.rowid = player.game_id'):
+            count(name, score, goal, state)
+    for game_id, (row, players, moves) in archive.games() if archive else ():
+        # Skip games archived but still in the hot tables, counted above
+        if not sources[game_id % len(sources)].execute('SELECT 1 FROM game WHERE rowid = ?', [game_id]).fetchone():
+            for name, score, playing in players:
+                count(name, score, row[1], row[2])
+    return totals
+
+
+def _replace_user_stats(connection, totals):
+    connection.execute('DELETE FROM user_stats')
+    connection.executemany(
+        'INSERT INTO user_stats (user_name, games_played, wins, rounds_won) VALUES (?, ?, ?, ?)',
+        [(name, *stats) for name, stats in totals.items()]
+    )
+
+
+def _backfill_user_stats(connection):
+    """Migration step filling user_stats from the games of the database, its shard files and its archive.
+
+    The stats of sharded games are kept in game.db, so a shard file's own user_stats stays empty.
+    """
+    (path,) = [row[2] for row in connection.execute('PRAGMA database_list') if row[1] == 'main']
+    if not path:  # In memory, with neither shards nor an archive
+        _replace_user_stats(connection, _count_user_stats(connection))
+        return
+    if re.fullmatch(r'.*-shard\d+', os.path.splitext(path)[0]):
+        return
+    count = 0
+    while os.path.exists(db_sharded.shard_paths(path, count + 1)[-1]):
+        count += 1
+    shards = [sqlite3.connect(shard) for shard in db_sharded.shard_paths(path, count)]
+    try:
+        archive = db_sqlite.Archive(os.path.join(os.path.dirname(path), db_sqlite.ARCHIVE_DATABASE))
+        _replace_user_stats(connection, _count_user_stats(connection, archive, shards))
+    finally:
+        for shard in shards:
+            shard.close()
+
+
+MIGRATIONS = [
+    [  # 1: Original schema
+        '''
+        CREATE TABLE IF NOT EXISTS user (
+         name VARCHAR(64) NOT NULL PRIMARY KEY,
+         password VARCHAR(64) NOT NULL
+        )''',
+        '''
+        CREATE TABLE IF NOT EXISTS game (
+         players INTEGER,
+         goal INTEGER,
+         state INTEGER DEFAULT 0,
+         ts TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+         turns VARCHAR(4096) DEFAULT '[]'
+        )''',
+        '''
+        CREATE TABLE IF NOT EXISTS player (
+         game_id INTEGER,
+         user_name VARCHAR(64),
+         score INTEGER DEFAULT 0,
+         playing INTEGER DEFAULT 1,
+         UNIQUE (game_id, user_name)
+        )''',
+    ],
+    [  # 2: Session tokens
+        '''
+        CREATE TABLE IF NOT EXISTS session (
+         token VARCHAR(64) NOT NULL PRIMARY KEY,
+         user_name VARCHAR(64) NOT NULL,
+         expires TIMESTAMP NOT NULL
+        )''',
+    ],
+    [  # 3: Indexes for the per-user game lists and the lobby
+        'CREATE INDEX IF NOT EXISTS player_user_playing ON player (user_name, playing, game_id)',
+        'CREATE INDEX IF NOT EXISTS game_state_ts ON game (state, ts)',
+    ],
+    [  # 4: One row per move instead of a JSON list of turns in game
+        '''
+        CREATE TABLE move (
+         game_id INTEGER NOT NULL,
+         round INTEGER NOT NULL,
+         player_index INTEGER NOT NULL,
+         move VARCHAR(8) NOT NULL,
+         PRIMARY KEY (game_id, round, player_index)
+        )''',
+        'ALTER TABLE game ADD COLUMN rounds INTEGER DEFAULT 0',
+        _move_turns_to_move_table,
+        'ALTER TABLE game DROP COLUMN turns',
+    ],
+    [  # 5: Version of every game for optimistic concurrency control
+        'ALTER TABLE game ADD COLUMN version INTEGER NOT NULL DEFAULT 0',
+    ],
+    [  # 6: Change counters per user and for the lobby, kept up to date by triggers
+        '''
+        CREATE TABLE user_version (
+         user_name VARCHAR(64) NOT NULL PRIMARY KEY,
+         version INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID''',
+        '''
+        CREATE TABLE counter (
+         name VARCHAR(64) NOT NULL PRIMARY KEY,
+         value INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID''',
+        "INSERT INTO counter (name) VALUES ('lobby')",
+        'INSERT INTO user_version (user_name) SELECT name FROM user',
+        '''
+        CREATE TRIGGER user_insert_version AFTER INSERT ON user BEGIN
+         INSERT INTO user_version (user_name) VALUES (NEW.name);
+        END''',
+        '''
+        CREATE TRIGGER user_delete_version AFTER DELETE ON user BEGIN
+         DELETE FROM user_version WHERE user_name = OLD.name;
+        END''',
+        '''
+        CREATE TRIGGER player_insert_version AFTER INSERT ON player BEGIN
+         UPDATE user_version SET version = version + 1 WHERE user_name = NEW.user_name;
+        END''',
+        '''
+        CREATE TRIGGER player_delete_version AFTER DELETE ON player BEGIN
+         UPDATE user_version SET version = version + 1 WHERE user_name = OLD.user_name;
+        END''',
+    ] + GAME_TRIGGERS,
+    [  # 7: Never reuse game ids, archived games keep theirs
+        '''
+        CREATE TABLE game_new (
+         id INTEGER PRIMARY KEY AUTOINCREMENT,
+         players INTEGER,
+         goal INTEGER,
+         state INTEGER DEFAULT 0,
+         ts TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+         rounds INTEGER DEFAULT 0,
+         version INTEGER NOT NULL DEFAULT 0
+        )''',
+        'INSERT INTO game_new (id, players, goal, state, ts, rounds, version) '
+        'SELECT rowid, players, goal, state, ts, rounds, version FROM game',
+        'DROP TABLE game',
+        'ALTER TABLE game_new RENAME TO game',
+        'CREATE INDEX game_state_ts ON game (state, ts)',
+    ] + GAME_TRIGGERS,
+    [  # 8: Leaderboard stats per user, kept up to date by every game change, counted from the games played so far
+        '''
+        CREATE TABLE user_stats (
+         user_name VARCHAR(64) NOT NULL PRIMARY KEY,
+         games_played INTEGER NOT NULL DEFAULT 0,
+         wins INTEGER NOT NULL DEFAULT 0,
+         rounds_won INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID''',
+        'CREATE INDEX user_stats_rank ON user_stats (wins DESC, games_played, user_name)',
+        _backfill_user_stats,
+    ],
+    [  # 9: Number of shards the games are split into and the last game id handed out, see shard_games()
+        '''
+        CREATE TABLE sharding (
+         id INTEGER PRIMARY KEY CHECK (id = 1),
+         shards INTEGER NOT NULL DEFAULT 1,
+         last_game_id INTEGER NOT NULL DEFAULT 0
+        )''',
+        'INSERT INTO sharding (id) VALUES (1)',
+    ],
+    [  # 10: Expired sessions are deleted in batches by the archive job
+        'CREATE INDEX session_expires ON session (expires)',
+    ],
+]
+
+TABLES = ['user', 'game', 'player', 'session', 'move', 'user_version', 'counter', 'user_stats', 'sharding']
+
+
+def schema_version(connection):
+    (version,) = connection.execute('PRAGMA user_version').fetchone()
+    return version
+
+
+def migrate(connection):
+    """Apply all migrations the database has not seen yet.
+
+    :param connection: sqlite3.Connection
+    :return: The new schema version
+    """
+    connection.execute('PRAGMA journal_mode = WAL')
+    for version in range(schema_version(connection), len(MIGRATIONS)):
+        connection.execute('BEGIN')
+        try:
+            for step in MIGRATIONS[version]:
+                if callable(step):
+                    step(connection)
+                else:
+                    connection.execute(step)
+            connection.execute('PRAGMA user_version = {}'.format(version + 1))
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+    return schema_version(connection)
+
+
+def reset(connection):
+    """Drop all tables so the next migrate() starts from scratch."""
+    for table in TABLES:
+        connection.execute('DROP TABLE IF EXISTS {}'.format(table))
+    connection.execute('PRAGMA user_version = 0')
+    connection.commit()
+
+
+def backfill_user_stats(connection, archive=None, shards=()):
+    """Rebuild user_stats from the games in the database or its shards, and in the archive.
+
+    The write locks of the database and of every shard are held throughout, so no game changes between being counted
+    and the stats being replaced.
+
+    :param connection: sqlite3.Connection of game.db
+    :param archive: db_sqlite.Archive, or None to count only the games in the hot tables
+    :param shards: sqlite3.Connection of every shard in order, empty if the games are in connection
+    :return: Number of users with stats
+    """
+    locked = []
+    try:
+        for source in [connection, *shards]:
+            source.execute('BEGIN IMMEDIATE')
+            locked.append(source)
+        totals = _count_user_stats(connection, archive, shards)
+        _replace_user_stats(connection, totals)
+        connection.commit()
+    finally:
+        for source in locked:
+            source.rollback()  # Nothing left to roll back in connection once committed
+    return len(totals)
+
+
+def shard_games(connection, shards, archive=None):
+    """Split the games of an unsharded database over its shard files, see db_sharded.
+
+    Games with their players and moves are copied to the shard of their id and deleted from game.db. The number of
+    shards and the largest game id used so far, in the database or in the archive, are recorded in game.db and in every
+    shard, whose new games get larger ids, so no id is used twice. The write locks of all files are held throughout.
+    The shards commit first and copies replace what is there already, so running it again after a crash is safe.
+
+    :param connection: sqlite3.Connection of game.db, at the latest schema version
+    :param shards: sqlite3.Connection of every shard in order, at the latest schema version
+    :param archive: db_sqlite.Archive of game.db, or None if nothing was archived
+    :return: Number of games moved, 0 if the database is split into as many shards already
+    :raise RuntimeError: If the games are split into a different number of shards
+    """
+    count = len(shards)
+    (recorded,) = connection.execute('SELECT shards FROM sharding WHERE id = 1').fetchone()
+    if recorded == count:
+        return 0
+    if recorded != 1:
+        raise RuntimeError('The games are split into {} shards, not {}'.format(recorded, count))
+    locked = []
+    try:
+        for source in [connection, *shards]:
+            source.execute('BEGIN IMMEDIATE')
+            locked.append(source)
+        (last_game_id,) = connection.execute(
+            "SELECT max(ifnull(max(rowid), 0), ifnull((SELECT seq FROM sqlite_sequence WHERE name = 'game'), 0)) "
+            'FROM game'
+        ).fetchone()
+        last_game_id = max(last_game_id, archive.last_game_id() if archive else 0)
+        moved = 0
+        for index, shard in enumerate(shards):
+            (shard_count,) = shard.execute('SELECT shards FROM sharding WHERE id = 1').fetchone()
+            if shard_count not in (1, count):
+                raise RuntimeError('Shard {} belongs to {} shards, not {}'.format(index, shard_count, count))
+            moved += shard.executemany(
+                'INSERT OR REPLACE INTO game (id, players, goal, state, ts, rounds, version) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                connection.execute('SELECT rowid, players, goal, state, ts, rounds, version FROM game '
+                                   'WHERE rowid % ? = ?', [count, index])
+            ).rowcount
+            shard.executemany(  # In joining order, which is rowid order
+                'INSERT OR REPLACE INTO player (game_id, user_name, score, playing) VALUES (?, ?, ?, ?)',
+                connection.execute('SELECT game_id, user_name, score, playing FROM player '
+                                   'WHERE game_id % ? = ? ORDER BY rowid', [count, index])
+            )
+            shard.executemany(
+                'INSERT OR REPLACE INTO move (game_id, round, player_index, move) VALUES (?, ?, ?, ?)',
+                connection.execute('SELECT game_id, round, player_index, move FROM move WHERE game_id % ? = ?',
+                                   [count, index])
+            )
+            shard.execute('INSERT OR IGNORE INTO user_version (user_name) SELECT DISTINCT user_name FROM player')
+            shard.execute('UPDATE sharding SET shards = ?, last_game_id = max(last_game_id, ?) WHERE id = 1',
+                          [count, last_game_id])
+        for table in ('move', 'player', 'game'):
+            connection.execute('DELETE FROM {}'.format(table))
+        connection.execute('UPDATE sharding SET shards = ?, last_game_id = ? WHERE id = 1', [count, last_game_id])
+        for source in [*shards, connection]:
+            source.commit()
+    finally:
+        for source in locked:
+            source.rollback()  # Nothing left to roll back once committed
+    return moved
+
+
+def _exercise(db):
+    """Call every DB and Game method once, with a small amount of data."""
+    db.add_username('alice', 'secret')
+    db.add_username('bob', 'secret')
+    db.user_pass_valid('alice', 'secret')
+    token = db.new_session('alice')
+    db_sqlite.session_cache.invalidate(token)
+    db.session_user(token)
+    db.new_game(2, 10, 'alice')
+    db.get_registering_games_by_user('bob')
+    db.get_registering_players([1])
+    db.updated_games('bob')
+    db.join_game(1, 'bob')
+    storage.Game.load_many(db.get_games_by_user('alice'), db)
+    storage.Game.load_many(db.get_games_by_ids([1]), db)
+    players, goal, state, ts, rounds, version = db.get_game_by_id(1)
+    game = pyramid.Pyramid(1, players, goal, state, ts, rounds, version, db)
+    with db.batch():
+        game.save_move(0, 'r', new_round=True)
+        game.save_game_state()
+    pyramid.Pyramid.load_many(db.get_games_by_ids([1]), db)  # With a round played, so the last turns are loaded
+    game = pyramid.Pyramid(1, players, goal, state, ts, 1, version + 1, db)
+    game.last_turn()
+    game = pyramid.Pyramid(1, players, goal, state, ts, 1, version + 1, db)
+    game.decorated_moves('alice')
+    game.reload()
+    game.save_score_for_player(0)
+    game.save_round_winners([0])
+    game.set_game_over()
+    game.save_game_state()
+    db.leaderboard(limit=10)
+    db.leaderboard('alice', 10)
+    db.quit_game(1, 'bob')
+    db.finished_games(storage.utc_timestamp(), 10)
+    db.abandoned_games(storage.utc_timestamp(), 10)
+    games = db.export_games([1])
+    db.delete_games([(1, games[1][0][5])])
+    for table, columns, rows in db.dump(after=0, limit=10):
+        list(rows)
+    db.delete_session(token)
+    db.delete_expired_sessions(10)
+    db.clear_tables(True)
+
+
+def explain_queries():
+    """Print the query plan of every statement DB and Game run, against a scratch in-memory database.
+
+    Plans that scan a whole table are marked with '!'.
+    """
+    pool = db_sqlite.ConnectionPool(':memory:', size=1)
+    shard_pools = [db_sqlite.ConnectionPool(':memory:', size=1, shard=(index, 2)) for index in range(2)]
+    with db_sqlite.DB(pool) as db, db_sharded.ShardedDB((pool, shard_pools)) as sharded:
+        statements = []
+        for source in [db] + sharded.shards:
+            migrate(source.connection)
+            source.connection.set_trace_callback(statements.append)
+        try:
+            _exercise(db)
+            for shard in sharded.shards:  # Shards take new games in turn, with ids from the sharding table
+                sharded.new_game(2, 10, 'alice')
+        finally:
+            for source in [db] + sharded.shards:
+                source.connection.set_trace_callback(None)
+
+        seen = set()
+        for sql in statements:
+            sql = ' '.join(sql.split())
+            if sql in seen or sql.split(' ', 1)[0].upper() not in ('SELECT', 'INSERT', 'UPDATE', 'DELETE'):
+                continue
+            seen.add(sql)
+            print(sql)
+            for row in db.connection.execute('EXPLAIN QUERY PLAN ' + sql):
+                detail = row[-1]
+                scan = detail.startswith('SCAN') and detail != 'SCAN CONSTANT ROW'
+                print('  {} {}'.format('!' if scan else ' ', detail))
+            print()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create or upgrade the game database.')
+    parser.add_argument('--database', default=db_sqlite.DATABASE)
+    parser.add_argument('--reset', action='store_true', help='drop all tables and data first')
+    parser.add_argument('--explain', action='store_true', help='print query plans instead of migrating')
+    parser.add_argument('--shards', type=int, default=1, help='also create or upgrade this many shard files')
+    parser.add_argument('--backfill-stats', action='store_true',
+                        help='then rebuild the leaderboard stats from the games and the archive')
+    args = parser.parse_args()
+
+    if args.explain:
+        explain_queries()
+    else:
+        shards = db_sharded.shard_paths(args.database, args.shards) if args.shards > 1 else []
+        for database in [args.database] + shards:
+            connection = sqlite3.connect(database)
+            if args.reset:
+                reset(connection)
+            print('{} is at schema version {}'.format(database, migrate(connection)))
+            connection.close()
+        archive = db_sqlite.Archive(os.path.join(os.path.dirname(args.database), db_sqlite.ARCHIVE_DATABASE))
+        connections = [sqlite3.connect(database) for database in [args.database] + shards]
+        try:
+            if shards:
+                moved = shard_games(connections[0], connections[1:], archive)
+                print('{}: games split over {} shards, {} moved'.format(args.database, len(shards), moved))
+            if args.backfill_stats:  # The stats of all games are kept in game.db
+                users = backfill_user_stats(connections[0], archive, connections[1:])
+                print('{}: stats of {} users rebuilt'.format(args.database, users))
+        finally:
+            for connection in connections:
+                connection.close()
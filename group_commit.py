@@ -0,0 +1,173 @@
+"""Group commit: one durable transaction for the changes of many concurrent requests.
+
+Every move, join, quit, new game, registration and session otherwise ends in a commit of its own, so under a burst of
+moves the disk syncs once per request. With group commit, GroupCommitDB hands these changes to a single writer thread
+instead. The writer takes what is queued, waits up to window seconds for more, up to max_batch changes, and applies
+them in one transaction on a connection with synchronous = FULL. Every change runs in a savepoint of its own, so one
+that raises is rolled back alone and its exception is raised in the request that made it. A request returns once the
+transaction holding its change has committed, and the topics of the group are published after that.
+
+Reads stay on the connection of the request. Changes made inside a batch() of the request's own DB do not go through
+the writer, the batch already commits them at once.
+
+    python app.py --group-commit --commit-window 0.002 --commit-batch 64
+"""
+
+import concurrent.futures
+import functools
+import queue
+import threading
+import time
+import traceback
+
+from db_sqlite import DB, savepoint
+
+WINDOW = 0.002  # Seconds the writer waits for more changes after the first one of a group
+MAX_BATCH = 64  # Changes per transaction
+
+_writer = None
+
+
+class GroupCommitWriter(threading.Thread):
+    """Daemon thread applying queued changes in groups, see the module docstring.
+
+    :param pool: ConnectionPool to borrow the writer's connection from, the shared pool if None. The connection is
+        kept until the writer stops.
+    """
+    def __init__(self, pool=None, window=WINDOW, max_batch=MAX_BATCH):
+        super().__init__(name='group-commit', daemon=True)
+        self.db = DB(pool)
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+
+    def submit(self, function, *args):
+        """Call function in the writer thread as part of the next group and wait until the group has committed.
+
+        :return: What function returns
+        """
+        if not self.is_alive():
+            raise RuntimeError('The group commit writer is not running')
+        future = concurrent.futures.Future()
+        self._queue.put((future, function, args))
+        return future.result()
+
+    def _collect(self, first):
+        """Return the group starting with first, ending with None if stop() was called meanwhile."""
+        group = [first]
+        deadline = time.monotonic() + self.window
+        while first is not None and len(group) < self.max_batch:
+            try:
+                item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            group.append(item)
+            if item is None:
+                break
+        return group
+
+    def _apply(self, group):
+        """Make the changes of a group in one transaction and hand each request its result."""
+        outcomes = []
+        try:
+            with self.db.batch():
+                connection = self.db.connection
+                for future, function, args in group:
+                    try:
+                        with savepoint(connection):
+                            outcomes.append((future, function(*args), None))
+                    except Exception as error:
+                        outcomes.append((future, None, error))
+        except Exception as error:  # E.g. the database stayed locked, none of the changes were saved
+            for future, function, args in group:
+                future.set_exception(error)
+            return
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def run(self):
+        self.db.connection.execute('PRAGMA synchronous = FULL')  # A change is acknowledged once it is on disk
+        try:
+            while True:
+                group = self._collect(self._queue.get())
+                stopped = group[-1] is None
+                if stopped:
+                    group.pop()
+                if group:
+                    try:
+                        self._apply(group)
+                    except Exception:
+                        traceback.print_exc()
+                if stopped:
+                    return
+        finally:
+            self.db.connection.execute('PRAGMA synchronous = NORMAL')
+            self.db.close()
+
+    def stop(self):
+        """Apply the changes queued so far and end the thread."""
+        self._queue.put(None)
+        self.join()
+
+
+def start(pool=None, window=WINDOW, max_batch=MAX_BATCH):
+    """Start the writer used by GroupCommitDB objects, stopping a running one first.
+
+    :return: The writer
+    """
+    global _writer
+    stop()
+    _writer = GroupCommitWriter(pool, window, max_batch)
+    _writer.start()
+    return _writer
+
+
+def stop():
+    global _writer
+    if _writer is not None:
+        _writer.stop()
+        _writer = None
+
+
+class GroupCommitDB(DB):
+    """DB making its changes through the writer started with start().
+
+    While the writer runs a change, every DB method uses the writer's connection, so the change joins the writer's
+    transaction.
+    """
+    @property
+    def connection(self):
+        if _writer is not None and threading.current_thread() is _writer:
+            return _writer.db.connection
+        return DB.connection.fget(self)
+
+    def _write(self, method, *args):
+        """Call a DB method through the writer, or directly from the writer or inside a batch() of this DB."""
+        if (_writer is None or threading.current_thread() is _writer
+                or self._connection is not None and self._connection.pending_topics is not None):
+            return method(*args)
+        return _writer.submit(method, *args)
+
+    def add_username(self, username, password):
+        return self._write(super().add_username, username, password)
+
+    def new_session(self, username):
+        return self._write(super().new_session, username)
+
+    def delete_session(self, token):
+        self._write(super().delete_session, token)
+
+    def new_game(self, players, goal, username):
+        self._write(super().new_game, players, goal, username)
+
+    def join_game(self, game_id, username):
+        self._write(super().join_game, game_id, username)
+
+    def quit_game(self, game_id, username):
+        self._write(super().quit_game, game_id, username)
+
+    def change(self, game_id, change, *args, before_retry=None):
+        return self._write(functools.partial(super().change, before_retry=before_retry), game_id, change, *args)
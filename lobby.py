@@ -0,0 +1,89 @@
+"""In-memory index of the games accepting players.
+
+Every ConnectionPool has a Lobby. DB loads it from the database on first use and updates it when it creates, joins or
+quits a game that accepts players, so listing the lobby runs no query over the games. The index remembers the value of
+the database's lobby counter it is current with. Other processes sharing the database move the counter without
+updating the index, so DB loads it again when it finds the counter moved.
+"""
+
+import threading
+
+
+class LobbyGame:
+    """A game accepting players."""
+    __slots__ = ('game_id', 'num_players', 'goal', 'ts', 'version', 'players')
+
+    def __init__(self, game_id, num_players, goal, ts, version, players):
+        self.game_id = game_id
+        self.num_players = num_players
+        self.goal = goal
+        self.ts = ts
+        self.version = version
+        self.players = players  # Names in joining order
+
+    def row(self):
+        """Return (game_id, players, goal, ts, rounds, version) like DB.get_registering_games_by_user()."""
+        return self.game_id, self.num_players, self.goal, self.ts, 0, self.version
+
+
+class Lobby:
+    """Games accepting players by id.
+
+    Hold lock while committing a change to a lobby game and applying it with put() or remove(), so the index sees the
+    changes in the order they were committed.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._games = None  # game id -> LobbyGame, None until loaded
+        self.counter = None  # Lobby counter of the database when the index was current with it, None if unknown
+
+    @property
+    def loaded(self):
+        return self._games is not None
+
+    def load(self, games, counter=None):
+        """Replace the index.
+
+        :param games: Iterable of LobbyGame
+        :param counter: Lobby counter of the database the games were read at
+        """
+        with self.lock:
+            self._games = {game.game_id: game for game in games}
+            self.counter = counter
+
+    def reset(self):
+        """Forget all games, the index is loaded again on next use."""
+        with self.lock:
+            self._games = None
+            self.counter = None
+
+    def advance(self, before, after):
+        """Note that a committed change moved the lobby counter from before to after and has been applied. If the
+        counter had moved since the index was current, someone else changed the lobby and the counter stays behind.
+        """
+        with self.lock:
+            if self.counter is not None and self.counter == before:
+                self.counter = after
+
+    def put(self, game):
+        """Add or replace a game. Ignored until the index is loaded, loading reads the change from the database."""
+        with self.lock:
+            if self._games is not None:
+                self._games[game.game_id] = game
+
+    def remove(self, game_id):
+        with self.lock:
+            if self._games is not None:
+                self._games.pop(game_id, None)
+
+    def players(self, game_id):
+        """Return the names of the players of a game in joining order, empty if the game does not accept players."""
+        with self.lock:
+            game = (self._games or {}).get(game_id)
+        return list(game.players) if game else []
+
+    def games_for(self, username):
+        """Return the games accepting players that username has not joined, newest first."""
+        with self.lock:
+            games = list((self._games or {}).values())
+        return sorted([game for game in games if username not in game.players], key=lambda game: -game.game_id)
@@ -0,0 +1,165 @@
+"""Request and query metrics in the Prometheus text exposition format.
+
+MetricsMiddleware wraps the WSGI application and records latency, count and response size per route. db_sqlite
+records the number and duration of queries per DB method. exposition() renders every metric for /metrics.
+"""
+
+import threading
+import time
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+registry = []
+_local = threading.local()
+
+
+def format_labels(names, values, extra=''):
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """Monotonically increasing value per combination of label values."""
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} counter'.format(self.name)
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield '{}{} {}'.format(self.name, format_labels(self.labels, label_values), value)
+
+
+class Histogram:
+    """Observations counted in cumulative buckets, with their sum and count, per combination of label values."""
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}  # label values -> [count per bucket..., +Inf count, sum]
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} histogram'.format(self.name)
+        with self._lock:
+            values = sorted((label_values, list(counts)) for label_values, counts in self._values.items())
+        for label_values, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield '{}_bucket{} {}'.format(
+                    self.name, format_labels(self.labels, label_values, 'le="{}"'.format(bound)), cumulative
+                )
+            yield '{}_sum{} {}'.format(self.name, format_labels(self.labels, label_values), counts[-1])
+            yield '{}_count{} {}'.format(self.name, format_labels(self.labels, label_values), cumulative)
+
+
+requests_total = Counter('game_requests_total', 'HTTP requests by route and status.', ('route', 'status'))
+request_seconds = Histogram('game_request_duration_seconds', 'Time to serve a request, including streaming the body.',
+                            ('route',))
+response_bytes = Histogram('game_response_size_bytes', 'Size of response bodies.', ('route',), SIZE_BUCKETS)
+query_seconds = Histogram('game_db_query_duration_seconds', 'SQL statements and their duration by DB method.',
+                          ('method',))
+
+
+def record_query(method, seconds):
+    """Record one SQL statement run by method, also counting it for the current thread."""
+    query_seconds.observe(seconds, method)
+    _local.queries = getattr(_local, 'queries', 0) + 1
+
+
+def thread_queries():
+    """Return the number of SQL statements the current thread has run so far."""
+    return getattr(_local, 'queries', 0)
+
+
+def exposition():
+    """Render all metrics in the Prometheus text format, version 0.0.4."""
+    lines = []
+    for metric in registry:
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+
+class MeasuredBody:
+    """Response body that counts the bytes sent and records the request when the server closes it."""
+    def __init__(self, body, route, status, started):
+        self.body = body
+        self.route = route
+        self.status = status
+        self.started = started
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            requests_total.inc(self.route, self.status.get('code', '500'))
+            request_seconds.observe(time.perf_counter() - self.started, self.route)
+            response_bytes.observe(self.size, self.route)
+
+
+class MetricsMiddleware:
+    """WSGI middleware recording per-route latency, request counts and response sizes.
+
+    Paths that are not in routes are recorded as 'other', so arbitrary URLs cannot create unbounded label values.
+    """
+    def __init__(self, app, routes):
+        self.app = app
+        self.routes = set(routes)
+
+    def __call__(self, e, start_response):
+        route = e.get('PATH_INFO') or '/'
+        if route not in self.routes:
+            route = 'other'
+        started = time.perf_counter()
+        status = {}
+
+        def measured_start_response(status_line, headers, exc_info=None):
+            status['code'] = status_line.split(' ', 1)[0]
+            return start_response(status_line, headers, exc_info)
+
+        try:
+            body = self.app(e, measured_start_response)
+        except Exception:
+            requests_total.inc(route, '500')
+            request_seconds.observe(time.perf_counter() - started, route)
+            raise
+        return MeasuredBody(body, route, status, started)
@@ -0,0 +1,150 @@
+"""In-process change notification.
+
+Code that changes a game publishes the topics it touched, e.g. 'lobby', 'game:12' or 'user:alice'. Every publish
+bumps one global counter and stamps the touched topics with it, so the version of a set of topics is the largest
+stamp among them. Pages remember the version they were rendered at and wait on the hub (long-poll) until it moves.
+
+Only requests served by the same process are notified. Other processes sharing the database do not publish here, so
+waiters also pass a changed() function that the hub calls every CHECK_INTERVAL seconds while they wait, e.g. to
+compare the change counters in the database.
+
+Threads wait with wait(). Coroutines wait with wait_async(), which holds no thread, so an event loop can keep
+thousands of long-polls open.
+"""
+
+import asyncio
+import threading
+import time
+
+WAIT_TIMEOUT = 25.0
+CHECK_INTERVAL = 5.0  # Seconds between calls of a waiter's changed()
+MAX_WAITERS = 4
+
+LOBBY = 'lobby'
+RESET = 'reset'  # Published when the tables are cleared, game ids may be reused after it
+
+
+def game_topic(game_id):
+    return 'game:{}'.format(game_id)
+
+
+def user_topic(username):
+    return 'user:{}'.format(username)
+
+
+class Hub:
+    """Versioned topics that requests can wait on."""
+    def __init__(self, max_waiters=MAX_WAITERS):
+        self.max_waiters = max_waiters
+        self._condition = threading.Condition()
+        self._counter = 0
+        self._versions = {}
+        self._waiters = 0
+        self._listeners = []
+        self._async_waiters = {}  # topic -> set of (event loop, asyncio.Event) of coroutines waiting on it
+
+    def subscribe(self, listener):
+        """Call listener(topics) after every publish, e.g. to invalidate caches.
+
+        :param listener: Function taking a tuple of topic names
+        """
+        self._listeners.append(listener)
+
+    def publish(self, *topics):
+        """Mark topics as changed and wake up everybody waiting on them.
+
+        :param topics: Topic names
+        """
+        waiters = set()
+        with self._condition:
+            self._counter += 1
+            for topic in topics:
+                self._versions[topic] = self._counter
+                waiters.update(self._async_waiters.get(topic, ()))
+            self._condition.notify_all()
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:  # Event loop closed
+                pass
+        for listener in self._listeners:
+            listener(topics)
+
+    def version(self, *topics):
+        """Return the version of a set of topics.
+
+        :param topics: Topic names
+        :return: int, 0 if none of the topics has been published
+        """
+        return max([self._versions.get(topic, 0) for topic in topics] or [0])
+
+    def wait(self, topics, version, timeout=WAIT_TIMEOUT, changed=None):
+        """Block until the version of topics differs from version, changed() returns True, or the timeout passes.
+
+        Returns at once without waiting if max_waiters requests are already waiting, so long-polls cannot tie up
+        every worker thread.
+
+        :param topics: Topic names
+        :param version: Version the caller has seen
+        :param timeout: Maximum seconds to wait
+        :param changed: Function called without holding the hub's lock every CHECK_INTERVAL seconds, returning True if
+            what the caller waits for changed without being published here
+        :return: Current version of topics
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            if self._waiters >= self.max_waiters:
+                return self.version(*topics)
+            self._waiters += 1
+        try:
+            while True:
+                check = min(deadline, time.monotonic() + CHECK_INTERVAL) if changed else deadline
+                with self._condition:
+                    while self.version(*topics) == version:
+                        remaining = check - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._condition.wait(remaining)
+                    current = self.version(*topics)
+                if current != version or time.monotonic() >= deadline or not changed or changed():
+                    return current
+        finally:
+            with self._condition:
+                self._waiters -= 1
+
+    async def wait_async(self, topics, version, timeout=WAIT_TIMEOUT, changed=None):
+        """Wait like wait(), but on the running event loop instead of a thread. max_waiters does not apply.
+
+        :param topics: Topic names
+        :param version: Version the caller has seen
+        :param timeout: Maximum seconds to wait
+        :param changed: Coroutine function awaited every CHECK_INTERVAL seconds, like the changed() of wait()
+        :return: Current version of topics
+        """
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._condition:
+            for topic in topics:
+                self._async_waiters.setdefault(topic, set()).add(waiter)
+        deadline = time.monotonic() + timeout
+        try:
+            while self.version(*topics) == version:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), min(remaining, CHECK_INTERVAL) if changed else remaining)
+                except asyncio.TimeoutError:
+                    if changed and await changed():
+                        break
+        finally:
+            with self._condition:
+                for topic in topics:
+                    waiters = self._async_waiters.get(topic)
+                    if waiters is not None:
+                        waiters.discard(waiter)
+                        if not waiters:
+                            del self._async_waiters[topic]
+        return self.version(*topics)
+
+
+hub = Hub()
@@ -0,0 +1,126 @@
+"""Opt-in sampling profiler for single requests.
+
+ProfilingMiddleware picks requests by route, by user or at random, samples the stack of the thread serving each
+picked request every few milliseconds until its body is closed, and writes the samples as collapsed stacks (one
+'frame;frame;frame count' line per distinct stack, the input format of flamegraph.pl and speedscope). File names
+carry the route, the game id and the number of SQL statements the request ran.
+
+Nothing is installed unless the app is started with --profile-dir, so there is no cost when profiling is off.
+"""
+
+import collections
+import http.cookies
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+import urllib.parse
+
+import metrics
+from storage import open_db
+
+INTERVAL = 0.002  # Seconds between samples
+
+_sequence = itertools.count()
+
+
+class Sampler:
+    """Background thread that samples the stack of one other thread."""
+    def __init__(self, thread_id, interval=INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                name = getattr(code, 'co_qualname', code.co_name)
+                stack.append('{}:{}'.format(os.path.basename(code.co_filename), name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+
+class ProfiledBody:
+    """Response body that keeps the sampler running while the body streams and writes the profile on close."""
+    def __init__(self, body, sampler, middleware, e, queries):
+        self.body = body
+        self.sampler = sampler
+        self.middleware = middleware
+        self.e = e
+        self.queries = queries
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.middleware.write(self.e, self.sampler.stop(), metrics.thread_queries() - self.queries)
+
+
+class ProfilingMiddleware:
+    """WSGI middleware profiling a selection of requests.
+
+    :param app: WSGI application
+    :param directory: Where to write the collapsed stack files
+    :param sample_rate: Fraction of all requests to profile
+    :param routes: Always profile requests for these paths
+    :param users: Always profile requests by these users
+    """
+    def __init__(self, app, directory, sample_rate=0.0, routes=(), users=()):
+        self.app = app
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.routes = set(routes)
+        self.users = set(users)
+        os.makedirs(directory, exist_ok=True)
+
+    def _selected(self, e):
+        if e.get('PATH_INFO') in self.routes or random.random() < self.sample_rate:
+            return True
+        if self.users and 'HTTP_COOKIE' in e:
+            cookies = http.cookies.SimpleCookie(e['HTTP_COOKIE'])
+            if 'session' in cookies:
+                with open_db() as db:
+                    return db.session_user(cookies['session'].value) in self.users
+        return False
+
+    def __call__(self, e, start_response):
+        if not self._selected(e):
+            return self.app(e, start_response)
+        queries = metrics.thread_queries()
+        sampler = Sampler(threading.get_ident())
+        try:
+            body = self.app(e, start_response)
+        except Exception:
+            sampler.stop()
+            raise
+        return ProfiledBody(body, sampler, self, e, queries)
+
+    def write(self, e, stacks, queries):
+        """Write collapsed stacks to a file named after the time, route, game id and query count."""
+        route = (e.get('PATH_INFO') or '/').strip('/').replace('/', '_') or 'root'
+        game_id = urllib.parse.parse_qs(e.get('QUERY_STRING', '')).get('id', [''])[0]
+        name = '{}-{}-{}-game{}-q{}.collapsed'.format(
+            time.strftime('%Y%m%d-%H%M%S'), next(_sequence), route,
+            ''.join(c for c in game_id if c.isalnum()) or '-', queries
+        )
+        with open(os.path.join(self.directory, name), 'w') as f:
+            for stack, count in sorted(stacks.items()):
+                f.write('{} {}\n'.format(stack, count))
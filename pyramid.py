@@ -4,10 +4,56 @@ The code below is still the same as for Rock-Paper-Scissors.
 Modify to implement the Pyramid game.
 """
 
-from db_sqlite import Game
+import itertools
+
+from cache import LRUCache
+from storage import Game, NO_MOVE
+from notify import hub, RESET
+
+ROCK, PAPER, SCISSORS = range(3)  # Move codes, indexes into Pyramid.MOVES
+MOVE_NAMES = ('Rock', 'Paper', 'Scissors')
+BEATS = {ROCK: {SCISSORS}, PAPER: {ROCK}, SCISSORS: {PAPER}}  # The moves each move beats
+DECORATED_CACHE_SIZE = 1000
+
+_outcomes = {}  # Number of players -> outcome table
+
+# Game id -> decorated complete rounds. Complete rounds never change, so pages only decorate rounds added since.
+decorated_rounds = LRUCache(DECORATED_CACHE_SIZE)
+
+
+def _clear_decorated_rounds(topics):
+    if RESET in topics:  # Game ids are reused once the tables are cleared
+        decorated_rounds.clear()
+
+
+hub.subscribe(_clear_decorated_rounds)
+
+
+def outcome_table(num_players):
+    """Return the outcome of every possible round for a number of players, building the table on first use.
+
+    A player wins a round if their move beats at least one of the other moves and none of the other moves beats it.
+
+    :param num_players: Moves in a round
+    :return: Dict mapping a tuple of move codes to a tuple with True for every player who wins
+    """
+    table = _outcomes.get(num_players)
+    if table is None:
+        table = {}
+        for turn in itertools.product(range(len(MOVE_NAMES)), repeat=num_players):
+            table[turn] = tuple(
+                any(other in BEATS[move] for other in turn) and not any(move in BEATS[other] for other in turn)
+                for move in turn
+            )
+        _outcomes[num_players] = table
+    return table
 
 
 class Pyramid(Game):
+    __slots__ = ()
+
+    MOVES = ('r', 'p', 's')
+
     def valid_moves(self, username):
         """Return list of pairs with valid moves for this player and how to display them.
 
@@ -22,82 +68,84 @@ class Pyramid(Game):
 
         :param username: Username of player who moves
         :param move: One of the strings 'r', 'p', 's'
+        :return: True if the move was made, False if it was discarded
         """
+        return self.change(self._add_player_move, username, move)
+
+    def _add_player_move(self, username, move):
         # Discard move if Game not in play (i.e. state != 1), or the move is not r(ock), p(aper) or s(cissors)
-        if self.state != 1 or move not in ('r', 'p', 's'):
-            return
+        if self.state != 1 or move not in self.MOVE_CODES:
+            return False
 
         # Find the index (position) of this player in the list of players in the game.
         # In the case of RPS games this value will be 0 or 1 since RPS always has 2 players.
         index = self.player_index(username)
 
         # If there are no game rounds yet, or the last one is complete
-        if not self.turns or not [None for m in self.turns[-1] if m is None]:  # No turns or last complete
-            new_turn = [None] * len(self.players)
-            new_turn[index] = move
-            self.turns.append(new_turn)
+        last_turn = self.last_turn()
+        if not last_turn or NO_MOVE not in last_turn:  # No turns or last complete
+            self.save_move(index, move, new_round=True)
             self.save_game_state()
+            return True
 
         # If opponent(s) moved in last round but user has not
-        elif self.turns[-1][index] is None:
-            last_turn = self.turns[-1]
-            last_turn[index] = move
+        elif last_turn[index] == NO_MOVE:
+            self.save_move(index, move)
             # Check if turn is complete and if so calculate scores
-            if not [None for m in last_turn if m is None]:
-                if last_turn in (['p', 'r'], ['s', 'p'], ['r', 's']):
-                    self.players[0]['score'] += 1
-                    self.save_score_for_player(0)
-                    if self.players[0]['score'] == self.goal:
-                        self.set_game_over()
-                elif last_turn in (['r', 'p'], ['p', 's'], ['s', 'r']):
-                    self.players[1]['score'] += 1
-                    self.save_score_for_player(1)
-                    if self.players[1]['score'] == self.goal:
-                        self.set_game_over()
+            last_turn = tuple(self.last_turn())
+            if NO_MOVE not in last_turn:
+                winners = [index for index, wins in enumerate(outcome_table(len(last_turn))[last_turn]) if wins]
+                for winner in winners:
+                    self.players[winner].score += 1
+                    self.save_score_for_player(winner)
+                self.save_round_winners(winners)
+                if any(self.players[winner].score == self.goal for winner in winners):  # After all scores are saved
+                    self.set_game_over()
             self.save_game_state()
+            return True
+        return False
 
     def decorated_moves(self, username):
         """Return a list of moves with formatting information.
 
+        Complete rounds are decorated once per game and kept in decorated_rounds. Only rounds completed since are
+        loaded and decorated, plus the incomplete latest round, which depends on who is viewing.
+
         :param username: Player's username
         :return: Formatted list of moves
         """
-        if not self.turns:
-            return []
-
-        last_turn = self.turns[-1]
-        if [None for m in last_turn if m is None]:  # Everybody has not yet moved in last turn, it is incomplete
-            incomplete_last_turn = last_turn
-            complete_turns = self.turns[:-1]
-        else:
-            incomplete_last_turn = None
-            complete_turns = self.turns
-
-        translate = {'r': 'Rock', 'p': 'Paper', 's': 'Scissors'}
-        decorated_turns = []
-
-        for turn in complete_turns:
-            if turn in (['p', 'r'], ['s', 'p'], ['r', 's']):
-                decorated_turns.append([(translate[turn[0]], True), (translate[turn[1]], False)])
-            elif turn in (['r', 'p'], ['p', 's'], ['s', 'r']):
-                decorated_turns.append([(translate[turn[0]], False), (translate[turn[1]], True)])
-            else:
-                decorated_turns.append([(translate[turn[0]], False), (translate[turn[1]], False)])
+        decorated_turns = decorated_rounds.get(self.id)
+        if decorated_turns is None or len(decorated_turns) > self.rounds:
+            decorated_turns = []
+        turns = self.turns_from(len(decorated_turns))
+        if not turns:
+            return decorated_turns
+
+        incomplete_last_turn = turns.pop() if NO_MOVE in turns[-1] else None  # Not everybody has moved yet
+        if turns:
+            decorated_turns = decorated_turns + [self._decorate(turn) for turn in turns]
+            decorated_rounds.put(self.id, decorated_turns)
 
         if incomplete_last_turn:
             index = self.player_index(username)
             decorated_last_turn = []
             for i, m in enumerate(incomplete_last_turn):
-                if m is None:
+                if m == NO_MOVE:
                     decorated_last_turn.append(('', False))
-                elif i == index or incomplete_last_turn[index]:
-                    decorated_last_turn.append((translate[m], False))
+                elif i == index or incomplete_last_turn[index] != NO_MOVE:
+                    decorated_last_turn.append((MOVE_NAMES[m], False))
                 else:
                     decorated_last_turn.append(('?', False))
-            decorated_turns.append(decorated_last_turn)
+            decorated_turns = decorated_turns + [decorated_last_turn]
 
         return decorated_turns
 
+    @staticmethod
+    def _decorate(turn):
+        """Pair every move of a complete round with whether it won."""
+        turn = tuple(turn)
+        return tuple(zip([MOVE_NAMES[m] for m in turn], outcome_table(len(turn))[turn]))
+
     def is_players_turn(self, username):
         """Check if it is player's turn.
 
@@ -106,11 +154,11 @@ class Pyramid(Game):
         """
         if self.state != 1:  # Game not in play
             return False
-        if not self.turns:  # Nobody has made any moves yet
+        latest_turn = self.last_turn()
+        if not latest_turn:  # Nobody has made any moves yet
             return True
 
-        latest_turn = self.turns[-1]
-        if not latest_turn[self.player_index(username)]:  # User not yet moved in latest turn
+        if latest_turn[self.player_index(username)] == NO_MOVE:  # User not yet moved in latest turn
             return True
-        if not [None for m in latest_turn if m is None]:  # Latest turn is complete, start new turn
+        if NO_MOVE not in latest_turn:  # Latest turn is complete, start new turn
             return True
@@ -0,0 +1,369 @@
+"""HTML rendering for the web app.
+
+Pages are generators of str fragments, and stream() turns them into encoded chunks for the WSGI response, so a big
+page starts going out right away and is never held as one string. The templates below are bound to str.format once,
+when the module is imported. The JSON API gets plain dicts, see the end of the module.
+"""
+
+import csv
+import io
+import json
+import urllib.parse
+
+from storage import NO_MOVE
+
+CHUNK_SIZE = 8192
+
+HEADER = '''<!DOCTYPE html>
+<html><head><title>Game</title>
+<style>
+    table { border-collapse: collapse; }
+    table, th, td { border: 1px solid silver; padding: 2px; }
+</style>
+</head>
+<body>
+<h1>Rock-Paper-Scissors</h1>'''
+
+FOOTER = '</body></html>'
+
+# Long-poll the wait URL (prefix of a query string) and reload the page once the version changes. Answers that come
+# back quickly without a change mean the server is not holding requests open, so fall back to polling every second.
+long_poll_script = '''
+<script>
+    function poll(version) {{
+        var started = Date.now()
+        var xmlhttp = new XMLHttpRequest();
+        xmlhttp.addEventListener("readystatechange", function (event) {{
+            if (event.target.readyState != 4) {{
+                return
+            }}
+            if (event.target.status == 200 && event.target.responseText != version) {{
+                window.location = '{1}'
+            }} else {{
+                setTimeout(poll, Date.now() - started < 1000 ? 1000 : 0, version)
+            }}
+        }})
+        xmlhttp.open("GET", "{2}v=" + version, true)
+        xmlhttp.setRequestHeader("Content-Type", "text/plain")
+        xmlhttp.send()
+    }}
+    poll('{0}')
+</script>'''.format
+
+# ----- Root page -----------------------------------------
+
+root_top = '''{0} | <a href="{1}/leaderboard">Leaderboard</a> | <a href="{1}/logout">Logout</a><h2>My games</h2>
+<table><tr><th>Game</th><th>Goal</th><th>Quit</th><th>State</th><th>Players</th></tr>
+'''.format
+my_game_start = '<tr><td>{0}</td><td>{1}</td><td><a href="{2}/quit?id={0}">quit</a></td>'.format
+my_game_awaiting = '<td>Awaiting {}</td><td>{}</td></tr>\n'.format
+my_game_link = '<td><a href="{}/game?id={}">{}</a></td><td>{}</td></tr>\n'.format
+player_score = '{}{}|{}{}'.format
+root_middle = '''</table><p><a href="{}/newgame">Start a New Game</a></p><h2>Games accepting players</h2>
+<table><tr><th>Game</th><th>Goal</th><th>Join</th><th>State</th><th>Players</th></tr>
+'''.format
+lobby_game = ('<tr><td>{0}</td><td>{1}</td><td><a href="{2}/join?id={0}">join</a></td>'
+              '<td>{3} of {4} players</td><td>{5}</td></tr>\n').format
+
+# ----- Game page -----------------------------------------
+
+game_top = '<a href="{}">Home</a><h3>Game {} -- Play to {}</h3>'.format
+move_link = '<a href="{}/game?id={}&amp;move={}">{}</a>'.format
+player_heading = '<th>{}</th>'.format
+quit_player_heading = '<th><s>{}</s></th>'.format
+score_cell = '<td>{} p</td>'.format
+round_start = '<tr><td>{}</td>'.format
+move_cell = '<td>{}</td>'.format
+winning_move_cell = '<td style="background-color:lightgreen">{}</td>'.format
+
+# ----- Leaderboard ---------------------------------------
+
+leaderboard_top = '''<a href="{}">Home</a><h2>Leaderboard</h2>
+<table><tr><th>Rank</th><th>Player</th><th>Wins</th><th>Games</th><th>Win rate</th><th>Rounds won</th></tr>
+'''.format
+leaderboard_row = '<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>\n'.format
+more_players = '<p><a href="{}/leaderboard?after={}&amp;rank={}">More players</a></p>\n'.format
+
+# ----- Dump ----------------------------------------------
+
+dump_top = ('<a href="{0}">Home</a> | <a href="{0}/clear_games">Clear games and players</a>'
+            ' | <a href="{0}/clear_all">Clear all</a>').format
+table_start = '<h2>Table "{}"</h2>\n<p>{}</p>\n<table><tr>{}</tr>\n'.format
+heading = '<th>{}</th>'.format
+cell = '<td>{}</td>'.format
+more_rows = '<p><a href="{}/dump?table={}&amp;after={}&amp;limit={}">More rows</a></p>\n'.format
+
+TABLE_DESCRIPTIONS = {
+    'user': 'Contains all registered users and their passwords.',
+    'game': 'One row for every game.',
+    'player': 'Connects players with games. One row for every player in a game.',
+    'move': 'One row for every move in a game.',
+}
+
+
+def stream(fragments, chunk_size=CHUNK_SIZE):
+    """Encode str fragments and yield them in chunks of roughly chunk_size bytes.
+
+    :param fragments: Iterable of str
+    :param chunk_size: Minimum size of every chunk but the last
+    :return: Generator of bytes
+    """
+    buffer = []
+    size = 0
+    for fragment in fragments:
+        buffer.append(fragment)
+        size += len(fragment)
+        if size >= chunk_size:
+            yield ''.join(buffer).encode()
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer).encode()
+
+
+def root_page(app_root, username, games, lobby_games, version):
+    """Render the list of the user's games and the games accepting players.
+
+    :param app_root: URL of the app
+    :param username: Logged in user
+    :param games: Games the user plays in
+    :param lobby_games: Games accepting players that the user has not joined
+    :param version: Change version the page is rendered at
+    :return: Generator of str
+    """
+    yield HEADER
+    yield root_top(username, app_root)
+    for game in games:
+        yield my_game_start(game.id, game.goal, app_root)
+        if game.state == 0:  # Accepting players
+            yield my_game_awaiting(game.num_players - len(game.players), ', '.join([p.name for p in game.players]))
+            continue
+        if game.state == 2:
+            state = 'Game over'
+        elif game.is_players_turn(username):
+            state = 'My turn'
+        else:
+            state = 'Awaiting Turn'
+        players_scores = ', '.join([
+            player_score(
+                '' if p.playing else '<s>',  # Add open strikethrough tag if player left game
+                p.name,
+                p.score,
+                '' if p.playing else '</s>'  # Add close strikethrough tag
+            ) for p in game.players
+        ])
+        yield my_game_link(app_root, game.id, state, players_scores)
+    yield root_middle(app_root)
+    for game in lobby_games:
+        yield lobby_game(game.id, game.goal, app_root, len(game.players), game.num_players,
+                         ', '.join([p.name for p in game.players]))
+    yield '</table>'
+    yield long_poll_script(version, app_root, '{}/wait_games?'.format(app_root))
+    yield FOOTER
+
+
+def game_page(app_root, game, username, version):
+    """Render a game with its moves, newest round first.
+
+    :param app_root: URL of the app
+    :param game: Pyramid game
+    :param username: Logged in user viewing the game
+    :param version: Change version the page is rendered at
+    :return: Generator of str
+    """
+    yield HEADER
+    yield game_top(app_root, game.id, game.goal)
+
+    if game.state == 2:
+        yield '<p>Game over</p>'
+    elif game.is_players_turn(username):
+        yield '<p>Your move: '
+        yield ' | '.join([move_link(app_root, game.id, mval, mname) for mval, mname in game.valid_moves(username)])
+    else:
+        yield '<p>Wait for your turn</p>'
+
+    yield '<table>\n<tr><th>&nbsp;</th>'
+    for p in game.players:
+        yield player_heading(p.name) if p.playing else quit_player_heading(p.name)
+    yield '</tr>\n<tr style="background-color: silver"><td>Round</td>'
+    for p in game.players:
+        yield score_cell(p.score)
+    yield '</tr>\n'
+
+    for index, turn in enumerate(reversed(game.decorated_moves(username))):
+        yield round_start(game.rounds - index)
+        for move, winner in turn:
+            yield winning_move_cell(move) if winner else move_cell(move)
+        yield '</tr>\n'
+    yield '</table>'
+
+    if game.state == 1:
+        yield long_poll_script(
+            version, '{}/game?id={}'.format(app_root, game.id), '{}/wait_game?id={}&'.format(app_root, game.id)
+        )
+    yield FOOTER
+
+
+def win_rate(games_played, wins):
+    """Fraction of finished games won, None before the first one."""
+    return round(wins / games_played, 3) if games_played else None
+
+
+def leaderboard_page(app_root, rows, rank=1, limit=None):
+    """Render a page of the leaderboard.
+
+    :param app_root: URL of the app
+    :param rows: (user_name, games_played, wins, rounds_won) rows as returned by Storage.leaderboard()
+    :param rank: Rank of the first user on the page
+    :param limit: Users on one page. A full page gets a link to the next one.
+    :return: Generator of str
+    """
+    yield HEADER
+    yield leaderboard_top(app_root)
+    for offset, (name, games_played, wins, rounds_won) in enumerate(rows):
+        rate = win_rate(games_played, wins)
+        yield leaderboard_row(rank + offset, name, wins, games_played, '-' if rate is None else '{:.0%}'.format(rate),
+                              rounds_won)
+    yield '</table>\n'
+    if limit and len(rows) == limit:
+        yield more_players(app_root, urllib.parse.quote(rows[-1][0]), rank + len(rows))
+    yield FOOTER
+
+
+def dump_page(app_root, tables, limit=None):
+    """Render the contents of tables.
+
+    :param app_root: URL of the app
+    :param tables: (table, columns, rows) triples as returned by DB.dump()
+    :param limit: Rows per table on one page. Tables that fill it get a link to the next page.
+    :return: Generator of str
+    """
+    yield HEADER
+    yield dump_top(app_root)
+    for name, columns, rows in tables:
+        yield table_start(name, TABLE_DESCRIPTIONS[name], ''.join([heading(column) for column in columns]))
+        count = 0
+        rowid = 0
+        for row in rows:
+            yield '<tr>' + ''.join([cell(value) for value in row]) + '</tr>\n'
+            count += 1
+            rowid = row[0]
+        yield '</table>\n'
+        if limit and count == limit:
+            yield more_rows(app_root, name, rowid, limit)
+    yield FOOTER
+
+
+def dump_ndjson(tables):
+    """Export rows as newline delimited JSON, one object per row with its table name.
+
+    :param tables: (table, columns, rows) triples as returned by DB.dump()
+    :return: Generator of str
+    """
+    for name, columns, rows in tables:
+        for row in rows:
+            record = dict(zip(columns, row))
+            record['table'] = name
+            yield json.dumps(record) + '\n'
+
+
+def dump_csv(columns, rows):
+    """Export the rows of one table as CSV with a header line.
+
+    :param columns: Column names
+    :param rows: Row tuples
+    :return: Generator of str
+    """
+    line = io.StringIO()
+    writer = csv.writer(line)
+    writer.writerow(columns)
+    yield line.getvalue()
+    for row in rows:
+        line.seek(0)
+        line.truncate()
+        writer.writerow(row)
+        yield line.getvalue()
+
+
+# ----- JSON API ------------------------------------------
+
+def to_json(data):
+    """Encode data as compact JSON bytes."""
+    return json.dumps(data, separators=(',', ':')).encode()
+
+
+def player_json(player):
+    return [player.name, player.score, bool(player.playing)]
+
+
+def games_json(username, games, lobby_games):
+    """The user's games and the games accepting players, the data of the root page.
+
+    :param username: Logged in user
+    :param games: Games the user plays in
+    :param lobby_games: Games accepting players that the user has not joined
+    :return: Dict
+    """
+    return {
+        'games': [{
+            'id': game.id,
+            'goal': game.goal,
+            'state': game.state,
+            'turn': bool(game.is_players_turn(username)),
+            'players': [player_json(p) for p in game.players],
+        } for game in games],
+        'lobby': [{
+            'id': game.id,
+            'goal': game.goal,
+            'seats': game.num_players - len(game.players),
+            'players': [p.name for p in game.players],
+        } for game in lobby_games],
+    }
+
+
+def leaderboard_json(rows, limit=None):
+    """A page of the leaderboard.
+
+    :param rows: (user_name, games_played, wins, rounds_won) rows as returned by Storage.leaderboard()
+    :param limit: Users on one page. For a full page, next is the name to ask for the next page after.
+    :return: Dict
+    """
+    return {
+        'players': [{
+            'name': name,
+            'games': games_played,
+            'wins': wins,
+            'win_rate': win_rate(games_played, wins),
+            'rounds_won': rounds_won,
+        } for name, games_played, wins, rounds_won in rows],
+        'next': rows[-1][0] if limit and len(rows) == limit else None,
+    }
+
+
+def game_json(game, username, since=0):
+    """State of a game for a player.
+
+    Moves are one string per round from round since on, with one character per player: the move, '-' if the player
+    has not moved yet, or '?' for a move of the unfinished round that the user sees only after making their own.
+
+    :param game: Pyramid game the user plays in
+    :param username: Logged in user
+    :param since: First round to include, so clients only fetch rounds they do not have yet
+    :return: Dict
+    """
+    index = game.player_index(username)
+    since = max(0, min(since, game.rounds))
+    moves = []
+    for turn in game.turns_from(since):
+        hidden = turn[index] == NO_MOVE
+        moves.append(''.join(['-' if m == NO_MOVE else '?' if hidden else game.MOVES[m] for m in turn]))
+    return {
+        'id': game.id,
+        'goal': game.goal,
+        'state': game.state,
+        'rounds': game.rounds,
+        'turn': bool(game.is_players_turn(username)),
+        'players': [player_json(p) for p in game.players],
+        'since': since,
+        'moves': moves,
+    }
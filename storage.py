@@ -0,0 +1,520 @@
+"""Storage interface of the game app.
+
+The app, the archive job and the games talk to storage only through Storage objects, so backends can be swapped
+without touching them. db_sqlite.DB keeps everything in SQLite files, db_memory.MemoryDB in dicts of the running
+process, without any disk I/O. open_db() returns an object of the backend chosen with configure(), SQLite unless
+configured otherwise.
+"""
+
+import abc
+import array
+import datetime
+
+NO_MOVE = -1  # Move code of a player who has not moved in a round
+
+# Tables and columns shown by Storage.dump(), in display order
+DUMP_COLUMNS = {
+    'user': ['name', 'password'],
+    'game': ['players', 'goal', 'state', 'ts', 'rounds'],
+    'player': ['game_id', 'user_name', 'score', 'playing'],
+    'move': ['game_id', 'round', 'player_index', 'move'],
+}
+
+_backend = None
+
+
+class ConflictError(Exception):
+    """Raised when a game was changed by someone else after it was read."""
+
+
+def utc_timestamp(days=0):
+    """Current time, or the time so many days from now, in the format of SQLite's datetime()."""
+    moment = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=days)
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def configure(backend):
+    """Choose the backend of the Storage objects returned by open_db().
+
+    :param backend: Callable returning a new Storage object, e.g. db_sqlite.DB or db_memory.MemoryDB
+    """
+    global _backend
+    _backend = backend
+
+
+def open_db():
+    """Return a new Storage object of the configured backend, to be closed when done with it."""
+    if _backend is None:
+        import db_sqlite  # Not at the top, db_sqlite imports this module
+        configure(db_sqlite.DB)
+    return _backend()
+
+
+class Storage(abc.ABC):
+    """Persistence operations of the app and of Game, implemented by every backend.
+
+    A Storage object is used by one thread at a time. Game ids are ints, but methods also accept them as str from
+    query strings. Timestamps are str in the format of utc_timestamp(). Changes are committed before a method returns
+    and then published on the hub, except for the game changes Game makes through change() and batch(). A backend
+    implements every abstract method, it cannot be instantiated otherwise.
+    """
+    def close(self):
+        """Hand back resources held since first use. The object can still be used afterwards."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # ----- Users and sessions -----------------------------------------------
+
+    @abc.abstractmethod
+    def user_pass_valid(self, username, password):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add_username(self, username, password):
+        """Register a user.
+
+        :return: False if the name is taken
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def new_session(self, username):
+        """Create a session for a user who has logged in.
+
+        :return: Opaque session token
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def session_user(self, token):
+        """Return the user a session token belongs to, None if the token is unknown or expired."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_session(self, token):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_expired_sessions(self, limit):
+        """Delete at most limit sessions that have expired, in one transaction.
+
+        :return: Number of sessions deleted
+        """
+        raise NotImplementedError
+
+    # ----- Games ------------------------------------------------------------
+
+    @abc.abstractmethod
+    def get_game_by_id(self, game_id):
+        """Return (players, goal, state, ts, rounds, version) of a game, None if there is no such game."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_games_by_ids(self, game_ids):
+        """Return (game_id, players, goal, state, ts, rounds, version) rows of games in id order."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_games_by_user(self, username):
+        """Return (game_id, players, goal, state, ts, rounds, version) rows of the games username plays, in id order."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_registering_games_by_user(self, username):
+        """Return (game_id, players, goal, ts, rounds, version) rows of the games username can join, newest first."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_registering_players(self, game_ids):
+        """Return the players of games accepting players, like get_players()."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def new_game(self, players, goal, username):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def join_game(self, game_id, username):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def quit_game(self, game_id, username):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def updated_games(self, username):
+        """Return (user version, lobby version), changing whenever a game of the user or the lobby changes."""
+        raise NotImplementedError
+
+    # ----- Game state, used by Game -----------------------------------------
+
+    def for_game(self, game_id):
+        """Return the Storage that the Game object of a game uses, self unless a backend splits up its games."""
+        return self
+
+    @abc.abstractmethod
+    def get_players(self, game_ids):
+        """Return a dict mapping game id to a list of (user_name, score, playing) rows in joining order."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_last_turns(self, game_ids):
+        """Return a dict mapping game id to the (player_index, move) rows of its latest round."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_moves(self, game_id, first_round, rounds):
+        """Return the (round, player_index, move) rows of rounds first_round up to, not including, rounds."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def change(self, game_id, change, *args, before_retry=None):
+        """Make a change to a game that ends with save_game_state(), rolled back if it raises.
+
+        :param game_id: Game being changed
+        :param change: Function making the change, started over when it raises ConflictError
+        :param before_retry: Function called before starting over, e.g. to read the game again
+        :return: What change returns
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def batch(self, game_ids=None):
+        """Context manager saving the changes of every game changed inside the block at once, or none of them if the
+        block raises.
+
+        Games read inside the block cannot be changed by anyone else before the batch ends. Topics are published
+        when it ends.
+
+        :param game_ids: Games the block changes, None if it may change any. Backends that split up their games only
+            lock the parts holding these.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add_move(self, game_id, round_index, index, move):
+        """Save a move, raising ConflictError if the player has moved in that round already."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def save_score(self, game_id, username, score):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def end_game(self, game_id):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add_round_wins(self, game_id, usernames):
+        """Count a won round in the stats of each of usernames."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add_game_results(self, game_id, usernames, winners):
+        """Count a finished game in the stats of each of usernames, and a won one in the stats of those in winners."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def save_game_state(self, game_id, rounds, ts, version, usernames):
+        """Save the rounds and ts of a game and commit the changes made since change() started.
+
+        :param version: Version the game was read at, raises ConflictError if it is no longer current
+        :param usernames: Players of the game, whose topics are published
+        """
+        raise NotImplementedError
+
+    # ----- Archive ----------------------------------------------------------
+
+    @abc.abstractmethod
+    def finished_games(self, before, limit):
+        """Return (game_id, version) of at most limit games that were over before the given time, oldest first."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def abandoned_games(self, before, limit):
+        """Return (game_id, version) of at most limit games that have accepted players, without anyone joining or
+        quitting, since before the given time.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def export_games(self, game_ids):
+        """Read everything about games, for the archive.
+
+        :return: Dict mapping game id to (game row, player rows, move rows), the game row as returned by
+            get_game_by_id() and move rows being (round, player_index, move)
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_games(self, games):
+        """Delete games with their players and moves, skipping games that changed since their version was read.
+
+        :param games: (game_id, version) pairs
+        :return: Ids of the deleted games
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def archive_games(self, games):
+        """Store games in the archive, replacing earlier copies of them.
+
+        :param games: Dict as returned by export_games()
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_archived_game(self, game_id):
+        """Return (game row, player rows, move rows) of an archived game like export_games(), None if not archived."""
+        raise NotImplementedError
+
+    # ----- Leaderboard ------------------------------------------------------
+
+    @abc.abstractmethod
+    def leaderboard(self, after=None, limit=None):
+        """Return the stats of users by rank: most wins first, then fewest games played, then by name.
+
+        Stats are kept up to date by every game change, so a page costs the same however many games were played.
+
+        :param after: Name of the user the previous page ended with, for keyset pagination
+        :param limit: Maximum number of users, or None for all
+        :return: List of (user_name, games_played, wins, rounds_won) rows
+        """
+        raise NotImplementedError
+
+    # ----- Administration ---------------------------------------------------
+
+    @abc.abstractmethod
+    def dump_table(self, table, after=0, limit=None):
+        """Iterate over the rows of a table in rowid order.
+
+        :param table: One of DUMP_COLUMNS
+        :param after: Only rows with a larger rowid, for keyset pagination
+        :param limit: Maximum number of rows, or None for all
+        :return: Iterable of tuples starting with the rowid, followed by the DUMP_COLUMNS of the table
+        """
+        raise NotImplementedError
+
+    def dump(self, tables=None, after=0, limit=None):
+        """Return the rows of several tables, see dump_table().
+
+        :param tables: Table names, all of DUMP_COLUMNS if None
+        :return: List of (table, columns, rows) triples, columns including rowid
+        """
+        return [
+            (table, ['rowid'] + DUMP_COLUMNS[table], self.dump_table(table, after, limit))
+            for table in (tables or DUMP_COLUMNS)
+        ]
+
+    @abc.abstractmethod
+    def clear_tables(self, clear_all):
+        """Delete all games and stats, and with clear_all all users and sessions too."""
+        raise NotImplementedError
+
+
+class Player:
+    """One player of a game."""
+    __slots__ = ('name', 'score', 'playing')
+
+    def __init__(self, name, score, playing):
+        self.name = name
+        self.score = score
+        self.playing = playing
+
+
+class Game:
+    """Base functionality for game classes.
+
+    Moves are stored one per move by the storage backend. Rounds are loaded lazily: the latest round on its own for
+    checking whose turn it is, the full history only when something asks for turns. In memory the loaded rounds are
+    one array of move codes, a round being one code per player. A move's code is its index in MOVES and a player who
+    has not moved yet has NO_MOVE.
+    """
+    __slots__ = ('id', 'num_players', 'goal', 'state', 'ts', 'rounds', 'version', 'db', 'players', '_index',
+                 '_moves', '_first_round')
+
+    MOVES = ()  # Moves of the game as stored, subclasses list theirs
+    MOVE_CODES = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.MOVE_CODES = {move: code for code, move in enumerate(cls.MOVES)}
+
+    def __init__(self, game_id, num_players, goal, state, ts, rounds, version, db, players=None, last_turn=None,
+                 moves=None):
+        """Initialize game object with state and players.
+
+        :param rounds: Number of rounds started
+        :param version: Incremented by every change to the game, checked when saving it
+        :param db: Storage, None for an archived game given with all of its players and moves. The game uses
+            db.for_game(game_id).
+        :param players: Prefetched (user_name, score, playing) rows. Loaded from storage if None.
+        :param last_turn: Prefetched (player_index, move) rows of the latest round. Loaded when needed if None.
+        :param moves: Prefetched (round, player_index, move) rows of all rounds, instead of last_turn
+        """
+        self.id = game_id
+        self.db = db and db.for_game(game_id)
+        self._set_state(num_players, goal, state, ts, rounds, version, players)
+        if moves is not None:
+            self._load(0, moves)
+        elif last_turn is not None and rounds:
+            self._load(rounds - 1, [(rounds - 1, index, move) for index, move in last_turn])
+
+    def _set_state(self, num_players, goal, state, ts, rounds, version, players):
+        self.num_players = num_players
+        self.goal = goal
+        self.state = state  # 0={Registering players}, 1={Game on}, 2={Game over}
+        self.ts = ts
+        self.rounds = rounds
+        self.version = version
+
+        if players is None:
+            players = self.db.get_players([self.id])[self.id]
+        self.players = [Player(*row) for row in players]
+        self._index = {player.name: index for index, player in enumerate(self.players)}
+
+        self._moves = array.array('b')  # Move codes of rounds _first_round up to rounds, one per player and round
+        self._first_round = rounds
+
+    def reload(self):
+        """Read the game again, dropping all changes that were not saved."""
+        self._set_state(*self.db.get_game_by_id(self.id), None)
+
+    @property
+    def read_only(self):
+        """True for an archived game, which was loaded without storage and cannot change."""
+        return self.db is None
+
+    def change(self, change, *args):
+        """Make a change to the game that ends with save_game_state(), starting over on the game as it is in storage
+        when someone else saved it first.
+
+        :param change: Method of the game
+        :return: What change returns, False for a read-only game
+        """
+        if self.read_only:
+            return False
+        return self.db.change(self.id, change, *args, before_retry=self.reload)
+
+    @classmethod
+    def load_many(cls, rows, db, players=None):
+        """Build game objects for many games, loading all of their players and latest rounds at once.
+
+        :param rows: Sequence of (game_id, num_players, goal, state, ts, rounds, version) tuples
+        :param db: Storage
+        :param players: Players of the games as returned by Storage.get_players(). Loaded if None.
+        :return: List of game objects in the order of rows
+        """
+        if players is None:
+            players = db.get_players([row[0] for row in rows])
+        last_turns = db.get_last_turns([row[0] for row in rows if row[5]])
+        return [
+            cls(*row, db, players=players[row[0]], last_turn=last_turns.get(row[0], []))
+            for row in rows
+        ]
+
+    def _load(self, first_round, moves):
+        """Replace the loaded rounds with rounds first_round up to rounds.
+
+        :param moves: (round, player_index, move) rows
+        """
+        width = len(self.players)
+        self._moves = array.array('b', [NO_MOVE]) * ((self.rounds - first_round) * width)
+        for round_index, index, move in moves:
+            self._moves[(round_index - first_round) * width + index] = self.MOVE_CODES[move]
+        self._first_round = first_round
+
+    def turns_from(self, first_round):
+        """Rounds first_round up to the latest, each an array with one move code (or NO_MOVE) per player.
+
+        Only moves of rounds that are not loaded yet are read from storage.
+
+        :param first_round: Index of the first round to return
+        :return: List of arrays
+        """
+        if self._first_round > first_round:
+            # Moves of rounds started after the game was read are not part of this state
+            self._load(first_round, self.db.get_moves(self.id, first_round, self.rounds))
+        width = len(self.players)
+        start = (first_round - self._first_round) * width
+        return [self._moves[index:index + width] for index in range(start, len(self._moves), width)]
+
+    @property
+    def turns(self):
+        """All rounds of the game, each an array with one move code (or NO_MOVE) per player."""
+        return self.turns_from(0)
+
+    def last_turn(self):
+        """Return the move codes of the latest round, or None if nobody has moved yet."""
+        if not self.rounds:
+            return None
+        if self._first_round == self.rounds:
+            self._load(self.rounds - 1, self.db.get_moves(self.id, self.rounds - 1, self.rounds))
+        return self._moves[-len(self.players):]
+
+    def player_index(self, username):
+        """Return player's index in player list
+
+        :param username: Name of the user to find index for
+        :return: int
+        """
+        return self._index[username]
+
+    def save_move(self, index, move, new_round=False):
+        """Record a player's move in the latest round.
+
+        :param index: Position of player in Game's player list
+        :param move: The move, one of MOVES
+        :param new_round: Start a new round with this move
+        """
+        width = len(self.players)
+        if new_round:
+            self._moves.extend([NO_MOVE] * width)
+            self.rounds += 1
+        else:
+            self.last_turn()
+        self._moves[len(self._moves) - width + index] = self.MOVE_CODES[move]
+        self.db.add_move(self.id, self.rounds - 1, index, move)
+        # Commit in save_game_state()
+
+    def save_score_for_player(self, index):
+        """Save player's score.
+
+        :param index: Position of player in Game's player list
+        """
+        player = self.players[index]
+        self.db.save_score(self.id, player.name, player.score)
+        # Commit in save_game_state()
+
+    def save_round_winners(self, indexes):
+        """Count the latest round in the stats of the players who won it.
+
+        :param indexes: Positions of the winners in Game's player list
+        """
+        if indexes:
+            self.db.add_round_wins(self.id, [self.players[index].name for index in indexes])
+        # Commit in save_game_state()
+
+    def set_game_over(self):
+        """Set game status to game over and count the game in the stats of its players, as won by those who reached
+        the goal.
+        """
+        self.state = 2  # Game over
+        self.db.end_game(self.id)
+        self.db.add_game_results(
+            self.id, [p.name for p in self.players], [p.name for p in self.players if p.score >= self.goal]
+        )
+        # Commit in save_game_state()
+
+    def save_game_state(self):
+        """Save game state. Inside Storage.batch() the commit waits for the end of the batch.
+
+        Raises ConflictError if the game was changed since it was read. The caller rolls back, see change().
+        """
+        self.ts = utc_timestamp()
+        self.db.save_game_state(self.id, self.rounds, self.ts, self.version, [p.name for p in self.players])
+        self.version += 1
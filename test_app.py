@@ -0,0 +1,164 @@
+"""Tests of the web app against a fresh in-memory store.
+
+    python -m unittest test_app
+"""
+
+import io
+import json
+import re
+import time
+import unittest
+import unittest.mock
+
+import app
+import archive
+import db_memory
+import storage
+
+
+def call(path, query='', token=None, body=None, host='localhost'):
+    """Call the app once and return (status, decoded body)."""
+    data = json.dumps(body).encode() if body is not None else b''
+    e = {
+        'REQUEST_METHOD': 'POST' if body is not None else 'GET',
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(data),
+        'CONTENT_LENGTH': str(len(data)),
+        'HTTP_HOST': host,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+    }
+    if token:
+        e['HTTP_COOKIE'] = 'session={}'.format(token)
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = status
+
+    result = app.application(e, start_response)
+    try:
+        text = b''.join(result).decode()
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return response['status'], text
+
+
+class ArchivedGameTest(unittest.TestCase):
+    def setUp(self):
+        store = db_memory.MemoryStore()
+        storage.configure(lambda: db_memory.MemoryDB(store))
+        self.db = db_memory.MemoryDB(store)
+        self.tokens = {}
+        for name in ('alice', 'bob'):
+            status, text = call('/api/login', body={'username': name, 'password': 'secret', 'register': True})
+            self.tokens[name] = json.loads(text)['token']
+        self.db.new_game(2, 1, 'alice')
+        self.db.join_game(1, 'bob')
+        call('/game', 'id=1&move=r', self.tokens['alice'])
+        call('/game', 'id=1&move=s', self.tokens['bob'])
+        self.assertEqual(self.db.get_game_by_id(1)[2], 2)  # Over after one round
+        self.assertEqual(archive.archive_batch(self.db, '9999-12-31 00:00:00'), 1)
+        self.assertIsNone(self.db.get_game_by_id(1))
+
+    def tearDown(self):
+        storage.configure(None)
+
+    def test_move_on_archived_game_page(self):
+        status, text = call('/game', 'id=1&move=p', self.tokens['alice'])
+        self.assertEqual(status, '200 OK')
+        self.assertIn('Game 1', text)
+
+    def test_move_on_archived_game_api(self):
+        status, text = call('/api/moves', token=self.tokens['alice'], body=[{'id': 1, 'move': 'p'}])
+        self.assertEqual(status, '200 OK')
+        self.assertEqual([(result['id'], result['ok']) for result in json.loads(text)['results']], [(1, False)])
+
+
+class LongPollTest(unittest.TestCase):
+    def setUp(self):
+        self.store = db_memory.MemoryStore()
+        storage.configure(lambda: db_memory.MemoryDB(self.store))
+        status, text = call('/api/login', body={'username': 'alice', 'password': 'secret', 'register': True})
+        self.token = json.loads(text)['token']
+
+    def tearDown(self):
+        storage.configure(None)
+
+    def test_bad_query(self):
+        for path, query in [('/wait_games', ''), ('/wait_games', 'v=abc'), ('/wait_game', 'v=1'),
+                            ('/wait_game', 'id=x&v=1'), ('/wait_game', 'id=1')]:
+            status, text = call(path, query, self.token)
+            self.assertEqual(status, '400 Bad Request', (path, query))
+
+    def test_change_by_other_process(self):
+        status, page = call('/', token=self.token)
+        (seen,) = re.findall(r"poll\('([^']*)'\)", page)
+        self.store.lobby_version += 1  # Like a game created by another process, which does not publish on our hub
+        started = time.monotonic()
+        with unittest.mock.patch('notify.CHECK_INTERVAL', 0.05):
+            status, version = call('/wait_games', 'v=' + seen, self.token)
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertNotEqual(version, seen)
+        status, page = call('/', token=self.token)
+        self.assertEqual(re.findall(r"poll\('([^']*)'\)", page), [version])
+
+
+class PageCacheTest(unittest.TestCase):
+    def setUp(self):
+        store = db_memory.MemoryStore()
+        storage.configure(lambda: db_memory.MemoryDB(store))
+        status, text = call('/api/login', body={'username': 'alice', 'password': 'secret', 'register': True})
+        self.token = json.loads(text)['token']
+        db = db_memory.MemoryDB(store)
+        db.new_game(2, 1, 'alice')
+        db.join_game(1, 'bob')
+
+    def tearDown(self):
+        storage.configure(None)
+
+    def test_links_follow_host(self):
+        for path, query in [('/', ''), ('/game', 'id=1')]:
+            call(path, query, self.token, host='a.example')
+            status, text = call(path, query, self.token, host='b.example')  # Not the page cached for a.example
+            self.assertIn('http://b.example/', text, path)
+            self.assertNotIn('a.example', text, path)
+
+
+class LeaderboardTest(unittest.TestCase):
+    def setUp(self):
+        store = db_memory.MemoryStore()
+        storage.configure(lambda: db_memory.MemoryDB(store))
+        self.db = db_memory.MemoryDB(store)
+        for game_id, (winner, loser) in enumerate([('bob', 'alice'), ('carol', 'alice'), ('bob', 'carol')], 1):
+            self.db.new_game(2, 1, winner)
+            self.db.join_game(game_id, loser)
+            self.db.add_game_results(game_id, [winner, loser], [winner])
+
+    def tearDown(self):
+        storage.configure(None)
+
+    def test_pages(self):
+        ranking = [('bob', 2, 2, 0), ('carol', 2, 1, 0), ('alice', 2, 0, 0)]
+        self.assertEqual(self.db.leaderboard(), ranking)
+        self.assertEqual(self.db.leaderboard(limit=2), ranking[:2])
+        self.assertEqual(self.db.leaderboard('bob', 1), ranking[1:2])
+        self.assertEqual(self.db.leaderboard('carol'), ranking[2:])
+
+    def test_undo_keeps_ranking(self):
+        with self.assertRaises(ZeroDivisionError):
+            with self.db.batch():
+                self.db.add_game_results(1, ['alice'], ['alice'])
+                1 / 0
+        self.assertEqual([row[0] for row in self.db.leaderboard()], ['bob', 'carol', 'alice'])
+
+    def test_bad_rank(self):
+        for rank in ('abc', '-3'):
+            status, text = call('/leaderboard', 'rank=' + rank)
+            self.assertEqual(status, '200 OK')
+            self.assertIn('bob', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+"""Tests of the HTTP/1.1 framing in asgi.HTTPConnection.
+
+    python -m unittest test_asgi
+"""
+
+import asyncio
+import unittest
+import unittest.mock
+
+import app
+import asgi
+import db_memory
+import storage
+from asgi import HTTPConnection
+
+
+class FakeWriter:
+    """Collects what is written to the connection."""
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def get_extra_info(self, name):
+        return None
+
+    def close(self):
+        pass
+
+
+def respond(status, body, method='GET', keep_alive=True):
+    """Send a response through HTTPConnection and return the bytes on the wire."""
+    writer = FakeWriter()
+    exchange = HTTPConnection(None, writer, b'', keep_alive, method)
+
+    async def send():
+        await exchange.send({'type': 'http.response.start', 'status': status, 'headers': [(b'etag', b'"1"')]})
+        await exchange.send({'type': 'http.response.body', 'body': body, 'more_body': True})
+        await exchange.send({'type': 'http.response.body', 'body': b''})
+
+    asyncio.run(send())
+    return writer.data
+
+
+class HTTPConnectionTest(unittest.TestCase):
+    def test_chunked_keep_alive(self):
+        self.assertEqual(
+            respond(200, b'hello'),
+            b'HTTP/1.1 200 OK\r\netag: "1"\r\ntransfer-encoding: chunked\r\n\r\n5\r\nhello\r\n0\r\n\r\n'
+        )
+
+    def test_not_modified_has_no_body(self):
+        self.assertEqual(respond(304, b''), b'HTTP/1.1 304 Not Modified\r\netag: "1"\r\n\r\n')
+
+    def test_no_content_has_no_body(self):
+        self.assertEqual(respond(204, b'ignored'), b'HTTP/1.1 204 No Content\r\netag: "1"\r\n\r\n')
+
+    def test_head_has_no_body(self):
+        self.assertEqual(respond(200, b'hello', method='HEAD'), b'HTTP/1.1 200 OK\r\netag: "1"\r\n\r\n')
+
+    def test_close_without_length(self):
+        self.assertEqual(respond(200, b'hello', keep_alive=False),
+                         b'HTTP/1.1 200 OK\r\netag: "1"\r\nconnection: close\r\n\r\nhello')
+
+    def test_chunked_request_refused(self):
+        async def serve():
+            reader = asyncio.StreamReader()
+            reader.feed_data(b'POST /api/moves HTTP/1.1\r\nHost: localhost\r\nTransfer-Encoding: chunked\r\n\r\n'
+                             b'2\r\n[]\r\n0\r\n\r\n')
+            reader.feed_eof()
+            writer = FakeWriter()
+            await asgi.serve_connection(None, reader, writer)  # Answered before the app is called
+            return writer.data
+
+        self.assertEqual(asyncio.run(serve()),
+                         b'HTTP/1.1 411 Length Required\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+
+
+def call(path, query, token):
+    """Send a GET request through asgi.ASGIApp and return (status, body)."""
+    messages = []
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode(),
+             'headers': [(b'authorization', 'Bearer {}'.format(token).encode())]}
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(asgi.ASGIApp(app.application, workers=2)(scope, receive, send))
+    return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:]).decode()
+
+
+class LongPollTest(unittest.TestCase):
+    def setUp(self):
+        self.store = db_memory.MemoryStore()
+        storage.configure(lambda: db_memory.MemoryDB(self.store))
+        with storage.open_db() as db:
+            db.add_username('alice', 'secret')
+            self.token = db.new_session('alice')
+            self.seen = app.root_page_version(db, 'alice')
+
+    def tearDown(self):
+        storage.configure(None)
+
+    def test_bad_query(self):
+        self.assertEqual(call('/wait_games', 'v=abc', self.token), (400, 'Expected v'))
+        self.assertEqual(call('/wait_game', 'v=1', self.token), (400, 'Expected id and v'))
+
+    def test_change_by_other_process(self):
+        self.store.lobby_version += 1  # Like a game created by another process, which does not publish on our hub
+        with unittest.mock.patch('notify.CHECK_INTERVAL', 0.05):
+            status, version = call('/wait_games', 'v=' + self.seen, self.token)
+        self.assertEqual(status, 200)
+        self.assertNotEqual(version, self.seen)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+"""Tests of the sharded SQLite backend against fresh database files.
+
+    python -m unittest test_db_sharded
+"""
+
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import archive
+import db_sharded
+import db_sqlite
+import db_sqlite_initialize
+
+
+class ShardGamesTest(unittest.TestCase):
+    """Games played before the database was split into shards."""
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'game.db')
+        self.connections = [sqlite3.connect(path) for path in [self.path] + db_sharded.shard_paths(self.path, 2)]
+        for connection in reversed(self.connections):  # The shards first, game.db counts the stats of their games
+            db_sqlite_initialize.migrate(connection)
+        pool = db_sqlite.ConnectionPool(self.path, size=1)
+        with db_sqlite.DB(pool) as db:
+            db.add_username('alice', 'secret')
+            for game_id in (1, 2, 3):
+                db.new_game(2, 1, 'alice')
+                db.join_game(game_id, 'bob')
+            with db.batch():
+                db.add_move(2, 0, 0, 'r')
+                db.end_game(3)
+            self.assertEqual(archive.archive_batch(db, '9999-12-31 00:00:00'), 1)
+        pool.close()
+
+    def tearDown(self):
+        db_sharded.configure(count=0)
+        for connection in self.connections:
+            connection.close()
+        self.directory.cleanup()
+
+    def shard(self):
+        archived = db_sqlite.Archive(os.path.join(self.directory.name, db_sqlite.ARCHIVE_DATABASE))
+        return db_sqlite_initialize.shard_games(self.connections[0], self.connections[1:], archived)
+
+    def test_games_move_to_their_shard(self):
+        self.assertEqual(self.shard(), 2)
+        self.assertEqual(self.shard(), 0)  # Split already
+        db_sharded.configure(self.path, 2, size=1)
+        with db_sharded.ShardedDB() as db:
+            self.assertEqual([row[0] for row in db.get_games_by_user('bob')], [1, 2])
+            self.assertEqual(db.shards[0].get_moves(2, 0, 1), [(0, 0, 'r')])
+            self.assertIsNotNone(db.get_archived_game(3))
+            self.assertEqual(list(db.users.dump_table('game')), [])
+            db.new_game(2, 1, 'carol')
+            db.new_game(2, 1, 'carol')
+            # Above the archived game, whose id is no longer in any game table
+            self.assertEqual([row[0] for row in db.get_games_by_user('carol')], [4, 5])
+
+    def test_dump_pages(self):
+        self.shard()
+        db_sharded.configure(self.path, 2, size=1)
+        with db_sharded.ShardedDB() as db:
+            for table in ('game', 'player', 'move'):
+                rows = list(db.dump_table(table))
+                pages, after = [], 0
+                while True:
+                    page = list(db.dump_table(table, after, 1))
+                    if not page:
+                        break
+                    pages.extend(page)
+                    after = page[-1][0]
+                self.assertEqual(pages, rows, table)
+                self.assertEqual(len({row[0] for row in rows}), len(rows), table)
+            self.assertEqual(len(rows), 1)
+            self.assertEqual(len(list(db.dump_table('player'))), 4)  # Rowids 1 and 2 in both shards
+
+    def test_other_count_refused(self):
+        self.shard()
+        with self.assertRaises(RuntimeError):
+            db_sqlite_initialize.shard_games(self.connections[0], self.connections[1:] + [self.connections[1]])
+        with self.assertRaises(RuntimeError):
+            db_sharded.configure(self.path, 3, size=1)
+        db_sqlite.configure_pool(self.path, size=1)
+        with self.assertRaises(RuntimeError):
+            db_sharded.check_layout()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+"""Tests of the SQLite backend against a fresh database file, shared by two pools as by two server processes.
+
+    python -m unittest test_db_sqlite
+"""
+
+import os
+import sqlite3
+import tempfile
+import unittest
+import unittest.mock
+
+import archive
+import db_sqlite
+import db_sqlite_initialize
+import pyramid
+import storage
+
+
+class TwoPoolsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, 'game.db')
+        connection = sqlite3.connect(path)
+        db_sqlite_initialize.migrate(connection)
+        connection.close()
+        self.pools = [db_sqlite.ConnectionPool(path, size=2), db_sqlite.ConnectionPool(path, size=2)]
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.close()
+        self.directory.cleanup()
+
+    def db(self, index):
+        return db_sqlite.DB(self.pools[index])
+
+    def lobby(self, index, username):
+        with self.db(index) as db:
+            return [row[0] for row in db.get_registering_games_by_user(username)]
+
+    def test_lobby_sees_other_pool(self):
+        self.assertEqual(self.lobby(0, 'bob'), [])
+        with self.db(1) as db:
+            db.new_game(2, 5, 'alice')
+        self.assertEqual(self.lobby(0, 'bob'), [1])
+        with self.db(1) as db:
+            db.join_game(1, 'bob')
+        self.assertEqual(self.lobby(0, 'carol'), [])
+
+    def test_own_change_keeps_lobby_current(self):
+        self.assertEqual(self.lobby(0, 'bob'), [])
+        with self.db(0) as db:
+            db.new_game(2, 5, 'alice')
+            db.new_game(2, 5, 'carol')
+            db.join_game(2, 'bob')
+            self.assertEqual(self.pools[0].lobby.counter, db._lobby_counter())  # No reload needed
+        self.assertEqual(self.lobby(0, 'bob'), [1])
+
+    def race(self):
+        """Let bob move in a game read before alice's move was saved through the other pool.
+
+        :return: (game as saved, number of times bob's game was read again)
+        """
+        with self.db(0) as db:
+            db.new_game(2, 2, 'alice')
+            db.join_game(1, 'bob')
+        with self.db(0) as db_a, self.db(1) as db_b:
+            game_a = pyramid.Pyramid(1, *db_a.get_game_by_id(1), db_a)
+            game_b = pyramid.Pyramid(1, *db_b.get_game_by_id(1), db_b)
+            self.assertTrue(game_a.add_player_move('alice', 'r'))
+            with unittest.mock.patch.object(pyramid.Pyramid, 'reload', autospec=True,
+                                            side_effect=pyramid.Pyramid.reload) as reload:
+                self.assertTrue(game_b.add_player_move('bob', 's'))  # Saved on top of alice's move
+        with self.db(0) as db:
+            return pyramid.Pyramid(1, *db.get_game_by_id(1), db), reload.call_count
+
+    def test_race_retried(self):
+        game, retries = self.race()
+        self.assertEqual(retries, 1)
+        codes = pyramid.Pyramid.MOVE_CODES
+        self.assertEqual([list(turn) for turn in game.turns], [[codes['r'], codes['s']]])  # One round, not two
+        self.assertEqual([player.score for player in game.players], [1, 0])
+
+    def test_race_retried_under_lock(self):
+        statements = []
+        connection = self.pools[1].get()
+        connection.set_trace_callback(statements.append)
+        self.pools[1].put(connection)
+        with unittest.mock.patch('db_sqlite.MAX_RETRIES', 2):  # The second attempt is the last
+            game, retries = self.race()
+        self.assertEqual(retries, 1)
+        self.assertIn('BEGIN IMMEDIATE', statements)
+        self.assertEqual([player.score for player in game.players], [1, 0])
+
+
+class SessionTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, 'game.db')
+        connection = sqlite3.connect(path)
+        db_sqlite_initialize.migrate(connection)
+        connection.close()
+        self.pool = db_sqlite.ConnectionPool(path, size=1)
+        storage.configure(lambda: db_sqlite.DB(self.pool))
+
+    def tearDown(self):
+        storage.configure(None)
+        self.pool.close()
+        self.directory.cleanup()
+
+    def test_expired_while_cached(self):
+        with storage.open_db() as db:
+            with unittest.mock.patch('db_sqlite.SESSION_DAYS', -1):
+                token = db.new_session('alice')
+            self.assertIsNotNone(db_sqlite.session_cache.get(token))
+            self.assertIsNone(db.session_user(token))
+
+    def test_expired_deleted(self):
+        with storage.open_db() as db:
+            token = db.new_session('alice')
+            with unittest.mock.patch('db_sqlite.SESSION_DAYS', -1):
+                for _ in range(3):
+                    db.new_session('bob')
+        self.assertEqual(archive.run(pause=0, batch_size=2), (0, 0, 3))
+        with storage.open_db() as db:
+            self.assertEqual(db.delete_expired_sessions(10), 0)
+            db_sqlite.session_cache.invalidate(token)
+            self.assertEqual(db.session_user(token), 'alice')
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def test_health_check_after_idle(self):
+        pool = db_sqlite.ConnectionPool(':memory:', size=1)
+        connection = pool.get()
+        statements = []
+        connection.set_trace_callback(statements.append)
+        pool.put(connection)
+        self.assertIs(pool.get(), connection)
+        self.assertEqual(statements, [])  # Not checked right after being handed back
+        pool.put(connection)
+        connection.close()  # Broken while idle
+        with unittest.mock.patch('db_sqlite.HEALTH_CHECK_IDLE', 0):
+            fresh = pool.get()
+        self.assertIsNot(fresh, connection)
+        self.assertEqual(fresh.execute('SELECT 1').fetchone(), (1,))
+        pool.put(fresh)
+        pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
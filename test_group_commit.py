@@ -0,0 +1,100 @@
+"""Tests of the group commit writer against a fresh database file, with callers in threads of their own.
+
+    python -m unittest test_group_commit
+"""
+
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+import db_sqlite
+import db_sqlite_initialize
+import group_commit
+
+
+class GroupCommitTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'game.db')
+        connection = sqlite3.connect(self.path)
+        db_sqlite_initialize.migrate(connection)
+        connection.close()
+        self.writer_pool = db_sqlite.ConnectionPool(self.path, size=1)
+        self.pool = db_sqlite.ConnectionPool(self.path, size=3)
+        self.statements = []
+        self.connection = self.writer_pool.get()  # The one the writer borrows
+        self.connection.set_trace_callback(self.statements.append)
+        self.writer_pool.put(self.connection)
+
+    def tearDown(self):
+        group_commit.stop()
+        self.pool.close()
+        self.writer_pool.close()
+        self.directory.cleanup()
+
+    def users(self):
+        """Return the user names committed so far, as another process sees them."""
+        connection = sqlite3.connect(self.path)
+        try:
+            return {name for (name,) in connection.execute('SELECT name FROM user')}
+        finally:
+            connection.close()
+
+    def run_group(self, *changes):
+        """Call each change in a thread of its own, all applied in one group however long they take to arrive.
+
+        :return: List of (result, exception, user names committed when the change returned) per change
+        """
+        group_commit.start(self.writer_pool, window=10.0, max_batch=len(changes))
+        outcomes = [None] * len(changes)
+
+        def call(index, change):
+            with group_commit.GroupCommitDB(self.pool) as db:
+                try:
+                    outcomes[index] = (change(db), None, self.users())
+                except Exception as error:
+                    outcomes[index] = (None, error, self.users())
+
+        threads = [threading.Thread(target=call, args=item) for item in enumerate(changes)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def test_failing_change_rolled_back_alone(self):
+        def failing(db):
+            def change():
+                db.add_username('mallory', 'secret')  # In the savepoint of this change
+                raise ValueError('bad change')
+            return db.change(1, change)
+
+        outcomes = self.run_group(lambda db: db.add_username('alice', 'secret'), failing,
+                                  lambda db: db.add_username('bob', 'secret'))
+        self.assertEqual([result for result, error, users in outcomes], [True, None, True])
+        self.assertIsInstance(outcomes[1][1], ValueError)
+        self.assertEqual(self.users(), {'alice', 'bob'})
+        self.assertEqual(self.statements.count('COMMIT'), 1)  # One transaction for the group
+
+    def test_acknowledged_after_commit(self):
+        outcomes = self.run_group(*[lambda db, name=name: db.add_username(name, 'secret')
+                                    for name in ('alice', 'bob', 'carol')])
+        for result, error, users in outcomes:
+            self.assertTrue(result)
+            self.assertEqual(users, {'alice', 'bob', 'carol'})  # The whole group was on disk when it returned
+
+    def test_connection_handed_back(self):
+        writer = group_commit.start(self.writer_pool, window=0, max_batch=1)
+        synchronous = writer.submit(lambda: self.connection.execute('PRAGMA synchronous').fetchone()[0])
+        self.assertEqual(synchronous, 2)  # FULL
+        group_commit.stop()
+        self.assertIs(self.writer_pool.get(), self.connection)  # No timeout, the pool has its only connection back
+        self.assertFalse(self.connection.in_transaction)
+        self.assertEqual(self.connection.execute('PRAGMA synchronous').fetchone()[0], 1)  # NORMAL, like the others
+        self.writer_pool.put(self.connection)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+"""Threaded WSGI server with a bounded worker pool.
+
+wsgiref.simple_server handles one request at a time, so one slow page holds up every other client. The server in
+this module accepts connections on the main thread and hands them to a fixed number of worker threads through a
+bounded queue. When the queue is full the connection is answered with 503 right away instead of waiting in line.
+"""
+
+import queue
+import threading
+import wsgiref.simple_server
+
+WORKERS = 8
+QUEUE_SIZE = 64
+
+SERVICE_UNAVAILABLE = (
+    b'HTTP/1.0 503 Service Unavailable\r\n'
+    b'Content-Type: text/plain; charset=utf-8\r\n'
+    b'Content-Length: 12\r\n'
+    b'Retry-After: 1\r\n'
+    b'Connection: close\r\n'
+    b'\r\n'
+    b'Server busy\n'
+)
+
+
+class ThreadedWSGIServer(wsgiref.simple_server.WSGIServer):
+    """WSGI server that serves requests from a pool of worker threads."""
+    def __init__(self, server_address, workers=WORKERS, queue_size=QUEUE_SIZE,
+                 handler_class=wsgiref.simple_server.WSGIRequestHandler):
+        self.request_queue_size = queue_size  # Listen backlog, read by TCPServer.server_activate()
+        super().__init__(server_address, handler_class)
+        self._requests = queue.Queue(queue_size)
+        self._workers = [threading.Thread(target=self._work, name='wsgi-worker-{}'.format(i), daemon=True)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def process_request(self, request, client_address):
+        """Queue an accepted connection for the workers, or turn it away if the queue is full."""
+        try:
+            self._requests.put_nowait((request, client_address))
+        except queue.Full:
+            self._reject(request)
+
+    def _reject(self, request):
+        try:
+            request.settimeout(0.0)
+            try:
+                request.recv(65536)  # Drain the request so closing the socket does not reset the connection
+            except OSError:
+                pass
+            request.settimeout(1.0)
+            request.sendall(SERVICE_UNAVAILABLE)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def _work(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        """Stop accepting connections and let the workers finish the requests already queued."""
+        super().server_close()
+        for _ in self._workers:
+            self._requests.put(None)
+        for worker in self._workers:
+            worker.join()
+
+
+def make_server(host, port, app, workers=WORKERS, queue_size=QUEUE_SIZE):
+    """Create a threaded server for a WSGI application.
+
+    :param host: Interface to listen on, '' for all
+    :param port: TCP port
+    :param app: WSGI application
+    :param workers: Number of worker threads
+    :param queue_size: Maximum number of accepted connections waiting for a worker
+    :return: ThreadedWSGIServer
+    """
+    server = ThreadedWSGIServer((host, port), workers, queue_size)
+    server.set_app(app)
+    return server